@@ -14,6 +14,7 @@ from keras import backend as K
 from keras.models import load_model
 
 import astroNN.NN.train_tools
+from astroNN.datasets.h5_tools import load_spectra
 
 
 def cnn_visualization(folder_name=None, h5name=None, num=None):
@@ -63,7 +64,7 @@ def cnn_visualization(folder_name=None, h5name=None, num=None):
             else:
                 index_not9999 = reduce(np.intersect1d, (index_not9999, temp_index))
 
-        spectra = np.array(F['spectra'])
+        spectra = load_spectra(F)
         rel_index = np.array(F['index'])
         spectra = spectra[index_not9999]
         spectra -= spec_meanstd[0]
@@ -74,6 +75,7 @@ def cnn_visualization(folder_name=None, h5name=None, num=None):
         rel_index = rel_index[ran]
     num_label = spectra.shape[1]
 
+    apogee_id = astroNN.NN.train_tools.apogee_id_fetch(relative_index=rel_index, dr=14)
     for i in range(random_number):
         temp_path = os.path.join(vis_parent_path, str(i))
         if not os.path.exists(temp_path):
@@ -81,7 +83,6 @@ def cnn_visualization(folder_name=None, h5name=None, num=None):
         reshaped = spectra[i].reshape((1, num_label, 1))
         layer_1_output = layer_1([reshaped, 0])[0]
         layer_2_output = layer_2([reshaped, 0])[0]
-        apogee_id = astroNN.NN.train_tools.apogee_id_fetch(relative_index=rel_index, dr=14)
 
         plt.figure(figsize=(30, 15), dpi=200)
         plt.rcParams['axes.grid'] = False
@@ -173,7 +174,7 @@ def cnn_gaia_visualization(folder_name=None, h5name=None, num=None):
             else:
                 index_not9999 = reduce(np.intersect1d, (index_not9999, temp_index))
 
-        spectra = np.array(F['spectra'])
+        spectra = load_spectra(F)
         spectra = spectra[index_not9999]
         spectra -= spec_meanstd[0]
         spectra /= spec_meanstd[1]
@@ -4,7 +4,6 @@
 
 import datetime
 import os
-import random
 from functools import reduce
 
 import h5py
@@ -18,15 +17,18 @@ from keras.utils import plot_model
 import astroNN.NN.cnn_models
 import astroNN.NN.generative_test
 import astroNN.NN.train_tools
+from astroNN.datasets.h5_tools import load_spectra
 
 
-def apogee_generative_train(h5name=None, model=None, test=False):
+def apogee_generative_train(h5name=None, model=None, test=False, workers=1, use_multiprocessing=False):
     """
     NAME: apogee_generative_train
     PURPOSE: To train generative model
     INPUT:
         h5name: name of h5 data, {h5name}_train.h5
         model: which model defined in astroNN.NN.cnn_model.py
+        workers: number of workers making batches, spectra and best fit spectra are read from the h5 file if workers>1
+        use_multiprocessing: True to make batches in processes instead of threads, batches are read from the h5 file
     OUTPUT: target and normalized data
     HISTORY:
         2017-Oct-14 Henry Leung
@@ -42,8 +44,8 @@ def apogee_generative_train(h5name=None, model=None, test=False):
     h5test = h5name + '_test.h5'
 
     with h5py.File(h5data) as F:  # ensure the file will be cleaned up
-        spectra = np.array(F['spectra'])
-        y = np.array(F['spectrabestfit'])
+        spectra = load_spectra(F)
+        y = load_spectra(F, 'spectrabestfit')
         num_flux = spectra.shape[1]
         input_std = spectra.std()
         output_std = y.std()
@@ -113,13 +115,34 @@ def apogee_generative_train(h5name=None, model=None, test=False):
 
     model.compile(optimizer=optimizer, loss=loss_function, metrics=metrics)
 
-    model.fit_generator(astroNN.NN.generative.generate_train_batch(num_train, batch_size, 0, spectra, y),
-                        steps_per_epoch=num_train / batch_size,
+    # Batches fit_generator keeps queued, EpochSampler needs to know it so a queued batch is never overwritten
+    max_queue_size = 10
+
+    if workers > 1 or use_multiprocessing is True:
+        # Workers read both the spectra and their best fit from the h5 file, so the arrays in memory are not needed
+        del spectra, y
+        rows = np.arange(num_train + num_cv)
+        train_data = astroNN.NN.train_tools.H5Sequence(h5data, rows[:num_train], None, batch_size,
+                                                       spec_meanstd=(1., input_std), y_name='spectrabestfit',
+                                                       y_meanstd=(1., output_std))
+        cv_data = astroNN.NN.train_tools.H5Sequence(h5data, rows[num_train:], None, batch_size,
+                                                    spec_meanstd=(1., input_std), shuffle=False,
+                                                    y_name='spectrabestfit', y_meanstd=(1., output_std))
+        train_steps, cv_steps = len(train_data), len(cv_data)
+    else:
+        train_sampler = astroNN.NN.train_tools.EpochSampler(spectra, y, batch_size, indx=0, num_objects=num_train,
+                                                            queue_size=max_queue_size)
+        cv_sampler = astroNN.NN.train_tools.EpochSampler(spectra, y, batch_size, indx=num_train, num_objects=num_cv,
+                                                         shuffle=False, queue_size=max_queue_size)
+        train_data, cv_data = train_sampler.generate(), cv_sampler.generate()
+        train_steps, cv_steps = train_sampler.steps, cv_sampler.steps
+
+    model.fit_generator(train_data,
+                        steps_per_epoch=train_steps,
                         epochs=max_epochs,
-                        validation_data=astroNN.NN.generative.generate_cv_batch(num_cv, batch_size, num_train, spectra,
-                                                                                y),
-                        max_queue_size=10, verbose=2, callbacks=[early_stopping, reduce_lr, csv_logger],
-                        validation_steps=num_cv / batch_size)
+                        validation_data=cv_data,
+                        max_queue_size=max_queue_size, verbose=2, callbacks=[early_stopping, reduce_lr, csv_logger],
+                        validation_steps=cv_steps, workers=workers, use_multiprocessing=use_multiprocessing)
 
     astronn_model = 'generative_{}.h5'.format(model_name)
     model.save(folder_name + astronn_model)
@@ -135,40 +158,24 @@ def apogee_generative_train(h5name=None, model=None, test=False):
     return None
 
 
-def load_batch(num_train, batch_size, indx, spectra, y):
-    # Generate list of random indices (within the relevant partition of the main data file, e.g. the
-    # training set) to be used to index into data_file
-    indices = random.sample(range(indx, indx + num_train), batch_size)
-    indices = np.sort(indices)
-
-    # load data
-    spectra = spectra[indices, :]
-    normed_y = y[:][indices]
-
-    # Reshape X data for compatibility with CNN
-    spectra = spectra.reshape(len(spectra), spectra.shape[1], 1)
-
-    return spectra, normed_y
-
-
 def generate_train_batch(num_objects, batch_size, indx, spectra, y):
-    while True:
-        x_batch, y_batch = load_batch(num_objects, batch_size, indx, spectra, y)
-        yield (x_batch, y_batch)
+    return astroNN.NN.train_tools.EpochSampler(spectra, y, batch_size, indx=indx, num_objects=num_objects).generate()
 
 
 def generate_cv_batch(num_objects, batch_size, indx, spectra, y):
-    while True:
-        x_batch, y_batch = load_batch(num_objects, batch_size, indx, spectra, y)
-        yield (x_batch, y_batch)
+    return astroNN.NN.train_tools.EpochSampler(spectra, y, batch_size, indx=indx, num_objects=num_objects,
+                                               shuffle=False).generate()
+
 
-def apogee_generator_train(h5name=None, model=None, test=False):
+def apogee_generator_train(h5name=None, model=None, test=False, workers=1, use_multiprocessing=False):
     """
     NAME: apogee_generator_train
     PURPOSE: To train generative model
     INPUT:
         h5name: name of h5 data, {h5name}_train.h5
         model: which model defined in astroNN.NN.cnn_model.py
+        workers: number of workers making batches, the target spectra are read from the h5 file if workers>1
+        use_multiprocessing: True to make batches in processes instead of threads, batches are read from the h5 file
     OUTPUT: target and normalized data
     HISTORY:
         2017-Nov-11 Henry Leung
@@ -200,7 +207,7 @@ def apogee_generator_train(h5name=None, model=None, test=False):
             else:
                 index_not9999 = reduce(np.intersect1d, (index_not9999, temp_index))
 
-        spectra = np.array(F['spectra'])
+        spectra = load_spectra(F)
         spectra = spectra[index_not9999]
 
         # num_flux = spectra.shape[1]
@@ -290,13 +297,33 @@ def apogee_generator_train(h5name=None, model=None, test=False):
 
     model.compile(optimizer=optimizer, loss=loss_function, metrics=metrics)
 
-    model.fit_generator(astroNN.NN.generative.generate_train_batch(num_train, batch_size, 0, spectra, y),
-                        steps_per_epoch=num_train / batch_size,
+    # Batches fit_generator keeps queued, EpochSampler needs to know it so a queued batch is never overwritten
+    max_queue_size = 10
+
+    if workers > 1 or use_multiprocessing is True:
+        # Labels are the input, the target spectra are read from the h5 file by the workers
+        del y
+        rows = np.asarray(index_not9999).ravel()
+        train_data = astroNN.NN.train_tools.H5Sequence(h5data, rows[:num_train], spectra[:num_train], batch_size,
+                                                       spec_meanstd=(1., output_std), labels_as_input=True)
+        cv_data = astroNN.NN.train_tools.H5Sequence(h5data, rows[num_train:], spectra[num_train:], batch_size,
+                                                    spec_meanstd=(1., output_std), shuffle=False,
+                                                    labels_as_input=True)
+        train_steps, cv_steps = len(train_data), len(cv_data)
+    else:
+        train_sampler = astroNN.NN.train_tools.EpochSampler(spectra, y, batch_size, indx=0, num_objects=num_train,
+                                                            queue_size=max_queue_size)
+        cv_sampler = astroNN.NN.train_tools.EpochSampler(spectra, y, batch_size, indx=num_train, num_objects=num_cv,
+                                                         shuffle=False, queue_size=max_queue_size)
+        train_data, cv_data = train_sampler.generate(), cv_sampler.generate()
+        train_steps, cv_steps = train_sampler.steps, cv_sampler.steps
+
+    model.fit_generator(train_data,
+                        steps_per_epoch=train_steps,
                         epochs=max_epochs,
-                        validation_data=astroNN.NN.generative.generate_cv_batch(num_cv, batch_size, num_train, spectra,
-                                                                                y),
-                        max_queue_size=10, verbose=2, callbacks=[early_stopping, reduce_lr, csv_logger],
-                        validation_steps=num_cv / batch_size)
+                        validation_data=cv_data,
+                        max_queue_size=max_queue_size, verbose=2, callbacks=[early_stopping, reduce_lr, csv_logger],
+                        validation_steps=cv_steps, workers=workers, use_multiprocessing=use_multiprocessing)
 
     astronn_model = 'generator_{}.h5'.format(model_name)
     model.save(folder_name + astronn_model)
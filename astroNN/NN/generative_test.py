@@ -16,6 +16,7 @@ from keras.models import load_model
 
 import astroNN.NN.train_tools
 import astroNN.datasets.h5_compiler
+from astroNN.datasets.h5_tools import load_spectra
 
 
 def batch_predictions(model, spectra, batch_size, num_labels):
@@ -49,9 +50,9 @@ def apogee_generative_test(model=None, testdata=None, folder_name=None, std=None
 
     with h5py.File(testdata) as F:
         random_number = 20
-        test_spectra = np.array(F['spectra'])
+        test_spectra = load_spectra(F)
         ran = random.sample(range(0, test_spectra.shape[0], 1), random_number)
-        bestfit_spectra = np.array(F['spectrabestfit'])
+        bestfit_spectra = load_spectra(F, 'spectrabestfit')
         rel_index = np.array((F['index'])[ran])
         test_spectra = test_spectra[ran]
         bestfit_spectra = bestfit_spectra[ran]
@@ -66,8 +67,8 @@ def apogee_generative_test(model=None, testdata=None, folder_name=None, std=None
     plt.rcParams['grid.color'] = 'gray'
     plt.rcParams['grid.alpha'] = '0.4'
 
+    apogee_id = astroNN.NN.train_tools.apogee_id_fetch(relative_index=rel_index, dr=14)
     for i in range(random_number):
-        apogee_id = astroNN.NN.train_tools.apogee_id_fetch(relative_index=rel_index, dr=14)
         test_predictions = predictions(model, test_spectra[i], std)
         test_predictions = test_predictions.reshape(num_labels)
         plt.figure(figsize=(30, 11), dpi=200)
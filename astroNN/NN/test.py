@@ -18,6 +18,7 @@ from keras.models import load_model
 
 import astroNN.apogee.cannon
 from astroNN.shared.nn_tools import h5name_check
+from astroNN.datasets.h5_tools import load_spectra
 
 
 def batch_predictions(model, spectra, batch_size, num_labels, std_labels, mean_labels):
@@ -112,7 +113,7 @@ def apogee_model_eval(h5name=None, folder_name=None, check_cannon=None, test_noi
             else:
                 index_not9999 = reduce(np.intersect1d, (index_not9999, temp_index))
 
-        test_spectra = np.array(F['spectra'])
+        test_spectra = load_spectra(F)
         test_spectra = test_spectra[index_not9999]
         test_spectra -= spec_meanstd[0]
         test_spectra /= spec_meanstd[1]
@@ -183,7 +184,7 @@ def apogee_model_eval(h5name=None, folder_name=None, check_cannon=None, test_noi
                 else:
                     index_not9999 = reduce(np.intersect1d, (index_not9999, temp_index))
 
-            train_spectra = np.array(F['spectra'])
+            train_spectra = load_spectra(F)
             train_spectra = train_spectra[index_not9999]
             sigma = 0.08 ** 2
             train_spectra_noisy = train_spectra + np.random.poisson(sigma, train_spectra.shape)
@@ -336,7 +337,7 @@ def gaia_model_eval(h5name=None, folder_name=None):
 
     # ensure the file will be cleaned up
     with h5py.File(h5test) as F:
-        test_spectra = np.array(F['spectra'])
+        test_spectra = load_spectra(F)
         test_spectra -= spec_meanstd[0]
         test_spectra /= spec_meanstd[1]
         absmag = np.array(F['absmag'])
@@ -379,7 +380,7 @@ def gaia_model_eval(h5name=None, folder_name=None):
 
     if traindata is not None:
         with h5py.File(traindata) as F:
-            train_spectra = np.array(F['spectra'])
+            train_spectra = load_spectra(F)
             train_spectra -= spec_meanstd[0]
             train_spectra /= spec_meanstd[1]
             absmag = np.array(F['absmag'])
@@ -10,6 +10,7 @@ import astroNN.NN.cnn_models
 import astroNN.NN.cnn_visualization
 import astroNN.NN.test
 import astroNN.NN.train_tools
+from astroNN.datasets.h5_tools import load_spectra
 import h5py
 import numpy as np
 import tensorflow as tf
@@ -23,7 +24,8 @@ def apogee_train(h5name=None, target=None, test=True, model=None, num_hidden=Non
                  activation=None, initializer=None, filter_length=None, pool_length=None, batch_size=None,
                  max_epochs=None, lr=None, early_stopping_min_delta=None, early_stopping_patience=None,
                  reuce_lr_epsilon=None, reduce_lr_patience=None, reduce_lr_min=None, cnn_visualization=True,
-                 cnn_vis_num=None, test_noisy=None):
+                 cnn_vis_num=None, test_noisy=None, workers=1, use_multiprocessing=False, streaming=False,
+                 tf_data=False, tf_data_cache=True):
     """
     NAME: apogee_train
     PURPOSE: To train
@@ -74,6 +76,14 @@ def apogee_train(h5name=None, target=None, test=True, model=None, num_hidden=Non
         cnn_visualization: whether do cnn visualization or not after training
         cnn_vis_num: number of spectra for cnn visualization!!Only has effect if and only if cnn_visualization=True!!
         test_noisy: whether of not test [train + noise + translation] data
+        workers: number of workers making batches, batches are read from the h5 file if workers>1
+        use_multiprocessing: True to make batches in processes instead of threads, batches are read from the h5 file
+        streaming: True to never load the spectra into memory, shuffled blocks of h5 chunks are read as they are
+                   needed, for datasets larger than memory (workers and use_multiprocessing are ignored)
+        tf_data: True to make batches with a tf.data pipeline in the threads of TensorFlow (workers,
+                 use_multiprocessing and streaming are ignored)
+        tf_data_cache: True to cache the spectra of the tf.data pipeline in memory, path of a file to cache them on
+                       disk, None not to cache
     OUTPUT: model
     HISTORY:
         2017-Oct-14 Henry Leung
@@ -177,24 +187,29 @@ def apogee_train(h5name=None, target=None, test=True, model=None, num_hidden=Non
             else:
                 index_not9999 = reduce(np.intersect1d, (index_not9999, temp_index))
 
-        spectra = np.array(F['spectra'])
-        spectra = spectra[index_not9999]
+        rows = np.ravel(index_not9999)
         # specpix_std = np.std(spectra)
 
         # Dont do std, so equal 1 deliberately
         specpix_std = 1
-        specpix_mean = np.median(spectra)
-        spectra -= specpix_mean
-        spectra /= specpix_std
-        num_flux = spectra.shape[1]
-        num_train = int(0.8 * spectra.shape[0])  # number of training example, rest are cross validation
-        num_cv = spectra.shape[0] - num_train  # cross validation
+        if streaming is True or tf_data is True or workers > 1 or use_multiprocessing is True:
+            # Spectra stay on disk, their median is estimated from a random sample
+            specpix_mean = astroNN.NN.train_tools.h5_median(F['spectra'], rows)
+        else:
+            spectra = load_spectra(F)
+            spectra = spectra[index_not9999]
+            specpix_mean = np.median(spectra)
+            spectra -= specpix_mean
+            spectra /= specpix_std
+        num_flux = F['spectra'].shape[1]
+        num_train = int(0.8 * rows.shape[0])  # number of training example, rest are cross validation
+        num_cv = rows.shape[0] - num_train  # cross validation
         # load data
         mean_labels = np.array([])
         std_labels = np.array([])
 
         i = 0
-        y = np.array((spectra.shape[1]))
+        y = np.array([])
         for tg in target:
             temp = np.array(F['{}'.format(tg)])
             temp = temp[index_not9999]
@@ -243,13 +258,55 @@ def apogee_train(h5name=None, target=None, test=True, model=None, num_hidden=Non
 
     model.compile(optimizer=optimizer, loss=loss_function, metrics=metrics)
 
-    model.fit_generator(astroNN.NN.train_tools.generate_train_batch(num_train, batch_size, 0, mu_std, spectra, y),
-                        steps_per_epoch=num_train / batch_size,
+    # Batches fit_generator keeps queued, EpochSampler needs to know it so a queued batch is never overwritten
+    max_queue_size = 10
+
+    if tf_data is True:
+        # The cross validation set is cached next to the training set if cached on disk
+        cv_cache = tf_data_cache + '_cv' if isinstance(tf_data_cache, str) else tf_data_cache
+        train_sampler = astroNN.NN.train_tools.H5TFDataset(h5data, rows[:num_train], y[:num_train], batch_size,
+                                                           spec_meanstd=spec_meanstd, mu_std=mu_std,
+                                                           cache=tf_data_cache)
+        cv_sampler = astroNN.NN.train_tools.H5TFDataset(h5data, rows[num_train:], y[num_train:], batch_size,
+                                                        spec_meanstd=spec_meanstd, mu_std=mu_std, shuffle=False,
+                                                        cache=cv_cache)
+        train_data, cv_data = train_sampler.generate(), cv_sampler.generate()
+        train_steps, cv_steps = train_sampler.steps, cv_sampler.steps
+        # Batches are made by the threads of TensorFlow, the generators only fetch them
+        workers, use_multiprocessing = 1, False
+    elif streaming is True:
+        train_sampler = astroNN.NN.train_tools.H5StreamSampler(h5data, rows[:num_train], y[:num_train], batch_size,
+                                                               spec_meanstd=spec_meanstd, mu_std=mu_std)
+        cv_sampler = astroNN.NN.train_tools.H5StreamSampler(h5data, rows[num_train:], y[num_train:], batch_size,
+                                                            spec_meanstd=spec_meanstd, mu_std=mu_std, shuffle=False)
+        train_data, cv_data = train_sampler.generate(), cv_sampler.generate()
+        train_steps, cv_steps = train_sampler.steps, cv_sampler.steps
+        # Batches come from the background threads of the samplers, not from the workers of fit_generator
+        workers, use_multiprocessing = 1, False
+    elif workers > 1 or use_multiprocessing is True:
+        # Workers read their batches from the h5 file, the spectra are never loaded in memory
+        train_data = astroNN.NN.train_tools.H5Sequence(h5data, rows[:num_train], y[:num_train], batch_size,
+                                                       spec_meanstd=spec_meanstd, mu_std=mu_std)
+        cv_data = astroNN.NN.train_tools.H5Sequence(h5data, rows[num_train:], y[num_train:], batch_size,
+                                                    spec_meanstd=spec_meanstd, mu_std=mu_std, shuffle=False)
+        train_steps, cv_steps = len(train_data), len(cv_data)
+    else:
+        train_sampler = astroNN.NN.train_tools.EpochSampler(spectra, y, batch_size, indx=0, num_objects=num_train,
+                                                            mu_std=mu_std, queue_size=max_queue_size)
+        cv_sampler = astroNN.NN.train_tools.EpochSampler(spectra, y, batch_size, indx=num_train, num_objects=num_cv,
+                                                         mu_std=mu_std, shuffle=False, queue_size=max_queue_size)
+        train_data, cv_data = train_sampler.generate(), cv_sampler.generate()
+        train_steps, cv_steps = train_sampler.steps, cv_sampler.steps
+
+    model.fit_generator(train_data,
+                        steps_per_epoch=train_steps,
                         epochs=max_epochs,
-                        validation_data=astroNN.NN.train_tools.generate_cv_batch(num_cv, batch_size, num_train, mu_std,
-                                                                                 spectra, y),
-                        max_queue_size=10, verbose=2, callbacks=[early_stopping, reduce_lr, csv_logger],
-                        validation_steps=num_cv / batch_size)
+                        validation_data=cv_data,
+                        max_queue_size=max_queue_size, verbose=2, callbacks=[early_stopping, reduce_lr, csv_logger],
+                        validation_steps=cv_steps, workers=workers, use_multiprocessing=use_multiprocessing)
+    if streaming is True and tf_data is not True:
+        train_sampler.close()
+        cv_sampler.close()
 
     astronn_model = 'model_{}{:02d}_run{:03d}.h5'.format(now.month, now.day, runno)
     model.save(fullfilepath + astronn_model)
@@ -283,7 +340,8 @@ def apogee_train(h5name=None, target=None, test=True, model=None, num_hidden=Non
 def gaia_train(h5name=None, test=True, model=None, num_hidden=None, num_filters=None,activation=None, initializer=None,
                filter_length=None, pool_length=None, batch_size=None, max_epochs=None, lr=None,
                early_stopping_min_delta=None, early_stopping_patience=None,reuce_lr_epsilon=None,
-               reduce_lr_patience=None, reduce_lr_min=None, cnn_visualization=True, cnn_vis_num=None):
+               reduce_lr_patience=None, reduce_lr_min=None, cnn_visualization=True, cnn_vis_num=None, workers=1,
+               use_multiprocessing=False, streaming=False, tf_data=False, tf_data_cache=True):
     """
     NAME: gaia_train
     PURPOSE: To train
@@ -308,6 +366,14 @@ def gaia_train(h5name=None, test=True, model=None, num_hidden=None, num_filters=
         cnn_visualization: whether do cnn visualization or not after training
         cnn_vis_num: number of spectra for cnn visualization!!Only has effect if and only if cnn_visualization=True!!
         test_noisy: whether of not test [train + noise + translation] data
+        workers: number of workers making batches, batches are read from the h5 file if workers>1
+        use_multiprocessing: True to make batches in processes instead of threads, batches are read from the h5 file
+        streaming: True to never load the spectra into memory, shuffled blocks of h5 chunks are read as they are
+                   needed, for datasets larger than memory (workers and use_multiprocessing are ignored)
+        tf_data: True to make batches with a tf.data pipeline in the threads of TensorFlow (workers,
+                 use_multiprocessing and streaming are ignored)
+        tf_data_cache: True to cache the spectra of the tf.data pipeline in memory, path of a file to cache them on
+                       disk, None not to cache
     OUTPUT: model
     HISTORY:
         2017-Nov-09 Henry Leung
@@ -393,16 +459,21 @@ def gaia_train(h5name=None, test=True, model=None, num_hidden=None, num_filters=
     h5data = h5name + '_train.h5'
 
     with h5py.File(h5data) as F:  # ensure the file will be cleaned up
-        spectra = np.array(F['spectra'])
+        rows = np.arange(F['spectra'].shape[0])
 
         # Dont do std, so equal 1 deliberately
         specpix_std = 1
-        specpix_mean = np.median(spectra)
-        spectra -= specpix_mean
-        spectra /= specpix_std
-        num_flux = spectra.shape[1]
-        num_train = int(0.8 * spectra.shape[0])  # number of training example, rest are cross validation
-        num_cv = spectra.shape[0] - num_train  # cross validation
+        if streaming is True or tf_data is True or workers > 1 or use_multiprocessing is True:
+            # Spectra stay on disk, their median is estimated from a random sample
+            specpix_mean = astroNN.NN.train_tools.h5_median(F['spectra'], rows)
+        else:
+            spectra = load_spectra(F)
+            specpix_mean = np.median(spectra)
+            spectra -= specpix_mean
+            spectra /= specpix_std
+        num_flux = F['spectra'].shape[1]
+        num_train = int(0.8 * rows.shape[0])  # number of training example, rest are cross validation
+        num_cv = rows.shape[0] - num_train  # cross validation
 
         # load data
         absmag = np.array(F['absmag'])
@@ -446,13 +517,56 @@ def gaia_train(h5name=None, test=True, model=None, num_hidden=None, num_filters=
 
     model.compile(optimizer=optimizer, loss=loss_function, metrics=metrics)
 
-    model.fit_generator(astroNN.NN.train_tools.generate_train_batch(num_train, batch_size, 0, mu_std, spectra, absmag),
-                        steps_per_epoch=num_train / batch_size,
+    # Batches fit_generator keeps queued, EpochSampler needs to know it so a queued batch is never overwritten
+    max_queue_size = 10
+
+    if tf_data is True:
+        # The cross validation set is cached next to the training set if cached on disk
+        cv_cache = tf_data_cache + '_cv' if isinstance(tf_data_cache, str) else tf_data_cache
+        train_sampler = astroNN.NN.train_tools.H5TFDataset(h5data, rows[:num_train], absmag[:num_train], batch_size,
+                                                           spec_meanstd=spec_meanstd, mu_std=mu_std,
+                                                           cache=tf_data_cache)
+        cv_sampler = astroNN.NN.train_tools.H5TFDataset(h5data, rows[num_train:], absmag[num_train:], batch_size,
+                                                        spec_meanstd=spec_meanstd, mu_std=mu_std, shuffle=False,
+                                                        cache=cv_cache)
+        train_data, cv_data = train_sampler.generate(), cv_sampler.generate()
+        train_steps, cv_steps = train_sampler.steps, cv_sampler.steps
+        # Batches are made by the threads of TensorFlow, the generators only fetch them
+        workers, use_multiprocessing = 1, False
+    elif streaming is True:
+        train_sampler = astroNN.NN.train_tools.H5StreamSampler(h5data, rows[:num_train], absmag[:num_train], batch_size,
+                                                               spec_meanstd=spec_meanstd, mu_std=mu_std)
+        cv_sampler = astroNN.NN.train_tools.H5StreamSampler(h5data, rows[num_train:], absmag[num_train:], batch_size,
+                                                            spec_meanstd=spec_meanstd, mu_std=mu_std, shuffle=False)
+        train_data, cv_data = train_sampler.generate(), cv_sampler.generate()
+        train_steps, cv_steps = train_sampler.steps, cv_sampler.steps
+        # Batches come from the background threads of the samplers, not from the workers of fit_generator
+        workers, use_multiprocessing = 1, False
+    elif workers > 1 or use_multiprocessing is True:
+        # Workers read their batches from the h5 file, the spectra are never loaded in memory
+        train_data = astroNN.NN.train_tools.H5Sequence(h5data, rows[:num_train], absmag[:num_train], batch_size,
+                                                       spec_meanstd=spec_meanstd, mu_std=mu_std)
+        cv_data = astroNN.NN.train_tools.H5Sequence(h5data, rows[num_train:], absmag[num_train:], batch_size,
+                                                    spec_meanstd=spec_meanstd, mu_std=mu_std, shuffle=False)
+        train_steps, cv_steps = len(train_data), len(cv_data)
+    else:
+        train_sampler = astroNN.NN.train_tools.EpochSampler(spectra, absmag, batch_size, indx=0, num_objects=num_train,
+                                                            mu_std=mu_std, queue_size=max_queue_size)
+        cv_sampler = astroNN.NN.train_tools.EpochSampler(spectra, absmag, batch_size, indx=num_train,
+                                                         num_objects=num_cv, mu_std=mu_std, shuffle=False,
+                                                         queue_size=max_queue_size)
+        train_data, cv_data = train_sampler.generate(), cv_sampler.generate()
+        train_steps, cv_steps = train_sampler.steps, cv_sampler.steps
+
+    model.fit_generator(train_data,
+                        steps_per_epoch=train_steps,
                         epochs=max_epochs,
-                        validation_data=astroNN.NN.train_tools.generate_cv_batch(num_cv, batch_size, num_train, mu_std,
-                                                                                 spectra, absmag),
-                        max_queue_size=10, verbose=2, callbacks=[early_stopping, reduce_lr, csv_logger],
-                        validation_steps=num_cv / batch_size)
+                        validation_data=cv_data,
+                        max_queue_size=max_queue_size, verbose=2, callbacks=[early_stopping, reduce_lr, csv_logger],
+                        validation_steps=cv_steps, workers=workers, use_multiprocessing=use_multiprocessing)
+    if streaming is True and tf_data is not True:
+        train_sampler.close()
+        cv_sampler.close()
 
     astronn_model = 'model_{}{:02d}_run{:03d}.h5'.format(now.month, now.day, runno)
     model.save(fullfilepath + astronn_model)
@@ -3,48 +3,500 @@
 # ---------------------------------------------------------#
 
 import os
-import random
+import queue
+import threading
 
+import h5py
 import numpy as np
-from astropy.io import fits
+from keras.utils import Sequence
 
-import astroNN.apogee.downloader
+import astroNN.apogee.catalog_cache
 
-_APOGEE_DATA = os.getenv('SDSS_LOCAL_SAS_MIRROR')
 
+class EpochSampler(object):
+    """
+    NAME: EpochSampler
+    PURPOSE: minibatches with epoch semantics for fit_generator, one permutation of a partition of the data is drawn
+             per epoch and cut into contiguous slices, so every spectrum is seen exactly once per epoch. Labels are
+             normalized once up front and each batch is gathered straight into a preallocated buffer
+    INPUT:
+        spectra = spectra array
+        y = labels array
+        batch_size = number of spectra in a batch, the last batch of an epoch has the rest
+        indx = first row of the partition, i.e. num_train for the cross validation set
+        num_objects = number of rows in the partition, None for all rows from indx to the end
+        mu_std = [mean, std] of the labels to normalize them with, None to keep the labels as they are
+        shuffle = True to draw a new permutation each epoch, False to go through the partition in order
+        queue_size = max_queue_size of fit_generator, sets how many buffers are needed so a queued batch is never
+                     overwritten before it is used
+    HISTORY:
+        2017-Nov-26 Henry Leung
+    """
+    def __init__(self, spectra, y, batch_size, indx=0, num_objects=None, mu_std=None, shuffle=True, queue_size=10):
+        self.spectra = spectra
+        self.indx = indx
+        self.num_objects = spectra.shape[0] - indx if num_objects is None else num_objects
+        self.batch_size = min(batch_size, self.num_objects)
+        self.shuffle = shuffle
+        self.steps = int(np.ceil(self.num_objects / self.batch_size))
+
+        if mu_std is None:
+            self.y = y
+        else:
+            self.y = (np.asarray(y, dtype=np.float64) - mu_std[0]) / mu_std[1]
+
+        # fit_generator keeps up to queue_size batches in its queue, plus the one in training and the one being made.
+        # The queue runs on across epochs, so this does not depend on the number of steps in an epoch
+        num_buffers = queue_size + 2
+        self._x_buffers = [np.empty((self.batch_size, spectra.shape[1], 1), dtype=spectra.dtype)
+                           for _ in range(num_buffers)]
+        self._y_buffers = [np.empty((self.batch_size,) + self.y.shape[1:], dtype=self.y.dtype)
+                           for _ in range(num_buffers)]
+        self._counter = 0
+
+    def __len__(self):
+        return self.steps
+
+    def epoch(self):
+        """
+        NAME: epoch
+        PURPOSE: rows of the data in the order of one epoch
+        INPUT:
+        OUTPUT: array of rows
+        HISTORY:
+            2017-Nov-26 Henry Leung
+        """
+        if self.shuffle is True:
+            return self.indx + np.random.permutation(self.num_objects)
+        return np.arange(self.indx, self.indx + self.num_objects)
+
+    def batch(self, indices):
+        """
+        NAME: batch
+        PURPOSE: gather spectra and normalized labels of rows into the next buffer
+        INPUT:
+            indices = array of rows, at most batch_size of them
+        OUTPUT: (spectra of shape (len(indices), number of pixels, 1), labels)
+        HISTORY:
+            2017-Nov-26 Henry Leung
+        """
+        # Sorted rows read the spectra array in order
+        indices = np.sort(indices)
+        length = indices.shape[0]
+        x = self._x_buffers[self._counter]
+        y = self._y_buffers[self._counter]
+        self._counter = (self._counter + 1) % len(self._x_buffers)
+        np.take(self.spectra, indices, axis=0, out=x[:length, :, 0])
+        np.take(self.y, indices, axis=0, out=y[:length])
+        return x[:length], y[:length]
+
+    def generate(self):
+        """
+        NAME: generate
+        PURPOSE: endless generator of (spectra, labels) batches for fit_generator, steps batches make one epoch
+        INPUT:
+        OUTPUT: generator
+        HISTORY:
+            2017-Nov-26 Henry Leung
+        """
+        while True:
+            order = self.epoch()
+            for start in range(0, self.num_objects, self.batch_size):
+                yield self.batch(order[start:start + self.batch_size])
+
+
+class H5Sequence(Sequence):
+    """
+    NAME: H5Sequence
+    PURPOSE: keras Sequence of minibatches read straight from a compiled h5 file, so fit_generator can make batches in
+             several worker threads or processes (workers>1, use_multiprocessing=True) while the model trains. Every
+             process opens the h5 file itself the first time it needs a batch, h5py handles are never shared
+    INPUT:
+        h5data = path of the compiled h5 file
+        rows = rows of the h5 file in this set in increasing order, i.e. the training part of the rows without -9999
+        y = labels of those rows, None if the targets are read from the y_name dataset
+        batch_size = number of spectra in a batch, the last batch of an epoch has the rest
+        spec_meanstd = [mean, std] to normalize the spectra with
+        mu_std = [mean, std] of the labels to normalize them with, None to keep the labels as they are
+        shuffle = True to draw a new permutation at the end of each epoch, False to go through the rows in order
+        name = name of the spectra dataset
+        y_name = name of a dataset to read the targets from instead of y, i.e. 'spectrabestfit' for generative models
+        y_meanstd = [mean, std] to normalize the targets of y_name with
+        labels_as_input = True to feed the labels to the model and train it to output the spectra, for generator models
+    HISTORY:
+        2017-Nov-27 Henry Leung
+    """
+    def __init__(self, h5data, rows, y, batch_size, spec_meanstd=(0., 1.), mu_std=None, shuffle=True,
+                 name='spectra', y_name=None, y_meanstd=(0., 1.), labels_as_input=False):
+        self.h5data = h5data
+        self.rows = np.asarray(rows)
+        self.batch_size = min(batch_size, self.rows.shape[0])
+        self.spec_meanstd = np.ravel(spec_meanstd)
+        self.shuffle = shuffle
+        self.name = name
+        self.y_name = y_name
+        self.y_meanstd = np.ravel(y_meanstd)
+        self.labels_as_input = labels_as_input
+        if y is None or mu_std is None:
+            self.y = None if y is None else np.asarray(y)
+        else:
+            self.y = (np.asarray(y, dtype=np.float64) - mu_std[0]) / mu_std[1]
+        self._h5f = None
+        self._pid = None
+        self.order = np.arange(self.rows.shape[0])
+        self.on_epoch_end()
+
+    def _dataset(self, name=None):
+        # Opened lazily in each process, a forked worker must not use the handle of its parent
+        if self._h5f is None or self._pid != os.getpid():
+            self._h5f = h5py.File(self.h5data, 'r')
+            self._pid = os.getpid()
+        return self._h5f[self.name if name is None else name]
+
+    def _read(self, name, positions, meanstd):
+        dataset = self._dataset(name)
+        data = np.asarray(dataset[self.rows[positions]], dtype=np.promote_types(dataset.dtype, np.float32))
+        data -= meanstd[0]
+        data /= meanstd[1]
+        return data
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_h5f'] = None
+        state['_pid'] = None
+        return state
+
+    def __len__(self):
+        return int(np.ceil(self.rows.shape[0] / self.batch_size))
+
+    def __getitem__(self, idx):
+        # h5py reads rows in increasing order only, sorting also makes the read sequential
+        positions = np.sort(self.order[idx * self.batch_size:(idx + 1) * self.batch_size])
+        spectra = self._read(self.name, positions, self.spec_meanstd)
+        if self.y_name is not None:
+            y = self._read(self.y_name, positions, self.y_meanstd)
+        else:
+            y = self.y[positions]
+        if self.labels_as_input is True:
+            return y.reshape(y.shape[0], y.shape[1], 1), spectra
+        return spectra.reshape(spectra.shape[0], spectra.shape[1], 1), y
+
+    def on_epoch_end(self):
+        if self.shuffle is True:
+            self.order = np.random.permutation(self.rows.shape[0])
+
+
+def h5_median(dataset, rows, num_sample=4096):
+    """
+    NAME: h5_median
+    PURPOSE: median of a h5 dataset estimated from a random sample of its rows, so it is never read whole
+    INPUT:
+        dataset = h5py dataset, i.e. F['spectra']
+        rows = rows of the dataset to sample from
+        num_sample = number of rows in the sample, all rows are read if there are not more than that
+    OUTPUT: median
+    HISTORY:
+        2017-Nov-27 Henry Leung
+    """
+    rows = np.asarray(rows)
+    if rows.shape[0] > num_sample:
+        rows = np.sort(np.random.choice(rows, num_sample, replace=False))
+    return np.median(dataset[rows])
+
+
+class H5StreamSampler(object):
+    """
+    NAME: H5StreamSampler
+    PURPOSE: out-of-core minibatches for fit_generator, spectra are read from the h5 file as they are needed instead
+             of being loaded into memory. Each epoch the h5 chunks are shuffled and read a window of chunks at a time,
+             every chunk with a single contiguous read, then the rows of the window are shuffled and cut into batches.
+             Batches are normalized and made by a background thread into a bounded queue, so memory use does not
+             depend on the size of the dataset
+    INPUT:
+        h5data = path of the compiled h5 file
+        rows = rows of the h5 file in this set in increasing order, i.e. the training part of the rows without -9999
+        y = labels of those rows
+        batch_size = number of spectra in a batch, the last batch of an epoch has the rest
+        spec_meanstd = [mean, std] to normalize the spectra with
+        mu_std = [mean, std] of the labels to normalize them with, None to keep the labels as they are
+        shuffle = True to shuffle each epoch, False to go through the rows in order
+        name = name of the spectra dataset
+        window = number of h5 chunks shuffled together, a larger window shuffles better and uses more memory
+        prefetch = number of batches made ahead of the training
+    HISTORY:
+        2017-Nov-27 Henry Leung
+    """
+    def __init__(self, h5data, rows, y, batch_size, spec_meanstd=(0., 1.), mu_std=None, shuffle=True, name='spectra',
+                 window=16, prefetch=8):
+        self.h5data = h5data
+        self.rows = np.asarray(rows)
+        self.num_objects = self.rows.shape[0]
+        self.batch_size = min(batch_size, self.num_objects)
+        self.steps = int(np.ceil(self.num_objects / self.batch_size))
+        self.spec_meanstd = np.ravel(spec_meanstd)
+        self.shuffle = shuffle
+        self.name = name
+        self.window = window
+        self.prefetch = prefetch
+        if mu_std is None:
+            self.y = np.asarray(y)
+        else:
+            self.y = (np.asarray(y, dtype=np.float64) - mu_std[0]) / mu_std[1]
+
+        with h5py.File(h5data, 'r') as F:
+            chunks = F[name].chunks
+            # Files written without chunks are read in blocks of the size of a batch
+            self.chunk_rows = chunks[0] if chunks is not None else self.batch_size
+        # Boundaries of the rows in each h5 chunk, rows are in increasing order so each chunk is a contiguous slice
+        self._bounds = np.append(np.unique(self.rows // self.chunk_rows, return_index=True)[1], self.num_objects)
+        self._queue = queue.Queue(maxsize=prefetch)
+        self._stop = threading.Event()
+        self._thread = None
 
-def load_batch(num_train, batch_size, indx, mu_std, spectra, y):
-    # Generate list of random indices (within the relevant partition of the main data file, e.g. the
-    # training set) to be used to index into data_file
-    indices = random.sample(range(indx, indx + num_train), batch_size)
-    indices = np.sort(indices)
+    def __len__(self):
+        return self.steps
 
-    mean_labels = mu_std[0]
-    std_labels = mu_std[1]
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
 
-    # load data
-    spectra = spectra[indices, :]
-    y = y[:][indices]
+    def _batch(self, spectra, positions):
+        spectra = np.asarray(spectra, dtype=np.promote_types(spectra.dtype, np.float32))
+        spectra -= self.spec_meanstd[0]
+        spectra /= self.spec_meanstd[1]
+        return spectra.reshape(spectra.shape[0], spectra.shape[1], 1), self.y[positions]
 
-    # Normalize labels
-    normed_y = (y - mean_labels) / std_labels
+    def _produce(self):
+        try:
+            with h5py.File(self.h5data, 'r') as F:
+                dataset = F[self.name]
+                num_chunks = self._bounds.shape[0] - 1
+                while not self._stop.is_set():
+                    order = np.random.permutation(num_chunks) if self.shuffle is True else np.arange(num_chunks)
+                    left_spectra, left_positions = None, np.zeros(0, dtype=np.int64)
+                    for start in range(0, num_chunks, self.window):
+                        blocks, positions = [], []
+                        # Chunks of a window are read in the order they are in the file
+                        for chunk in np.sort(order[start:start + self.window]):
+                            first, last = self._bounds[chunk], self._bounds[chunk + 1]
+                            rows = self.rows[first:last]
+                            blocks.append(dataset[rows[0]:rows[-1] + 1][rows - rows[0]])
+                            positions.append(np.arange(first, last))
+                        spectra, positions = np.concatenate(blocks), np.concatenate(positions)
+                        if self.shuffle is True:
+                            permutation = np.random.permutation(positions.shape[0])
+                            spectra, positions = spectra[permutation], positions[permutation]
+                        # Rows left over from the previous window go first so no batch mixes epochs
+                        if left_spectra is not None:
+                            spectra = np.concatenate((left_spectra, spectra))
+                            positions = np.concatenate((left_positions, positions))
+                        full = positions.shape[0] - positions.shape[0] % self.batch_size
+                        for batch in range(0, full, self.batch_size):
+                            if not self._put(self._batch(spectra[batch:batch + self.batch_size],
+                                                         positions[batch:batch + self.batch_size])):
+                                return
+                        left_spectra, left_positions = spectra[full:], positions[full:]
+                    if left_positions.shape[0] > 0:
+                        if not self._put(self._batch(left_spectra, left_positions)):
+                            return
+        except Exception as e:
+            # Hand the error to the training thread instead of letting it wait forever
+            self._put(e)
 
-    # Reshape X data for compatibility with CNN
-    spectra = spectra.reshape(len(spectra), spectra.shape[1], 1)
+    def generate(self):
+        """
+        NAME: generate
+        PURPOSE: endless generator of (spectra, labels) batches for fit_generator, steps batches make one epoch
+        INPUT:
+        OUTPUT: generator
+        HISTORY:
+            2017-Nov-27 Henry Leung
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._produce, daemon=True)
+            self._thread.start()
+        while True:
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                raise item
+            yield item
 
-    return spectra, normed_y
+    def close(self):
+        """
+        NAME: close
+        PURPOSE: stop the background thread
+        INPUT:
+        OUTPUT: None
+        HISTORY:
+            2017-Nov-27 Henry Leung
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        return None
+
+
+def _autotune():
+    # tf.data.experimental.AUTOTUNE in recent TensorFlow, tf.contrib.data.AUTOTUNE in 1.8 to 1.12, None before.
+    # tf.contrib is gone in TensorFlow 2 and is only looked at if the module has it
+    import tensorflow as tf
+    experimental = getattr(tf.data, 'experimental', None)
+    if experimental is not None and hasattr(experimental, 'AUTOTUNE'):
+        return experimental.AUTOTUNE
+    contrib = getattr(tf, 'contrib', None)
+    if contrib is not None:
+        return getattr(getattr(contrib, 'data', None), 'AUTOTUNE', None)
+    return None
+
+
+def _initializable_iterator(dataset):
+    # Dataset.make_initializable_iterator from TensorFlow 1.4, tf.compat.v1.data.make_initializable_iterator from
+    # 1.13 on and the only one left in TensorFlow 2
+    import tensorflow as tf
+    compat = getattr(getattr(tf, 'compat', None), 'v1', None)
+    if compat is not None and hasattr(compat.data, 'make_initializable_iterator'):
+        return compat.data.make_initializable_iterator(dataset)
+    if hasattr(dataset, 'make_initializable_iterator'):
+        return dataset.make_initializable_iterator()
+    raise ImportError('H5TFDataset needs tf.data with initializable iterators, TensorFlow 1.4 or newer')
+
+
+class H5TFDataset(object):
+    """
+    NAME: H5TFDataset
+    PURPOSE: tf.data input pipeline of minibatches from a compiled h5 file, input processing runs in the threads of
+             TensorFlow instead of Python. Spectra are read in h5 chunks in file order, cached in memory or on disk
+             after the first epoch, shuffled, batched, then normalized by a parallel map and prefetched with autotuning
+    INPUT:
+        h5data = path of the compiled h5 file
+        rows = rows of the h5 file in this set in increasing order, i.e. the training part of the rows without -9999
+        y = labels of those rows
+        batch_size = number of spectra in a batch, the last batch of an epoch has the rest
+        spec_meanstd = [mean, std] to normalize the spectra with
+        mu_std = [mean, std] of the labels to normalize them with, None to keep the labels as they are
+        shuffle = True to shuffle each epoch, False to go through the rows in order
+        cache = True to cache the spectra in memory, path of a file to cache them on disk, None not to cache
+        name = name of the spectra dataset
+        shuffle_buffer = number of spectra in the shuffle buffer, None for all of them
+        num_parallel_calls = number of batches normalized in parallel, None to autotune
+    HISTORY:
+        2017-Nov-27 Henry Leung
+    """
+    def __init__(self, h5data, rows, y, batch_size, spec_meanstd=(0., 1.), mu_std=None, shuffle=True, cache=True,
+                 name='spectra', shuffle_buffer=None, num_parallel_calls=None):
+        self.h5data = h5data
+        self.rows = np.asarray(rows)
+        self.num_objects = self.rows.shape[0]
+        self.batch_size = min(batch_size, self.num_objects)
+        self.steps = int(np.ceil(self.num_objects / self.batch_size))
+        self.name = name
+        if mu_std is None:
+            self.y = np.asarray(y)
+        else:
+            self.y = (np.asarray(y, dtype=np.float64) - mu_std[0]) / mu_std[1]
+
+        with h5py.File(h5data, 'r') as F:
+            dtype = F[name].dtype
+            num_flux = F[name].shape[1]
+            chunks = F[name].chunks
+            self.chunk_rows = chunks[0] if chunks is not None else self.batch_size
+        self._bounds = np.append(np.unique(self.rows // self.chunk_rows, return_index=True)[1], self.num_objects)
+        self.dtype = dtype
+        self.num_flux = num_flux
+        self.spec_meanstd = np.ravel(spec_meanstd)
+        self.shuffle = shuffle
+        self.cache = cache
+        self.shuffle_buffer = self.num_objects if shuffle_buffer is None else shuffle_buffer
+        self.num_parallel_calls = num_parallel_calls
+
+    def __len__(self):
+        return self.steps
+
+    def _blocks(self):
+        # One contiguous read for each h5 chunk, in the order they are in the file
+        with h5py.File(self.h5data, 'r') as F:
+            dataset = F[self.name]
+            for chunk in range(self._bounds.shape[0] - 1):
+                first, last = self._bounds[chunk], self._bounds[chunk + 1]
+                rows = self.rows[first:last]
+                yield dataset[rows[0]:rows[-1] + 1][rows - rows[0]], self.y[first:last]
+
+    def build(self):
+        """
+        NAME: build
+        PURPOSE: build the pipeline in the default graph
+        INPUT:
+        OUTPUT: tf.data.Dataset of (spectra, labels) batches, repeated endlessly
+        HISTORY:
+            2017-Nov-27 Henry Leung
+        """
+        import tensorflow as tf
+
+        autotune = _autotune()
+        num_parallel_calls = self.num_parallel_calls
+        if num_parallel_calls is None:
+            num_parallel_calls = autotune if autotune is not None else os.cpu_count()
+        spec_mean, spec_std = float(self.spec_meanstd[0]), float(self.spec_meanstd[1])
+
+        def normalize(spectra, labels):
+            spectra = (tf.cast(spectra, tf.float32) - spec_mean) / spec_std
+            return tf.expand_dims(spectra, -1), labels
+
+        # Spectra are cached with the dtype of the h5 file and only promoted to float32 by the parallel map
+        dataset = tf.data.Dataset.from_generator(self._blocks, (tf.as_dtype(self.dtype), tf.as_dtype(self.y.dtype)),
+                                                 (tf.TensorShape([None, self.num_flux]),
+                                                  tf.TensorShape([None]).concatenate(self.y.shape[1:])))
+        dataset = dataset.flat_map(lambda spectra, labels: tf.data.Dataset.from_tensor_slices((spectra, labels)))
+        if self.cache is not None:
+            dataset = dataset.cache('' if self.cache is True else self.cache)
+        if self.shuffle is True:
+            dataset = dataset.shuffle(self.shuffle_buffer)
+        # Batched before repeat, so the last batch of an epoch has the rest and never mixes two epochs
+        dataset = dataset.batch(self.batch_size)
+        dataset = dataset.map(normalize, num_parallel_calls=num_parallel_calls)
+        dataset = dataset.repeat()
+        return dataset.prefetch(autotune if autotune is not None else 2)
+
+    def generate(self):
+        """
+        NAME: generate
+        PURPOSE: endless generator of (spectra, labels) batches for fit_generator, fetched from the pipeline with the
+                 session of keras, steps batches make one epoch
+        INPUT:
+        OUTPUT: generator
+        HISTORY:
+            2017-Nov-27 Henry Leung
+        """
+        from keras.backend import get_session
+
+        # fit_generator of standalone keras only takes numpy batches, so a batch is fetched with session.run. The
+        # pipeline is added to the graph of the session right away, not later in the thread of fit_generator
+        session = get_session()
+        with session.graph.as_default():
+            iterator = _initializable_iterator(self.build())
+            next_batch = iterator.get_next()
+        session.run(iterator.initializer)
+
+        def generator():
+            while True:
+                yield session.run(next_batch)
+
+        return generator()
 
 
 def generate_train_batch(num_objects, batch_size, indx, mu_std, spectra, y):
-    while True:
-        x_batch, y_batch = load_batch(num_objects, batch_size, indx, mu_std, spectra, y)
-        yield (x_batch, y_batch)
+    return EpochSampler(spectra, y, batch_size, indx=indx, num_objects=num_objects, mu_std=mu_std).generate()
 
 
 def generate_cv_batch(num_objects, batch_size, indx, mu_std, spectra, y):
-    while True:
-        x_batch, y_batch = load_batch(num_objects, batch_size, indx, mu_std, spectra, y)
-        yield (x_batch, y_batch)
+    return EpochSampler(spectra, y, batch_size, indx=indx, num_objects=num_objects, mu_std=mu_std,
+                        shuffle=False).generate()
 
 
 def apogee_id_fetch(relative_index=None, dr=None):
@@ -52,7 +504,6 @@ def apogee_id_fetch(relative_index=None, dr=None):
     NAME: apogee_id_fetch
     PURPOSE: fetch apogee id from fits
     INPUT:
-        relative_index in h5 file generated from h5_compiler
         relative_index in h5 file generated from h5_compiler
         dr = 13 or 14
     OUTPUT: real apogee_id
@@ -62,24 +513,28 @@ def apogee_id_fetch(relative_index=None, dr=None):
     if dr is None:
         dr = 14
         print('dr is not provided, using default dr=14')
-    if dr == 13:
-        allstarepath = os.path.join(_APOGEE_DATA, 'dr13/apogee/spectro/redux/r6/stars/l30e/l30e.2/allStar-l30e.2.fits')
-        # Check if directory exists
-        if not os.path.exists(allstarepath):
-            astroNN.apogee.downloader.allstar(dr=13)
-        hdulist = fits.open(allstarepath)
-        apogee_id = hdulist[1].data['APOGEE_ID'][relative_index]
-        apogee_id = np.array(apogee_id)
-        return apogee_id
-    if dr == 14:
-        allstarepath = os.path.join(_APOGEE_DATA, 'dr14/apogee/spectro/redux/r8/stars/l31c/l31c.2/allStar-l31c.2.fits')
-        # Check if directory exists
-        if not os.path.exists(allstarepath):
-            astroNN.apogee.downloader.allstar(dr=14)
-        hdulist = fits.open(allstarepath)
-        apogee_id = hdulist[1].data['APOGEE_ID'][relative_index]
-        apogee_id = np.array(apogee_id)
-        return apogee_id
+    if dr == 13 or dr == 14:
+        return astroNN.apogee.catalog_cache.apogee_id_index(dr=dr).to_id(relative_index)
+    else:
+        raise ValueError('Only DR13/DR14 supported')
+
+
+def apogee_row_fetch(apogee_id=None, dr=None):
+    """
+    NAME: apogee_row_fetch
+    PURPOSE: fetch the row in allStar of apogee id, the inverse of apogee_id_fetch
+    INPUT:
+        apogee_id = apogee id or array of apogee id
+        dr = 13 or 14
+    OUTPUT: array of rows in allStar, -1 for apogee id not found
+    HISTORY:
+        2017-Nov-21 Henry Leung
+    """
+    if dr is None:
+        dr = 14
+        print('dr is not provided, using default dr=14')
+    if dr == 13 or dr == 14:
+        return astroNN.apogee.catalog_cache.apogee_id_index(dr=dr).to_row(apogee_id)
     else:
         raise ValueError('Only DR13/DR14 supported')
 
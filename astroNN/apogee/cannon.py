@@ -6,11 +6,10 @@ import os
 
 import numpy as np
 import pylab as plt
-from astropy.io import fits
 from astropy.stats import mad_std
 
 import astroNN.NN.test
-import astroNN.apogee.downloader
+import astroNN.apogee.catalog_cache
 import astroNN.datasets.h5_compiler
 
 
@@ -29,11 +28,10 @@ def cannon_plot(apogee_indexlist, std_labels, target, folder_name=None, aspcap_a
     HISTORY:
         2017-Oct-27 Henry Leung
     """
-    cannon_fullfilename = astroNN.apogee.downloader.allstarcannon(dr=14)
+    cannon_data = astroNN.apogee.catalog_cache.allstarcannon_columns(dr=14)
     cannonplot_fullpath = os.path.join(folder_name, 'Cannon_Plots/')
     if not os.path.exists(cannonplot_fullpath):
         os.makedirs(cannonplot_fullpath)
-    hdulist = fits.open(cannon_fullfilename)
     print('Plotting Cannon with test set spectra for comparison')
 
     x_lab = 'ASPCAP'
@@ -44,7 +42,7 @@ def cannon_plot(apogee_indexlist, std_labels, target, folder_name=None, aspcap_a
     for i in range(num_labels):
         tg = astroNN.NN.test.target_to_aspcap_conversion(target[i])
         try:
-            cannon_result = (hdulist[1].data['{}'.format(tg)])[apogee_indexlist]
+            cannon_result = (cannon_data['{}'.format(tg)])[apogee_indexlist]
             resid = cannon_result - aspcap_answer[:, i]
             madstd = mad_std(resid)
             mean = np.median(resid)
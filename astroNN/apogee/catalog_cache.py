@@ -0,0 +1,214 @@
+# ---------------------------------------------------------#
+#   astroNN.apogee.catalog_cache: memory-mapped column cache of catalogs
+# ---------------------------------------------------------#
+
+import os
+import tempfile
+
+import numpy as np
+from astropy.io import fits
+
+import astroNN.apogee.downloader
+from astroNN.apogee.apogee_shared import apogee_default_dr
+
+# ID indices already loaded in this process, keyed by data release
+_ID_INDEX = {}
+
+
+def _save_npy(path, array):
+    # Write to a temporary file of this writer only, then rename, so an interrupted conversion never leaves a broken
+    # cache and processes converting the same column at the same time never write into each other's file
+    fd, temppath = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, array)
+        # mkstemp makes the file readable by its owner only, the cache is shared like the catalog next to it
+        os.chmod(temppath, 0o644)
+        os.replace(temppath, path)
+    except BaseException:
+        os.remove(temppath)
+        raise
+    return None
+
+
+class ColumnCache(object):
+    """
+    NAME: ColumnCache
+    PURPOSE: dictionary-like access to columns of a FITS table, each column is converted to a .npy file next to the
+             FITS file on first use and memory-mapped afterward, so later access takes milliseconds and almost no memory
+    INPUT:
+        fitspath = full path of the FITS file
+        columns = list of columns to convert at once in advance, saves opening the FITS file for every column
+        hdu = index of the HDU of the table
+    HISTORY:
+        2017-Nov-20 Henry Leung
+    """
+    def __init__(self, fitspath, columns=None, hdu=1):
+        self.fitspath = fitspath
+        self.hdu = hdu
+        filename = os.path.splitext(os.path.basename(fitspath))[0]
+        self.cachedir = os.path.join(os.path.dirname(fitspath), 'astroNN_cache', filename)
+        if not os.path.exists(self.cachedir):
+            os.makedirs(self.cachedir)
+        header = fits.getheader(fitspath, hdu)
+        # FITS column names are case insensitive, same as astropy
+        self.names = [header['TTYPE{}'.format(i)] for i in range(1, header['TFIELDS'] + 1)]
+        self._upper_names = {name.upper(): name for name in self.names}
+        self._length = header['NAXIS2']
+        self._columns = {}
+        if columns is not None:
+            self.preload(columns)
+
+    def _resolve(self, name):
+        try:
+            return self._upper_names[name.upper()]
+        except KeyError:
+            raise KeyError("Key '{}' does not exist in {}".format(name, self.fitspath))
+
+    def _cachepath(self, name):
+        return os.path.join(self.cachedir, '{}.npy'.format(name))
+
+    def _is_fresh(self, name):
+        path = self._cachepath(name)
+        return os.path.isfile(path) and os.path.getmtime(path) >= os.path.getmtime(self.fitspath)
+
+    def preload(self, columns):
+        """
+        NAME: preload
+        PURPOSE: convert all columns not cached yet with a single pass over the FITS file
+        INPUT:
+            columns = list of column names
+        OUTPUT: None
+        HISTORY:
+            2017-Nov-20 Henry Leung
+        """
+        columns = [self._resolve(name) for name in columns]
+        stale = [name for name in columns if not self._is_fresh(name)]
+        if stale:
+            with fits.open(self.fitspath, memmap=True) as hdulist:
+                for name in stale:
+                    column = np.asarray(hdulist[self.hdu].data[name])
+                    if column.dtype.byteorder not in ('=', '|'):
+                        column = column.astype(column.dtype.newbyteorder('='))
+                    _save_npy(self._cachepath(name), column)
+        return None
+
+    def __getitem__(self, name):
+        name = self._resolve(name)
+        if name not in self._columns:
+            self.preload([name])
+            self._columns[name] = np.load(self._cachepath(name), mmap_mode='r')
+        return self._columns[name]
+
+    def __contains__(self, name):
+        return name.upper() in self._upper_names
+
+    def __len__(self):
+        return self._length
+
+
+class IDIndex(object):
+    """
+    NAME: IDIndex
+    PURPOSE: two-way lookup between row and ID of a catalog, the sorting permutation of the ID column is stored next to
+             the column cache so ID to row is a binary search without parsing the catalog again
+    INPUT:
+        cache = ColumnCache of the catalog
+        column = name of the ID column
+    HISTORY:
+        2017-Nov-21 Henry Leung
+    """
+    def __init__(self, cache, column='APOGEE_ID'):
+        self.ids = cache[column]
+        column = cache._resolve(column)
+        sorterpath = cache._cachepath('{}_argsort'.format(column))
+        if not (os.path.isfile(sorterpath) and
+                os.path.getmtime(sorterpath) >= os.path.getmtime(cache._cachepath(column))):
+            _save_npy(sorterpath, np.argsort(self.ids, kind='mergesort').astype(np.int64))
+        self.sorter = np.load(sorterpath, mmap_mode='r')
+        self.sorted_ids = np.asarray(self.ids)[self.sorter]
+
+    def _as_ids(self, ids):
+        ids = np.atleast_1d(np.asarray(ids))
+        # IDs read from h5 files are bytes while the cached column is unicode, or the other way around
+        if ids.dtype.kind != self.ids.dtype.kind:
+            if ids.dtype.kind == 'S':
+                ids = np.char.decode(ids, 'ascii')
+            else:
+                ids = np.char.encode(ids.astype(str), 'ascii')
+        return np.char.strip(ids)
+
+    def to_id(self, rows):
+        """
+        NAME: to_id
+        PURPOSE: IDs of rows
+        INPUT:
+            rows = row or array of rows
+        OUTPUT: array of IDs
+        HISTORY:
+            2017-Nov-21 Henry Leung
+        """
+        return np.asarray(self.ids[rows])
+
+    def to_row(self, ids):
+        """
+        NAME: to_row
+        PURPOSE: rows of IDs, the first row is returned for duplicated IDs
+        INPUT:
+            ids = ID or array of IDs
+        OUTPUT: array of rows, -1 for IDs not in the catalog
+        HISTORY:
+            2017-Nov-21 Henry Leung
+        """
+        ids = self._as_ids(ids)
+        position = np.searchsorted(self.sorted_ids, ids)
+        position = np.minimum(position, self.sorted_ids.shape[0] - 1)
+        found = self.sorted_ids[position] == ids
+        return np.where(found, self.sorter[position], -1)
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+
+def apogee_id_index(dr=None):
+    """
+    NAME: apogee_id_index
+    PURPOSE: APOGEE_ID index of allStar, loaded once per process
+    INPUT:
+        dr = 13 or 14
+    OUTPUT: IDIndex of allStar
+    HISTORY:
+        2017-Nov-21 Henry Leung
+    """
+    dr = apogee_default_dr(dr=dr)
+    if dr not in _ID_INDEX:
+        _ID_INDEX[dr] = IDIndex(allstar_columns(dr=dr, columns=['APOGEE_ID']), column='APOGEE_ID')
+    return _ID_INDEX[dr]
+
+
+def allstar_columns(dr=None, columns=None):
+    """
+    NAME: allstar_columns
+    PURPOSE: memory-mapped columns of allStar, download and convert the catalog if needed
+    INPUT:
+        dr = 13 or 14
+        columns = list of columns to convert at once in advance
+    OUTPUT: ColumnCache of allStar
+    HISTORY:
+        2017-Nov-20 Henry Leung
+    """
+    return ColumnCache(astroNN.apogee.downloader.allstar(dr=dr), columns=columns)
+
+
+def allstarcannon_columns(dr=None, columns=None):
+    """
+    NAME: allstarcannon_columns
+    PURPOSE: memory-mapped columns of allStarCannon, download and convert the catalog if needed
+    INPUT:
+        dr = 14
+        columns = list of columns to convert at once in advance
+    OUTPUT: ColumnCache of allStarCannon
+    HISTORY:
+        2017-Nov-20 Henry Leung
+    """
+    return ColumnCache(astroNN.apogee.downloader.allstarcannon(dr=dr), columns=columns)
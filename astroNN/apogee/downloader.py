@@ -3,17 +3,36 @@
 # ---------------------------------------------------------#
 
 import os
-import urllib.request
+import threading
 
+import numpy as np
 from astropy.io import fits
+from tqdm import tqdm
 
-from astroNN.shared.downloader_tools import TqdmUpTo
+from astroNN.shared.downloader_tools import TqdmUpTo, fetch, urlretrieve
+from astroNN.shared.inventory import mirror_inventory, mirror_quota, record_download
 from astroNN.apogee.apogee_shared import apogee_env, apogee_default_dr
 
 currentdir = os.getcwd()
 
 _APOGEE_DATA = apogee_env()
 
+_SAS_URL = 'https://data.sdss.org/sas/'
+
+# Spectra on SAS as (directory relative to SAS root, filename with a placeholder for apogee id) for each kind and dr
+_SPECTRA_PATHS = {('combined', 13): ('dr13/apogee/spectro/redux/r6/stars/l30e/l30e.2/', 'aspcapStar-r6-l30e.2-{}.fits'),
+                  ('combined', 14): ('dr14/apogee/spectro/redux/r8/stars/l31c/l31c.2/', 'aspcapStar-r8-l31c.2-{}.fits'),
+                  ('visit', 13): ('dr13/apogee/spectro/redux/r6/stars/apo25m/', 'apStar-r6-{}.fits'),
+                  ('visit', 14): ('dr14/apogee/spectro/redux/r8/stars/apo25m/', 'apStar-r8-{}.fits')}
+_SPECTRA_NAMES = {'combined': 'combined', 'visit': 'individual visit'}
+# Rough size in bytes of a single spectra file, only used to estimate downloads when no file of that kind is present yet
+_SPECTRA_TYPICAL_SIZE = {'combined': 500e3, 'visit': 5e6}
+
+
+def _record_download(fullfilenames, quota=None):
+    # Downloaded files go into the mirror inventory, then least recently used spectra are evicted if over quota
+    record_download(_APOGEE_DATA, fullfilenames, quota=quota)
+
 
 def allstar(dr=None):
     """
@@ -49,8 +68,9 @@ def allstar(dr=None):
     # Check if files exists
     if not os.path.isfile(os.path.join(fullfilepath, filename)):
         with TqdmUpTo(unit='B', unit_scale=True, miniters=1, desc=url.split('/')[-1]) as t:
-            urllib.request.urlretrieve(url, fullfilename, reporthook=t.update_to)
+            urlretrieve(url, fullfilename, reporthook=t.update_to)
             print('Downloaded DR{:d} allStar file catalog successfully to {}'.format(dr, fullfilename))
+            _record_download(fullfilename)
     else:
         print(fullfilename + ' was found!')
 
@@ -88,8 +108,9 @@ def allstarcannon(dr=None):
     # Check if files exists
     if not os.path.isfile(os.path.join(fullfilepath, filename)):
         with TqdmUpTo(unit='B', unit_scale=True, miniters=1, desc=url.split('/')[-1]) as t:
-            urllib.request.urlretrieve(url, fullfilename, reporthook=t.update_to)
+            urlretrieve(url, fullfilename, reporthook=t.update_to)
             print('Downloaded DR{:d} allStarCannon file catalog successfully to {}'.format(dr, fullfilename))
+            _record_download(fullfilename)
     else:
         print(fullfilename + ' was found')
 
@@ -129,14 +150,59 @@ def allvisit(dr=None):
 
     if not os.path.isfile(os.path.join(fullfilepath, filename)):
         with TqdmUpTo(unit='B', unit_scale=True, miniters=1, desc=url.split('/')[-1]) as t:
-            urllib.request.urlretrieve(url, fullfilename, reporthook=t.update_to)
+            urlretrieve(url, fullfilename, reporthook=t.update_to)
             print('Downloaded DR{:d} allVisit file catalog successfully to {}'.format(dr, fullfilepath))
+            _record_download(fullfilename)
     else:
         print(fullfilename + ' was found')
 
     return None
 
 
+def spectra_path(dr=None, location=None, apogee=None, kind='combined'):
+    """
+    NAME: spectra_path
+    PURPOSE: url and local path of a spectra file
+    INPUT:
+        dr = 13 or 14
+        location = location id
+        apogee = apogee id
+        kind = 'combined' (aspcapStar) or 'visit' (apStar)
+    OUTPUT: (url, full local file path)
+    HISTORY:
+        2017-Nov-21 Henry Leung
+    """
+    dr = apogee_default_dr(dr=dr)
+    if (kind, dr) not in _SPECTRA_PATHS:
+        raise ValueError('{} spectra only supports DR13 or DR14'.format(kind))
+    directory, filename = _SPECTRA_PATHS[(kind, dr)]
+    filename = filename.format(apogee)
+    url = '{}{}{}/{}'.format(_SAS_URL, directory, location, filename)
+    fullfilename = os.path.join(_APOGEE_DATA, directory, str(location), filename)
+    return url, fullfilename
+
+
+def _spectra(dr, location, apogee, kind, verbose):
+    warning_flag = None
+    urlstr, fullfilename = spectra_path(dr=dr, location=location, apogee=apogee, kind=kind)
+    inventory = mirror_inventory(_APOGEE_DATA)
+    # The inventory decides, a file it lists but which is gone is downloaded again by open_spectra() when it is read
+    if fullfilename not in inventory:
+        if not os.path.exists(os.path.dirname(fullfilename)):
+            os.makedirs(os.path.dirname(fullfilename))
+        warning_flag = fetch([(urlstr, fullfilename)], connections=1)[0]
+        if warning_flag is None:
+            _record_download(fullfilename)
+            print('Downloaded DR{} {} file successfully to {}'.format(dr, _SPECTRA_NAMES[kind], fullfilename))
+        else:
+            print('{} cannot be found on server, skipped'.format(urlstr))
+    else:
+        inventory.touch(fullfilename)
+        if verbose == 1:
+            print(fullfilename + ' was found, not downloaded again')
+    return warning_flag, fullfilename
+
+
 def combined_spectra(dr=None, location=None, apogee=None, verbose=1):
     """
     NAME: combined_spectra
@@ -146,54 +212,10 @@ def combined_spectra(dr=None, location=None, apogee=None, verbose=1):
     HISTORY:
         2017-Oct-15 Henry Leung
     """
-    warning_flag = None
-
     dr = apogee_default_dr(dr=dr)
-
-    if dr == 13:
-        str1 = 'https://data.sdss.org/sas/dr13/apogee/spectro/redux/r6/stars/l30e/l30e.2/'
-        str2 = '{}/aspcapStar-r6-l30e.2-{}.fits'.format(location, apogee)
-        filename = 'aspcapStar-r6-l30e.2-{}.fits'.format(apogee)
-        urlstr = str1 + str2
-        fullfilename = os.path.join(_APOGEE_DATA, 'dr13/apogee/spectro/redux/r6/stars/l30e/l30e.2/', str(location))
-        if not os.path.exists(fullfilename):
-            os.makedirs(fullfilename)
-        fullfilename = os.path.join(_APOGEE_DATA, 'dr13/apogee/spectro/redux/r6/stars/l30e/l30e.2/', str(location),
-                                filename)
-        if not os.path.isfile(fullfilename):
-            try:
-                urllib.request.urlretrieve(urlstr, fullfilename)
-                print('Downloaded DR13 combined file successfully to {}'.format(fullfilename))
-            except urllib.request.HTTPError:
-                print('{} cannot be found on server, skipped'.format(urlstr))
-        else:
-            print(fullfilename + ' was found, not downloaded again')
-
-    elif dr == 14:
-        str1 = 'https://data.sdss.org/sas/dr14/apogee/spectro/redux/r8/stars/l31c/l31c.2/'
-        str2 = '{}/aspcapStar-r8-l31c.2-{}.fits'.format(location, apogee)
-        filename = 'aspcapStar-r8-l31c.2-{}.fits'.format(apogee)
-        urlstr = str1 + str2
-        fullfilename = os.path.join(_APOGEE_DATA, 'dr14/apogee/spectro/redux/r8/stars/l31c/l31c.2/', str(location))
-        if not os.path.exists(fullfilename):
-            os.makedirs(fullfilename)
-        fullfilename = os.path.join(_APOGEE_DATA, 'dr14/apogee/spectro/redux/r8/stars/l31c/l31c.2/', str(location),
-                                filename)
-        if not os.path.isfile(fullfilename):
-            try:
-                urllib.request.urlretrieve(urlstr, fullfilename)
-                print('Downloaded DR14 combined file successfully to {}'.format(fullfilename))
-            except urllib.request.HTTPError:
-                print('{} cannot be found on server, skipped'.format(urlstr))
-                warning_flag = 1
-        else:
-            if verbose == 1:
-                print(fullfilename + ' was found, not downloaded again')
-
-    else:
+    if dr != 13 and dr != 14:
         raise ValueError('combined_spectra() only supports DR13 or DR14')
-
-    return warning_flag, fullfilename
+    return _spectra(dr, location, apogee, 'combined', verbose)
 
 
 def visit_spectra(dr=None, location=None, apogee=None, verbose=1):
@@ -205,49 +227,244 @@ def visit_spectra(dr=None, location=None, apogee=None, verbose=1):
     HISTORY:
         2017-Oct-11 Henry Leung
     """
-    warning_flag = None
+    dr = apogee_default_dr(dr=dr)
+    if dr != 13 and dr != 14:
+        raise ValueError('visit_spectra() only supports DR13 or DR14')
+    return _spectra(dr, location, apogee, 'visit', verbose)
+
 
+def plan_spectra(dr=None, location=None, apogee=None, kind='combined'):
+    """
+    NAME: plan_spectra
+    PURPOSE: work out which spectra files are missing in the local mirror and estimate the size of downloading them
+    INPUT:
+        dr = 13 or 14
+        location = array of location id
+        apogee = array of apogee id
+        kind = 'combined' (aspcapStar) or 'visit' (apStar)
+    OUTPUT: dictionary of 'url' and 'fullfilename' (arrays in the order of input), 'missing' (indices of the files to
+            download) and 'expected_size' (estimated bytes to download)
+    HISTORY:
+        2017-Nov-23 Henry Leung
+    """
     dr = apogee_default_dr(dr=dr)
+    location = np.atleast_1d(location)
+    apogee = np.atleast_1d(apogee)
+    if location.shape != apogee.shape:
+        raise ValueError('location and apogee must have the same shape')
+
+    paths = [spectra_path(dr=dr, location=loc, apogee=apogee_id, kind=kind) for loc, apogee_id in zip(location, apogee)]
+    url = np.array([path[0] for path in paths])
+    fullfilename = np.array([path[1] for path in paths])
+
+    # Presence is looked up in the inventory of the mirror without any filesystem call
+    inventory = mirror_inventory(_APOGEE_DATA)
+    present = inventory.contains(fullfilename)
+    missing = np.nonzero(~present)[0]
+
+    # Files of the same kind have similar size, so the median of those present is a good guess of those missing
+    if np.any(present):
+        typical_size = np.median([inventory.size(path) for path in fullfilename[present][:1000]])
+    else:
+        typical_size = _SPECTRA_TYPICAL_SIZE[kind]
 
-    if dr == 13:
-        str1 = 'https://data.sdss.org/sas/dr13/apogee/spectro/redux/r6/stars/apo25m/'
-        str2 = '{}/apStar-r6-{}.fits'.format(location, apogee)
-        filename = 'apStar-r6-{}.fits'.format(apogee)
-        urlstr = str1 + str2
-        fullfilename = os.path.join(_APOGEE_DATA, 'dr13/apogee/spectro/redux/r6/stars/apo25m/', str(location))
-        if not os.path.exists(fullfilename):
-            os.makedirs(fullfilename)
-        fullfilename = os.path.join(_APOGEE_DATA, 'dr13/apogee/spectro/redux/r6/stars/apo25m/', str(location), filename)
-        if not os.path.isfile(fullfilename):
-            try:
-                urllib.request.urlretrieve(urlstr, fullfilename)
-                print('Downloaded DR13 individual visit file successfully to {}'.format(fullfilename))
-            except urllib.request.HTTPError:
-                print('{} cannot be found on server, skipped'.format(urlstr))
-        else:
-            print(fullfilename + ' was found, not downloaded again')
+    return {'url': url, 'fullfilename': fullfilename, 'missing': missing,
+            'expected_size': int(typical_size * missing.shape[0])}
+
+
+class SpectraPrefetcher(object):
+    """
+    NAME: SpectraPrefetcher
+    PURPOSE: download the spectra missing in the local mirror in a background thread, iterating over it gives the path
+             of each file in the order of input as soon as that file is available, so files already present can be read
+             while the others are still downloading. Files are read with open_spectra(), which downloads again a file
+             listed in the inventory but deleted since
+    INPUT:
+        dr = 13 or 14
+        location = array of location id
+        apogee = array of apogee id
+        kind = 'combined' (aspcapStar) or 'visit' (apStar)
+        workers = number of concurrent connections
+        verbose = 1 to show the plan and a progress bar, 0 to print nothing
+        quota = disk quota of the local mirror in bytes or a string like '500G', None to use ASTRONN_MIRROR_QUOTA,
+                least recently used spectra not needed here are deleted to make room for the downloads
+    HISTORY:
+        2017-Nov-23 Henry Leung
+    """
+    def __init__(self, dr=None, location=None, apogee=None, kind='combined', workers=16, verbose=1, quota=None):
+        self.kind = kind
+        self.workers = workers
+        self.verbose = verbose
+        self.quota = mirror_quota(quota)
+        plan = plan_spectra(dr=dr, location=location, apogee=apogee, kind=kind)
+        self.url = plan['url']
+        self.fullfilename = plan['fullfilename']
+        self.missing = plan['missing']
+        self.expected_size = plan['expected_size']
+        self.warning_flag = np.zeros(self.fullfilename.shape[0], dtype=np.int8)
+        # Files still downloading, event is set once the download of that file is done
+        self._pending = {counter: threading.Event() for counter in self.missing.tolist()}
+        self._thread = None
+        if verbose == 1:
+            print('{} of {} {} files are missing in the local mirror, about {:.1f} MB to download'.format(
+                self.missing.shape[0], self.fullfilename.shape[0], _SPECTRA_NAMES[kind], self.expected_size / 1e6))
+
+    def _run(self):
+        # Downloads are only recorded in memory here, the inventory is saved once by _finish()
+        inventory = mirror_inventory(_APOGEE_DATA)
+        for directory in set(os.path.dirname(path) for path in self.fullfilename[self.missing]):
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+
+        with tqdm(total=self.missing.shape[0], unit='file', desc='{} spectra'.format(self.kind),
+                  disable=self.verbose != 1) as t:
+            def callback(job, flag):
+                counter = self.missing[job]
+                if flag is None:
+                    inventory.add(self.fullfilename[counter], save=False)
+                else:
+                    self.warning_flag[counter] = 1
+                self._pending[counter].set()
+                t.update(1)
 
-    elif dr == 14:
-        str1 = 'https://data.sdss.org/sas/dr14/apogee/spectro/redux/r8/stars/apo25m/'
-        str2 = '{}/apStar-r8-{}.fits'.format(location, apogee)
-        filename = 'apStar-r8-{}.fits'.format(apogee)
-        urlstr = str1 + str2
-        fullfilename = os.path.join(_APOGEE_DATA, 'dr14/apogee/spectro/redux/r8/stars/apo25m/', str(location))
-        if not os.path.exists(fullfilename):
-            os.makedirs(fullfilename)
-        fullfilename = os.path.join(_APOGEE_DATA, 'dr14/apogee/spectro/redux/r8/stars/apo25m/', str(location), filename)
-        if not os.path.isfile(fullfilename):
             try:
-                urllib.request.urlretrieve(urlstr, fullfilename)
-                print('Downloaded DR14 individual visit file successfully to {}'.format(fullfilename))
-            except urllib.request.HTTPError:
-                print('{} cannot be found on server, skipped'.format(urlstr))
-                warning_flag = 1
-        else:
-            if verbose == 1:
-                print(fullfilename + ' was found, not downloaded again')
+                # Files are queued in the order of input, so the next file needed is usually the next downloaded
+                fetch(list(zip(self.url[self.missing], self.fullfilename[self.missing])), connections=self.workers,
+                      callback=callback)
+            finally:
+                for counter, event in self._pending.items():
+                    if not event.is_set():
+                        self.warning_flag[counter] = 1
+                        event.set()
+
+        if self.verbose == 1:
+            failed = np.sum(self.warning_flag)
+            print('Downloaded {} of {} missing {} files, {} failed'.format(
+                self.missing.shape[0] - failed, self.missing.shape[0], _SPECTRA_NAMES[self.kind], failed))
+
+    def start(self):
+        """
+        NAME: start
+        PURPOSE: start downloading the missing files in the background
+        INPUT:
+        OUTPUT: self
+        HISTORY:
+            2017-Nov-23 Henry Leung
+        """
+        if self._thread is None and self.missing.shape[0] > 0:
+            if self.quota is not None:
+                # Make room for the downloads first, files of this selection are never evicted
+                mirror_inventory(_APOGEE_DATA).evict(quota=max(self.quota - self.expected_size, 0),
+                                                     keep=self.fullfilename)
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def _finish(self):
+        # The downloads and uses of the whole selection are merged into the saved inventory at once
+        if self._thread is not None:
+            self._thread.join()
+        mirror_inventory(_APOGEE_DATA).evict(quota=self.quota, keep=self.fullfilename)
+
+    def join(self):
+        """
+        NAME: join
+        PURPOSE: wait until all missing files are downloaded or failed
+        INPUT:
+        OUTPUT: (warning_flag array, 0 if the file is available locally and 1 if it failed to download,
+                 array of full local file path)
+        HISTORY:
+            2017-Nov-23 Henry Leung
+        """
+        self.start()
+        if self._thread is not None:
+            self._thread.join()
+        # The files are about to be used by the caller
+        mirror_inventory(_APOGEE_DATA).touch(self.fullfilename[self.warning_flag == 0])
+        self._finish()
+        return self.warning_flag, self.fullfilename
+
+    def __iter__(self):
+        self.start()
+        inventory = mirror_inventory(_APOGEE_DATA)
+        try:
+            for counter, path in enumerate(self.fullfilename):
+                if counter in self._pending:
+                    self._pending[counter].wait()
+                if self.warning_flag[counter] == 0:
+                    inventory.touch(path)
+                    yield path
+                else:
+                    yield None
+        finally:
+            self._finish()
+
+    def __len__(self):
+        return self.fullfilename.shape[0]
+
+
+def bulk_spectra(dr=None, location=None, apogee=None, kind='combined', workers=16, verbose=1, quota=None):
+    """
+    NAME: bulk_spectra
+    PURPOSE: download many spectra files at once over a pool of persistent connections, only files missing locally are
+             downloaded
+    INPUT:
+        dr = 13 or 14
+        location = array of location id
+        apogee = array of apogee id
+        kind = 'combined' (aspcapStar) or 'visit' (apStar)
+        workers = number of concurrent connections
+        verbose = 1 to show a progress bar, 0 to print nothing
+        quota = disk quota of the local mirror in bytes or a string like '500G', None to use ASTRONN_MIRROR_QUOTA
+    OUTPUT: (warning_flag array, 0 if the file is available locally and 1 if it failed to download,
+             array of full local file path)
+    HISTORY:
+        2017-Nov-21 Henry Leung
+    """
+    return SpectraPrefetcher(dr=dr, location=location, apogee=apogee, kind=kind, workers=workers, verbose=verbose,
+                             quota=quota).join()
 
+
+def refetch_spectra(fullfilename):
+    """
+    NAME: refetch_spectra
+    PURPOSE: download again a spectra file listed in the inventory of the local mirror but which is gone, i.e. deleted
+             by hand or evicted by another process sharing the mirror
+    INPUT:
+        fullfilename = full local file path from spectra_path(), bulk_spectra() or SpectraPrefetcher
+    OUTPUT: warning_flag, None if downloaded successfully or 1 if failed
+    HISTORY:
+        2017-Nov-23 Henry Leung
+    """
+    # Local paths mirror the directory tree of SAS
+    url = _SAS_URL + os.path.relpath(fullfilename, _APOGEE_DATA).replace(os.sep, '/')
+    mirror_inventory(_APOGEE_DATA).remove(fullfilename, save=False)
+    if not os.path.exists(os.path.dirname(fullfilename)):
+        os.makedirs(os.path.dirname(fullfilename))
+    warning_flag = fetch([(url, fullfilename)], connections=1)[0]
+    if warning_flag is None:
+        _record_download(fullfilename)
+        print('{} disappeared from the local mirror and was downloaded again'.format(fullfilename))
     else:
-        raise ValueError('visit_spectra() only supports DR13 or DR14')
+        mirror_inventory(_APOGEE_DATA).save()
+        print('{} disappeared from the local mirror and cannot be downloaded again, skipped'.format(fullfilename))
+    return warning_flag
+
 
-    return warning_flag, fullfilename
\ No newline at end of file
+def open_spectra(fullfilename):
+    """
+    NAME: open_spectra
+    PURPOSE: fits.open a spectra file of the local mirror. Presence is only checked by the inventory, so a file deleted
+             since is found out here and downloaded again
+    INPUT:
+        fullfilename = full local file path from spectra_path(), bulk_spectra() or SpectraPrefetcher
+    OUTPUT: HDUList, None if the file is gone and cannot be downloaded again
+    HISTORY:
+        2017-Nov-23 Henry Leung
+    """
+    try:
+        return fits.open(fullfilename)
+    except FileNotFoundError:
+        if refetch_spectra(fullfilename) is not None:
+            return None
+        return fits.open(fullfilename)
@@ -3,17 +3,16 @@
 # ---------------------------------------------------------#
 
 from astroquery.vizier import Vizier
-from astropy.io import fits
 import numpy as np
 import os
 import pylab as plt
 
-from astroNN.datasets.xmatch import xmatch
-from astroNN.apogee.downloader import allstar, combined_spectra
+from astroNN.datasets.xmatch import xmatch_kdtree
+from astroNN.apogee.downloader import bulk_spectra, open_spectra
+from astroNN.apogee.catalog_cache import allstar_columns, allstarcannon_columns
 from astroNN.apogee.apogee_shared import apogee_default_dr
 from astroNN.shared.nn_tools import h5name_check
 from astroNN.datasets.h5_compiler import gap_delete
-from astroNN.apogee.downloader import allstarcannon
 
 import tensorflow as tf
 from keras.backend.tensorflow_backend import set_session
@@ -50,17 +49,16 @@ def apokasc_logg(dr=None, h5name=None, folder_name=None):
     apokasc_dec = catalogs['_DE']
     apokasc_logg = catalogs['log_g_']
 
-    allstarpath = allstar(dr=dr)
-    hdulist = fits.open(allstarpath)
+    allstar_data = allstar_columns(dr=dr, columns=['RA', 'DEC', 'APOGEE_ID', 'LOCATION_ID', 'PARAM'])
     print('Now processing allStar DR{} catalog'.format(dr))
-    cannon_fullfilename = allstarcannon(dr=14)
-    cannonhdulist = fits.open(cannon_fullfilename)
+    cannon_data = allstarcannon_columns(dr=14, columns=['LOGG'])
 
-    apogee_ra = hdulist[1].data['RA']
-    apogee_dec = hdulist[1].data['DEC']
+    apogee_ra = allstar_data['RA']
+    apogee_dec = allstar_data['DEC']
 
-    m1, m2, sep = xmatch(apogee_ra, apokasc_ra, maxdist=2, colRA1=apogee_ra, colDec1=apogee_dec, epoch1=2000.,
-                         colRA2=apokasc_ra, colDec2=apokasc_dec, epoch2=2000., colpmRA2=None, colpmDec2=None, swap=True)
+    m1, m2, sep = xmatch_kdtree(apogee_ra, apokasc_ra, maxdist=2, colRA1=apogee_ra, colDec1=apogee_dec, epoch1=2000.,
+                                colRA2=apokasc_ra, colDec2=apokasc_dec, epoch2=2000., colpmRA2=None, colpmDec2=None,
+                                swap=True, cache=True)
     currentdir = os.getcwd()
     fullfolderpath = currentdir + '/' + folder_name
     modelname = '/model_{}.h5'.format(folder_name[-11:])
@@ -73,25 +71,25 @@ def apokasc_logg(dr=None, h5name=None, folder_name=None):
     astronn_residue = []
     cannon_residue = []
 
+    # Download all missing spectra concurrently before the loop
+    warningflags, paths = bulk_spectra(dr=dr, location=allstar_data['LOCATION_ID'][m1],
+                                       apogee=allstar_data['APOGEE_ID'][m1], kind='combined')
+
     for counter, index in enumerate(m1):
-        apogee_id = hdulist[1].data['APOGEE_ID'][index]
-        location_id = hdulist[1].data['LOCATION_ID'][index]
-        cannon_residue.extend([cannonhdulist[1].data['LOGG'][index] - apokasc_logg[counter]])
-        warningflag, path = combined_spectra(dr=dr, location=location_id, apogee=apogee_id, verbose=0)
-        if warningflag is None:
-            combined_file = fits.open(path)
+        cannon_residue.extend([cannon_data['LOGG'][index] - apokasc_logg[counter]])
+        if warningflags[counter] == 0:
+            combined_file = open_spectra(paths[counter])
+            if combined_file is None:
+                continue
             _spec = combined_file[1].data  # Pseudo-comtinumm normalized flux
             spec = (_spec - spec_meanstd[0])/spec_meanstd[1]
             spec = gap_delete(spec, dr=14)
-            aspcap_residue.extend([hdulist[1].data['PARAM'][index, 1] - apokasc_logg[counter]])
+            aspcap_residue.extend([allstar_data['PARAM'][index, 1] - apokasc_logg[counter]])
             prediction = model.predict(spec.reshape([1, len(spec), 1]), batch_size=1)
             prediction *= mean_and_std[1]
             prediction += mean_and_std[0]
             astronn_residue.extend([prediction[0,1] - apokasc_logg[counter]])
 
-    hdulist.close()
-    cannonhdulist.close()
-
     plt.figure(figsize=(15, 11), dpi=200)
     plt.axhline(0, ls='--', c='k', lw=2)
     plt.scatter(apokasc_logg, aspcap_residue, s=3)
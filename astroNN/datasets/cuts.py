@@ -0,0 +1,101 @@
+# ---------------------------------------------------------#
+#   astroNN.datasets.cuts: select stars with cuts on catalog
+# ---------------------------------------------------------#
+
+import numpy as np
+
+
+def allstar_cuts(data, starflagcut=True, aspcapflagcut=True, vscattercut=1, tefflow=4000, teffhigh=5500, ironlow=None,
+                 loggcut=False):
+    """
+    NAME: allstar_cuts
+    PURPOSE: build the usual quality cuts on allStar catalog as boolean masks
+    INPUT:
+        data = allStar table, anything with allStar column names as keys
+        starflagcut = True (Cut star with starflag != 0), False (do nothing)
+        aspcapflagcut = True (Cut star with aspcapflag != 0), False (do nothing)
+        vscattercut = scalar for maximum scattercut
+        tefflow/teffhigh = Teff lower cut and Teff upper cut
+        ironlow = lower limit of Fe/H dex, None to skip
+        loggcut = True (Cut star with logg == -9999), False (do nothing)
+    OUTPUT: list of (name of the cut, boolean mask)
+    HISTORY:
+        2017-Nov-18 Henry Leung
+    """
+    teff = data['PARAM'][:, 0]
+    cuts = []
+
+    if starflagcut is True:
+        cuts.append(('STARFLAG == 0', data['STARFLAG'] == 0))
+    if aspcapflagcut is True:
+        cuts.append(('ASPCAPFLAG == 0', data['ASPCAPFLAG'] == 0))
+    cuts.append(('Teff >= {}'.format(tefflow), tefflow <= teff))
+    cuts.append(('Teff <= {}'.format(teffhigh), teffhigh >= teff))
+    cuts.append(('VSCATTER < {}'.format(vscattercut), data['VSCATTER'] < vscattercut))
+    if ironlow is not None:
+        cuts.append(('[Fe/H] > {}'.format(ironlow), data['X_H'][:, 17] > ironlow))
+    if loggcut is True:
+        cuts.append(('Log(g) != -9999', data['PARAM'][:, 1] != -9999))
+    # There are some location_id=1 to avoid
+    cuts.append(('LOCATION_ID > 1', data['LOCATION_ID'] > 1))
+
+    return cuts
+
+
+def snr_cuts(data, low=None, high=None):
+    """
+    NAME: snr_cuts
+    PURPOSE: build SNR cuts on allStar catalog as boolean masks
+    INPUT:
+        data = allStar table, anything with allStar column names as keys
+        low/high = SNR lower cut and SNR upper cut, None to skip
+    OUTPUT: list of (name of the cut, boolean mask)
+    HISTORY:
+        2017-Nov-18 Henry Leung
+    """
+    cuts = []
+    if low is not None:
+        cuts.append(('SNR > {}'.format(low), data['SNR'] > low))
+    if high is not None:
+        cuts.append(('SNR < {}'.format(high), data['SNR'] < high))
+    return cuts
+
+
+def fused_mask(cuts, mask=None):
+    """
+    NAME: fused_mask
+    PURPOSE: fuse all cuts into one boolean mask
+    INPUT:
+        cuts = list of (name of the cut, boolean mask), applied in order
+        mask = boolean mask to start from (i.e. result of common cuts), None to start with all stars
+    OUTPUT: (fused boolean mask, list of (name of the cut, number of stars survived after this cut))
+    HISTORY:
+        2017-Nov-18 Henry Leung
+    """
+    survivors = []
+    for name, cut in cuts:
+        if mask is None:
+            mask = np.array(cut, dtype=bool)
+        else:
+            mask = mask & cut
+        survivors.append((name, int(np.count_nonzero(mask))))
+    return mask, survivors
+
+
+def select(cuts, mask=None, verbose=1):
+    """
+    NAME: select
+    PURPOSE: apply all cuts at once and return the indices of the selected stars
+    INPUT:
+        cuts = list of (name of the cut, boolean mask), applied in order
+        mask = boolean mask to start from (i.e. result of common cuts), None to start with all stars
+        verbose = 1 to print the number of stars survived after each cut, 0 to print nothing
+    OUTPUT: (sorted indices of selected stars, list of (name of the cut, number of stars survived after this cut))
+    HISTORY:
+        2017-Nov-18 Henry Leung
+    """
+    mask, survivors = fused_mask(cuts, mask=mask)
+    if verbose == 1:
+        for name, count in survivors:
+            print('{:>20}: {} stars survived'.format(name, count))
+    return np.nonzero(mask)[0], survivors
@@ -3,24 +3,43 @@
 # ---------------------------------------------------------#
 
 import os
-from functools import reduce
+from functools import lru_cache
+from multiprocessing import Pool
 
 import h5py
 import numpy as np
-from astropy.io import fits
 
 import astroNN.apogee.downloader
-import astroNN.gaia.downloader
 import astroNN.datasets.xmatch
 from astroNN.apogee.apogee_shared import apogee_env, apogee_default_dr
 from astroNN.gaia.gaia_shared import gaia_env, gaia_default_dr, to_absmag
 from astroNN.shared.nn_tools import h5name_check
-from astroNN.apogee.downloader import combined_spectra, visit_spectra
+from astroNN.datasets.h5_tools import H5BlockWriter
+from astroNN.datasets.cuts import allstar_cuts, snr_cuts, fused_mask, select
+from astroNN.apogee.downloader import bulk_spectra, open_spectra, plan_spectra, SpectraPrefetcher
+from astroNN.apogee.catalog_cache import allstar_columns
+from astroNN.gaia.catalogs import tgas_load
 
 currentdir = os.getcwd()
 _APOGEE_DATA = apogee_env()
 _GAIA_DATA = gaia_env()
 
+# Labels saved with the spectra as (name in h5 file, allStar column, index in that column or None for a scalar column)
+_APOGEE_LABELS = (('SNR', 'SNR', None), ('RA', 'RA', None), ('DEC', 'DEC', None),
+                  ('teff', 'PARAM', 0), ('logg', 'PARAM', 1), ('M', 'PARAM', 3), ('alpha', 'PARAM', 6),
+                  ('C', 'X_H', 0), ('Cl', 'X_H', 1), ('N', 'X_H', 2), ('O', 'X_H', 3), ('Na', 'X_H', 4),
+                  ('Mg', 'X_H', 5), ('Al', 'X_H', 6), ('Si', 'X_H', 7), ('P', 'X_H', 8), ('S', 'X_H', 9),
+                  ('K', 'X_H', 10), ('Ca', 'X_H', 11), ('Ti', 'X_H', 12), ('Ti2', 'X_H', 13), ('V', 'X_H', 14),
+                  ('Cr', 'X_H', 15), ('Mn', 'X_H', 16), ('Fe', 'X_H', 17), ('Ni', 'X_H', 19), ('Cu', 'X_H', 20),
+                  ('Ge', 'X_H', 21), ('Rb', 'X_H', 22), ('Y', 'X_H', 23), ('Nd', 'X_H', 24))
+
+# allStar columns used by the compilers, converted to the column cache at once on first use
+_ALLSTAR_COLUMNS = ['APOGEE_ID', 'LOCATION_ID', 'STARFLAG', 'ASPCAPFLAG', 'VSCATTER', 'SNR', 'NVISITS', 'RA', 'DEC', 'K',
+                    'PARAM', 'X_H']
+
+# Manifest of stars already in a compiled h5 file, used to resume or refresh a compilation
+_APOGEE_MANIFEST = (('APOGEE_ID', 'APOGEE_ID', None), ('LOCATION_ID', 'LOCATION_ID', None))
+
 
 def apogeeid_digit(arr):
     """
@@ -35,45 +54,210 @@ def apogeeid_digit(arr):
     return str(''.join(filter(str.isdigit, arr)))
 
 
+# Pixel ranges deleted by gap_delete as (start, end), end of None means until the end of the spectra
+_APOGEE_GAPS = {13: ((0, 322), (3243, 3648), (6049, 6412), (8306, None)),  # Blue/Green/Red chip gap
+                14: ((0, 246), (3274, 3585), (6080, 6344), (8335, 8575))}
+
+
+@lru_cache(maxsize=None)
+def _gap_mask(dr, length):
+    """
+    NAME: _gap_mask
+    PURPOSE: boolean mask of pixels to keep after deleting the gaps between APOGEE camera, cached for each dr and length
+    INPUT:
+        dr = 13 or 14
+        length = number of pixels of the spectra
+    OUTPUT: read-only boolean mask
+    HISTORY:
+        2017-Nov-19 Henry Leung
+    """
+    if dr not in _APOGEE_GAPS:
+        raise ValueError('Only DR13 and DR14 are supported')
+    mask = np.ones(length, dtype=bool)
+    for start, end in _APOGEE_GAPS[dr]:
+        mask[start:end] = False
+    mask.setflags(write=False)
+    return mask
+
+
 def gap_delete(single_spec, dr=None):
     """
     NAME: gap_delete
     PURPOSE: delete the gap between APOGEE camera
     INPUT:
-        single_spec = single spectra array
+        single_spec = single spectra array, or an array of spectra with shape (N, 8575) to delete the gap all at once
         dr = 13 or 14
     OUTPUT: corrected array
     HISTORY:
         2017-Oct-26 Henry Leung
     """
     dr = apogee_default_dr(dr=dr)
+    single_spec = np.asarray(single_spec)
+    return single_spec[..., _gap_mask(dr, single_spec.shape[-1])]
+
+
+def gather_labels(data, index, labels=None):
+    """
+    NAME: gather_labels
+    PURPOSE: gather labels of many stars at once, each allStar column is fancy indexed only once
+    INPUT:
+        data = allStar table, i.e. from astroNN.apogee.catalog_cache.allstar_columns()
+        index = indices of the stars in allStar
+        labels = table of (name, column, index in column), default to the labels saved by compile_apogee
+    OUTPUT: dictionary of label name to contiguous numpy array
+    HISTORY:
+        2017-Nov-16 Henry Leung
+    """
+    if labels is None:
+        labels = _APOGEE_LABELS
+
+    columns = {}
+    gathered = {}
+    for name, column, column_index in labels:
+        if column not in columns:
+            columns[column] = np.asarray(data[column][index])
+            if columns[column].dtype.kind == 'U':  # h5py cannot store numpy unicode string
+                columns[column] = np.char.encode(columns[column], 'ascii')
+        if column_index is None:
+            gathered[name] = np.ascontiguousarray(columns[column])
+        else:
+            gathered[name] = np.ascontiguousarray(columns[column][:, column_index])
+    return gathered
+
+
+def _manifest_keys(apogee_id, location_id):
+    return np.char.add(np.char.add(np.asarray(location_id).astype('S'), b'.'), np.asarray(apogee_id).astype('S'))
 
-    if dr == 13:
-        arr1 = np.arange(0, 322, 1) # Blue chip gap
-        arr2 = np.arange(3243, 3648, 1) # Green chip gap
-        arr3 = np.arange(6049, 6412, 1) # Red chip gap
-        arr4 = np.arange(8306, len(single_spec), 1)
-        single_spec = np.delete(single_spec, arr4)
-        single_spec = np.delete(single_spec, arr3)
-        single_spec = np.delete(single_spec, arr2)
-        single_spec = np.delete(single_spec, arr1)
-        return single_spec
-    elif dr == 14:
-        arr1 = np.arange(0, 246, 1) # Blue chip gap
-        arr2 = np.arange(3274, 3585, 1) # Green chip gap
-        arr3 = np.arange(6080, 6344, 1) # Red chip gap
-        arr4 = np.arange(8335, 8575, 1)
-        single_spec = np.delete(single_spec, arr4)
-        single_spec = np.delete(single_spec, arr3)
-        single_spec = np.delete(single_spec, arr2)
-        single_spec = np.delete(single_spec, arr1)
-        return single_spec
+
+def compiled_mask(h5filename, manifest):
+    """
+    NAME: compiled_mask
+    PURPOSE: check which stars are already in a compiled h5 file according to its manifest
+    INPUT:
+        h5filename = compiled h5 file
+        manifest = dictionary contains 'APOGEE_ID' and 'LOCATION_ID' arrays of the stars to check
+    OUTPUT: boolean mask of stars already in the file, or None if the file has no manifest
+    HISTORY:
+        2017-Nov-18 Henry Leung
+    """
+    keys = _manifest_keys(manifest['APOGEE_ID'], manifest['LOCATION_ID'])
+    if not os.path.isfile(h5filename):
+        return np.zeros(keys.shape[0], dtype=bool)
+    with h5py.File(h5filename, 'r') as F:
+        if 'APOGEE_ID' not in F or 'LOCATION_ID' not in F:
+            return None
+        # Rows of an interrupted compilation are only complete up to the shortest dataset
+        length = min([dataset.shape[0] for dataset in F.values() if isinstance(dataset, h5py.Dataset)])
+        existing = _manifest_keys(F['APOGEE_ID'][:length], F['LOCATION_ID'][:length])
+    return np.isin(keys, existing)
+
+
+def _combined_spectra_worker(job):
+    """
+    NAME: _combined_spectra_worker
+    PURPOSE: open and gap delete a single aspcapStar file, picklable so it can run in a process pool
+    INPUT:
+        job = (dr, full path of the aspcapStar file or None if the file is not available)
+    OUTPUT: (spectra, bestfit spectra) or None if the file is not available
+    HISTORY:
+        2017-Nov-16 Henry Leung
+    """
+    dr, path = job
+    if path is None:
+        return None
+    combined_file = open_spectra(path)
+    if combined_file is None:
+        return None
+    with combined_file:
+        _spec = gap_delete(combined_file[1].data, dr=dr)  # Pseudo-comtinumm normalized flux
+        _spec_bestfit = gap_delete(combined_file[3].data, dr=dr)  # Best fit spectrum for training generative model
+    return _spec, _spec_bestfit
+
+
+def _ordered_map(func, jobs, workers=None, chunksize=16):
+    """
+    NAME: _ordered_map
+    PURPOSE: map func over jobs either serially or with a process pool, results always come back in the order of jobs
+    INPUT:
+        func = picklable top level function
+        jobs = iterable of arguments, consumed lazily
+        workers = number of processes, None or 1 to run serially in this process
+        chunksize = number of jobs sent to a worker at once
+    OUTPUT: generator of results
+    HISTORY:
+        2017-Nov-16 Henry Leung
+    """
+    if workers is None or workers <= 1:
+        for job in jobs:
+            yield func(job)
     else:
-        raise ValueError('Only DR13 and DR14 are supported')
+        with Pool(processes=workers) as pool:
+            for result in pool.imap(func, jobs, chunksize=chunksize):
+                yield result
+
+
+def _apogee_selection(allstar_data, starflagcut=True, aspcapflagcut=True, vscattercut=1, SNRtrain_low=200,
+                      SNRtrain_high=99999, tefflow=4000, teffhigh=5500, ironlow=-3, SNRtest_low=100, SNRtest_high=200):
+    """
+    NAME: _apogee_selection
+    PURPOSE: apply the cuts of compile_apogee to allStar
+    INPUT:
+        allstar_data = allStar table, i.e. from astroNN.apogee.catalog_cache.allstar_columns()
+        others = see compile_apogee
+    OUTPUT: (indices of the training set, indices of the testing set)
+    HISTORY:
+        2017-Nov-23 Henry Leung
+    """
+    # Cuts shared by both training and testing set are fused once, only the SNR cuts differ between them
+    common_cuts = allstar_cuts(allstar_data, starflagcut=starflagcut, aspcapflagcut=aspcapflagcut,
+                               vscattercut=vscattercut, tefflow=tefflow, teffhigh=teffhigh, ironlow=ironlow,
+                               loggcut=True)
+    common_mask, _ = fused_mask(common_cuts)
+
+    print('Cuts for the training dataset')
+    filtered_train_index, _ = select(common_cuts + snr_cuts(allstar_data, low=SNRtrain_low, high=SNRtrain_high))
+    print('Cuts for the testing dataset')
+    filtered_test_index, _ = select(snr_cuts(allstar_data, low=SNRtest_low, high=SNRtest_high), mask=common_mask)
+
+    print('Total entry after filtering: ', filtered_train_index.shape[0])
+    print('Total Visit there: ', np.sum(allstar_data['NVISITS'][filtered_train_index]))
+
+    return filtered_train_index, filtered_test_index
+
+
+def plan_apogee(dr=None, kind='combined', starflagcut=True, aspcapflagcut=True, vscattercut=1, SNRtrain_low=200,
+                SNRtrain_high=99999, tefflow=4000, teffhigh=5500, ironlow=-3, SNRtest_low=100, SNRtest_high=200):
+    """
+    NAME: plan_apogee
+    PURPOSE: list the spectra a compilation with the same cuts needs but are missing in the local mirror, without
+             downloading anything
+    INPUT:
+        dr = 13 or 14
+        kind = 'combined' (aspcapStar for compile_apogee) or 'visit' (apStar for compile_apogee_apstar)
+        others = cuts, see compile_apogee
+    OUTPUT: dictionary of 'url' and 'fullfilename' of the spectra needed, 'missing' (indices of the files to download)
+            and 'expected_size' (estimated bytes to download)
+    HISTORY:
+        2017-Nov-23 Henry Leung
+    """
+    dr = apogee_default_dr(dr=dr)
+    allstar_data = allstar_columns(dr=dr, columns=_ALLSTAR_COLUMNS)
+    filtered_train_index, filtered_test_index = _apogee_selection(
+        allstar_data, starflagcut=starflagcut, aspcapflagcut=aspcapflagcut, vscattercut=vscattercut,
+        SNRtrain_low=SNRtrain_low, SNRtrain_high=SNRtrain_high, tefflow=tefflow, teffhigh=teffhigh, ironlow=ironlow,
+        SNRtest_low=SNRtest_low, SNRtest_high=SNRtest_high)
+    union_index = np.union1d(filtered_train_index, filtered_test_index)
+    plan = plan_spectra(dr=dr, location=allstar_data['LOCATION_ID'][union_index],
+                        apogee=allstar_data['APOGEE_ID'][union_index], kind=kind)
+    print('{} of {} spectra are missing in the local mirror, about {:.1f} MB to download'.format(
+        plan['missing'].shape[0], union_index.shape[0], plan['expected_size'] / 1e6))
+    return plan
 
 
 def compile_apogee(h5name=None, dr=None, starflagcut=True, aspcapflagcut=True, vscattercut=1, SNRtrain_low=200,
-                   SNRtrain_high=99999, tefflow=4000, teffhigh=5500, ironlow=-3, SNRtest_low=100, SNRtest_high=200):
+                   SNRtrain_high=99999, tefflow=4000, teffhigh=5500, ironlow=-3, SNRtest_low=100, SNRtest_high=200,
+                   workers=None, block_size=256, resume=False, chunk_rows=None, compression=None,
+                   compression_opts=None, spectra_dtype=None, download_workers=16):
     """
     NAME: compile_apogee
     PURPOSE: compile apogee data to a training and testing dataset
@@ -87,6 +271,15 @@ def compile_apogee(h5name=None, dr=None, starflagcut=True, aspcapflagcut=True, v
         tefflow/teffhigh = Teff lower cut and Teff upper cut for training set
         ironlow = lower limit of Fe/H dex
         SNRtest_low/SNRtest_high = SNR lower cut and SNR upper cut for testing set
+        workers = number of processes to read the spectra with, None or 1 to read serially
+        block_size = number of spectra kept in memory before they are written to the h5 file
+        resume = True to only append stars missing in existing {h5name}_train.h5 and {h5name}_test.h5 (i.e. after an
+                 interrupted compilation or if new stars pass the cuts), False to compile from scratch
+        chunk_rows = number of spectra per h5 chunk, set it to the training batch size for fast random minibatch reads
+        compression = None, 'gzip' or 'lzf' compression of the h5 datasets
+        compression_opts = compression level for gzip (0-9)
+        spectra_dtype = dtype to store spectra with, i.e. 'float32' or 'float16', None to keep the dtype of the FITS
+        download_workers = number of concurrent downloads of spectra missing in the local mirror
 
     OUTPUT: {h5name}_train.h5   {h5name}_test.h5
     HISTORY:
@@ -95,191 +288,71 @@ def compile_apogee(h5name=None, dr=None, starflagcut=True, aspcapflagcut=True, v
     h5name_check(h5name)
     dr = apogee_default_dr(dr=dr)
 
-    allstarpath = astroNN.apogee.downloader.allstar(dr=dr)
-
-    # Loading Data form FITS files
-    hdulist = fits.open(allstarpath)
+    # Loading memory-mapped columns of allStar
+    allstar_data = allstar_columns(dr=dr, columns=_ALLSTAR_COLUMNS)
     print('Now processing allStar DR{} catalog'.format(dr))
-    starflag = hdulist[1].data['STARFLAG']
-    aspcapflag = hdulist[1].data['ASPCAPFLAG']
-    vscatter = hdulist[1].data['VSCATTER']
-    SNR = hdulist[1].data['SNR']
-    location_id = hdulist[1].data['LOCATION_ID']
-    teff = hdulist[1].data['PARAM'][:, 0]
-    logg = hdulist[1].data['PARAM'][:, 1]
-    Fe = hdulist[1].data['X_H'][:, 17]
-
-    total = range(len(starflag))
-
-    if starflagcut is True:
-        DR_fitlered_starflag = np.where(starflag == 0)[0]
-    else:
-        DR_fitlered_starflag = total
-
-    if aspcapflagcut is True:
-        DR_fitlered_aspcapflag = np.where(aspcapflag == 0)[0]
-    else:
-        DR_fitlered_aspcapflag = total
-    DR_fitlered_temp_lower = np.where((tefflow <= teff))[0]
-    DR_fitlered_temp_upper = np.where((teffhigh >= teff))[0]
-    DR_fitlered_vscatter = np.where(vscatter < vscattercut)[0]
-    DR_fitlered_Fe = np.where(Fe > ironlow)[0]
-    DR_fitlered_logg = np.where(logg != -9999)[0]
-    DR_fitlered_snrlow = np.where(SNR > SNRtrain_low)[0]
-    DR_fitlered_snrhigh = np.where(SNR < SNRtrain_high)[0]
-    DR_fitlered_SNRtest_low = np.where(SNR > SNRtest_low)[0]
-    DR_fitlered_SNRtest_high = np.where(SNR < SNRtest_high)[0]
-
-    # There are some location_id=1 to avoid
-    DR14_fitlered_location = np.where(location_id > 1)[0]
-
-    # Here we found the common indices that satisfied all requirement
-    filtered_train_index = reduce(np.intersect1d, (DR_fitlered_starflag, DR_fitlered_aspcapflag, DR_fitlered_temp_lower,
-                                                   DR_fitlered_vscatter, DR_fitlered_Fe, DR_fitlered_logg,
-                                                   DR_fitlered_snrlow,
-                                                   DR_fitlered_snrhigh, DR14_fitlered_location, DR_fitlered_temp_upper))
-
-    filtered_test_index = reduce(np.intersect1d, (DR_fitlered_starflag, DR_fitlered_aspcapflag, DR_fitlered_temp_lower,
-                                                  DR_fitlered_vscatter, DR_fitlered_Fe, DR_fitlered_logg,
-                                                  DR_fitlered_SNRtest_low,
-                                                  DR_fitlered_SNRtest_high, DR14_fitlered_location,
-                                                  DR_fitlered_temp_upper))
-
-    print('Total entry after filtering: ', filtered_train_index.shape[0])
-    print('Total Visit there: ', np.sum(hdulist[1].data['NVISITS'][filtered_train_index]))
-
-    for tt in ['train', 'test']:
-        spec = []
-        spec_bestfit = []
-        SNR = []
-        RA = []
-        DEC = []
-        teff = []
-        logg = []
-        MH = []
-        alpha_M = []
-        C = []
-        Cl = []
-        N = []
-        O = []
-        Na = []
-        Mg = []
-        Al = []
-        Si = []
-        P = []
-        S = []
-        K = []
-        Ca = []
-        Ti = []
-        Ti2 = []
-        V = []
-        Cr = []
-        Mn = []
-        Fe = []
-        Ni = []
-        Cu = []
-        Ge = []
-        Rb = []
-        Y = []
-        Nd = []
 
-        if tt == 'train':
-            filtered_index = filtered_train_index
-        else:
-            filtered_index = filtered_test_index
-
-        print('Filtering the dataset according to the cuts you specified or default cuts for the {}ing dataset'.format(
-            tt))
-
-        for index in filtered_index:
-            apogee_id = hdulist[1].data['APOGEE_ID'][index]
-            location_id = hdulist[1].data['LOCATION_ID'][index]
-            warningflag, path = combined_spectra(dr=dr, location=location_id, apogee=apogee_id, verbose=0)
-            if warningflag is None:
-                combined_file = fits.open(path)
-                _spec = combined_file[1].data  # Pseudo-comtinumm normalized flux
-                _spec_bestfit = combined_file[3].data  # Best fit spectrum for training generative model
-                _spec = gap_delete(_spec, dr=14)  # Delete the gap between sensors
-                _spec_bestfit = gap_delete(_spec_bestfit, dr=14)  # Delete the gap between sensors
-
-                spec.extend([_spec])
-                spec_bestfit.extend([_spec_bestfit])
-                SNR.extend([hdulist[1].data['SNR'][index]])
-                RA.extend([hdulist[1].data['RA'][index]])
-                DEC.extend([hdulist[1].data['DEC'][index]])
-                teff.extend([hdulist[1].data['PARAM'][index, 0]])
-                logg.extend([hdulist[1].data['PARAM'][index, 1]])
-                MH.extend([hdulist[1].data['PARAM'][index, 3]])
-                alpha_M.extend([hdulist[1].data['PARAM'][index, 6]])
-                C.extend([hdulist[1].data['X_H'][index, 0]])
-                Cl.extend([hdulist[1].data['X_H'][index, 1]])
-                N.extend([hdulist[1].data['X_H'][index, 2]])
-                O.extend([hdulist[1].data['X_H'][index, 3]])
-                Na.extend([hdulist[1].data['X_H'][index, 4]])
-                Mg.extend([hdulist[1].data['X_H'][index, 5]])
-                Al.extend([hdulist[1].data['X_H'][index, 6]])
-                Si.extend([hdulist[1].data['X_H'][index, 7]])
-                P.extend([hdulist[1].data['X_H'][index, 8]])
-                S.extend([hdulist[1].data['X_H'][index, 9]])
-                K.extend([hdulist[1].data['X_H'][index, 10]])
-                Ca.extend([hdulist[1].data['X_H'][index, 11]])
-                Ti.extend([hdulist[1].data['X_H'][index, 12]])
-                Ti2.extend([hdulist[1].data['X_H'][index, 13]])
-                V.extend([hdulist[1].data['X_H'][index, 14]])
-                Cr.extend([hdulist[1].data['X_H'][index, 15]])
-                Mn.extend([hdulist[1].data['X_H'][index, 16]])
-                Fe.extend([hdulist[1].data['X_H'][index, 17]])
-                Ni.extend([hdulist[1].data['X_H'][index, 19]])
-                Cu.extend([hdulist[1].data['X_H'][index, 20]])
-                Ge.extend([hdulist[1].data['X_H'][index, 21]])
-                Rb.extend([hdulist[1].data['X_H'][index, 22]])
-                Y.extend([hdulist[1].data['X_H'][index, 23]])
-                Nd.extend([hdulist[1].data['X_H'][index, 24]])
-
-        print('Creating {}_{}.h5'.format(h5name, tt))
-        h5f = h5py.File('{}_{}.h5'.format(h5name, tt), 'w')
-        h5f.create_dataset('spectra', data=spec)
-        h5f.create_dataset('spectrabestfit', data=spec_bestfit)
-        h5f.create_dataset('index', data=filtered_index)
-        h5f.create_dataset('SNR', data=SNR)
-        h5f.create_dataset('RA', data=RA)
-        h5f.create_dataset('DEC', data=DEC)
-        h5f.create_dataset('teff', data=teff)
-        h5f.create_dataset('logg', data=logg)
-        h5f.create_dataset('M', data=MH)
-        h5f.create_dataset('alpha', data=alpha_M)
-        h5f.create_dataset('C', data=C)
-        h5f.create_dataset('Cl', data=Cl)
-        h5f.create_dataset('N', data=N)
-        h5f.create_dataset('O', data=O)
-        h5f.create_dataset('Na', data=Na)
-        h5f.create_dataset('Mg', data=Mg)
-        h5f.create_dataset('Al', data=Al)
-        h5f.create_dataset('Si', data=Si)
-        h5f.create_dataset('P', data=P)
-        h5f.create_dataset('S', data=S)
-        h5f.create_dataset('K', data=K)
-        h5f.create_dataset('Ca', data=Ca)
-        h5f.create_dataset('Ti', data=Ti)
-        h5f.create_dataset('Ti2', data=Ti2)
-        h5f.create_dataset('V', data=V)
-        h5f.create_dataset('Cr', data=Cr)
-        h5f.create_dataset('Mn', data=Mn)
-        h5f.create_dataset('Fe', data=Fe)
-        h5f.create_dataset('Ni', data=Ni)
-        h5f.create_dataset('Cu', data=Cu)
-        h5f.create_dataset('Ge', data=Ge)
-        h5f.create_dataset('Rb', data=Rb)
-        h5f.create_dataset('Y', data=Y)
-        h5f.create_dataset('Nd', data=Nd)
-        h5f.close()
+    filtered_train_index, filtered_test_index = _apogee_selection(
+        allstar_data, starflagcut=starflagcut, aspcapflagcut=aspcapflagcut, vscattercut=vscattercut,
+        SNRtrain_low=SNRtrain_low, SNRtrain_high=SNRtrain_high, tefflow=tefflow, teffhigh=teffhigh, ironlow=ironlow,
+        SNRtest_low=SNRtest_low, SNRtest_high=SNRtest_high)
+
+    dtypes = {'spectra': spectra_dtype, 'spectrabestfit': spectra_dtype} if spectra_dtype is not None else None
+    writers, todo, members, rows = {}, {}, {}, {}
+    for tt, filtered_index in (('train', filtered_train_index), ('test', filtered_test_index)):
+        # Labels are gathered up front, the writer only keeps rows of stars with spectra so everything stays aligned
+        labels = gather_labels(allstar_data, filtered_index, labels=_APOGEE_LABELS + _APOGEE_MANIFEST)
+        labels['index'] = filtered_index
+        h5filename = '{}_{}.h5'.format(h5name, tt)
+
+        mode = 'w'
+        todo[tt] = np.ones(filtered_index.shape[0], dtype=bool)
+        if resume is True:
+            compiled = compiled_mask(h5filename, labels)
+            if compiled is None:
+                print('{} has no manifest of compiled stars, compiling from scratch'.format(h5filename))
+            else:
+                mode = 'a'
+                todo[tt] = ~compiled
+                print('{} already contains {} stars, {} stars to append'.format(h5filename, np.sum(compiled),
+                                                                                np.sum(todo[tt])))
+
+        print('{} {}'.format('Creating' if mode == 'w' else 'Appending to', h5filename))
+        writers[tt] = H5BlockWriter(h5filename, block_size=block_size, table=labels, mode=mode, chunk_rows=chunk_rows,
+                                    compression=compression, compression_opts=compression_opts, dtypes=dtypes)
+
+    # Every star is read only once even if it is in both the training and testing set
+    union_index = np.union1d(filtered_train_index[todo['train']], filtered_test_index[todo['test']])
+    print('Total spectra to read for both training and testing dataset: ', union_index.shape[0])
+
+    for tt, filtered_index in (('train', filtered_train_index), ('test', filtered_test_index)):
+        members[tt] = np.isin(union_index, filtered_index[todo[tt]])
+        rows[tt] = np.searchsorted(filtered_index, union_index)
+
+    # Missing spectra are downloaded in the background while those already present are read, a job waits only if
+    # its own file is still downloading
+    prefetcher = SpectraPrefetcher(dr=dr, location=allstar_data['LOCATION_ID'][union_index],
+                                   apogee=allstar_data['APOGEE_ID'][union_index], kind='combined',
+                                   workers=download_workers)
+
+    # Spectra are read in union_index order regardless of workers, so the output is the same as serial
+    jobs = ((dr, path) for path in prefetcher)
+    for counter, result in enumerate(_ordered_map(_combined_spectra_worker, jobs, workers=workers)):
+        if result is not None:
+            for tt, writer in writers.items():
+                if members[tt][counter]:
+                    writer.append(row=rows[tt][counter], spectra=result[0], spectrabestfit=result[1])
+
+    for tt, writer in writers.items():
+        writer.close()
         print('Successfully created {}_{}.h5 in {}'.format(h5name, tt, currentdir))
 
     return None
 
 
 def compile_apogee_apstar(h5name=None, dr=None, starflagcut=True, aspcapflagcut=True, vscattercut=1, SNRtrain_low=200,
-                   SNRtrain_high=99999, tefflow=4000, teffhigh=5500, ironlow=-3, SNRtest_low=100, SNRtest_high=200):
+                   SNRtrain_high=99999, tefflow=4000, teffhigh=5500, ironlow=-3, SNRtest_low=100, SNRtest_high=200,
+                   download_workers=16):
     """
     NAME: compile_apogee
     PURPOSE: compile apogee data to a training and testing dataset
@@ -293,6 +366,7 @@ def compile_apogee_apstar(h5name=None, dr=None, starflagcut=True, aspcapflagcut=
         tefflow/teffhigh = Teff lower cut and Teff upper cut for training set
         ironlow = lower limit of Fe/H dex
         SNRtest_low/SNRtest_high = SNR lower cut and SNR upper cut for testing set
+        download_workers = number of concurrent downloads of spectra missing in the local mirror
 
     OUTPUT: {h5name}_train.h5   {h5name}_test.h5
     HISTORY:
@@ -301,146 +375,101 @@ def compile_apogee_apstar(h5name=None, dr=None, starflagcut=True, aspcapflagcut=
     h5name_check(h5name)
     dr = apogee_default_dr(dr=dr)
 
-    allstarpath = astroNN.apogee.downloader.allstar(dr=dr)
-
-    # Loading Data form FITS files
-    hdulist = fits.open(allstarpath)
+    # Loading memory-mapped columns of allStar
+    allstar_data = allstar_columns(dr=dr, columns=_ALLSTAR_COLUMNS)
     print('Now processing allStar DR{} catalog'.format(dr))
-    starflag = hdulist[1].data['STARFLAG']
-    aspcapflag = hdulist[1].data['ASPCAPFLAG']
-    vscatter = hdulist[1].data['VSCATTER']
-    SNR = hdulist[1].data['SNR']
-    location_id = hdulist[1].data['LOCATION_ID']
-    teff = hdulist[1].data['PARAM'][:, 0]
-    logg = hdulist[1].data['PARAM'][:, 1]
-    Fe = hdulist[1].data['X_H'][:, 17]
-
-    total = range(len(starflag))
-
-    if starflagcut is True:
-        DR_fitlered_starflag = np.where(starflag == 0)[0]
-    else:
-        DR_fitlered_starflag = total
 
-    if aspcapflagcut is True:
-        DR_fitlered_aspcapflag = np.where(aspcapflag == 0)[0]
-    else:
-        DR_fitlered_aspcapflag = total
-    DR_fitlered_temp_lower = np.where((tefflow <= teff))[0]
-    DR_fitlered_temp_upper = np.where((teffhigh >= teff))[0]
-    DR_fitlered_vscatter = np.where(vscatter < vscattercut)[0]
-    DR_fitlered_Fe = np.where(Fe > ironlow)[0]
-    DR_fitlered_logg = np.where(logg != -9999)[0]
-    DR_fitlered_snrlow = np.where(SNR > SNRtrain_low)[0]
-    DR_fitlered_snrhigh = np.where(SNR < SNRtrain_high)[0]
-    DR_fitlered_SNRtest_low = np.where(SNR > SNRtest_low)[0]
-    DR_fitlered_SNRtest_high = np.where(SNR < SNRtest_high)[0]
-
-    # There are some location_id=1 to avoid
-    DR14_fitlered_location = np.where(location_id > 1)[0]
-
-    # Here we found the common indices that satisfied all requirement
-    filtered_train_index = reduce(np.intersect1d, (DR_fitlered_starflag, DR_fitlered_aspcapflag, DR_fitlered_temp_lower,
-                                                   DR_fitlered_vscatter, DR_fitlered_Fe, DR_fitlered_logg,
-                                                   DR_fitlered_snrlow,
-                                                   DR_fitlered_snrhigh, DR14_fitlered_location, DR_fitlered_temp_upper))
-
-    filtered_test_index = reduce(np.intersect1d, (DR_fitlered_starflag, DR_fitlered_aspcapflag, DR_fitlered_temp_lower,
-                                                  DR_fitlered_vscatter, DR_fitlered_Fe, DR_fitlered_logg,
-                                                  DR_fitlered_SNRtest_low,
-                                                  DR_fitlered_SNRtest_high, DR14_fitlered_location,
-                                                  DR_fitlered_temp_upper))
-
-    print('Total entry after filtering: ', filtered_train_index.shape[0])
-    print('Total Visit there: ', np.sum(hdulist[1].data['NVISITS'][filtered_train_index]))
+    filtered_train_index, filtered_test_index = _apogee_selection(
+        allstar_data, starflagcut=starflagcut, aspcapflagcut=aspcapflagcut, vscattercut=vscattercut,
+        SNRtrain_low=SNRtrain_low, SNRtrain_high=SNRtrain_high, tefflow=tefflow, teffhigh=teffhigh, ironlow=ironlow,
+        SNRtest_low=SNRtest_low, SNRtest_high=SNRtest_high)
+
+    spec = []
+    SNR = []
+    RA = []
+    DEC = []
+    teff = []
+    logg = []
+    MH = []
+    alpha_M = []
+    C = []
+    Cl = []
+    N = []
+    O = []
+    Na = []
+    Mg = []
+    Al = []
+    Si = []
+    P = []
+    S = []
+    K = []
+    Ca = []
+    Ti = []
+    Ti2 = []
+    V = []
+    Cr = []
+    Mn = []
+    Fe = []
+    Ni = []
+    Cu = []
+    Ge = []
+    Rb = []
+    Y = []
+    Nd = []
+
+    # Every star is read only once even if it is in both the training and testing set
+    filtered_index = np.union1d(filtered_train_index, filtered_test_index)
+
+    print('Filtering the dataset according to the cuts you specified or default cuts')
+
+    warningflags, paths = bulk_spectra(dr=dr, location=allstar_data['LOCATION_ID'][filtered_index],
+                                       apogee=allstar_data['APOGEE_ID'][filtered_index], kind='visit',
+                                       workers=download_workers)
+
+    for counter, index in enumerate(filtered_index):
+        if warningflags[counter] == 0:
+            combined_file = open_spectra(paths[counter])
+            if combined_file is None:
+                continue
+            nvisits = combined_file[0].header['NVISITS']
+            # _spec = combined_file[1].data  # Pseudo-comtinumm normalized flux
+            # _spec = gap_delete(_spec, dr=14)  # Delete the gap between sensors
+            combined_file.close()
+
+            # spec.extend([_spec])
+            # SNR.extend([allstar_data['SNR'][index]])
+            # RA.extend([allstar_data['RA'][index]])
+            # DEC.extend([allstar_data['DEC'][index]])
+            # teff.extend([allstar_data['PARAM'][index, 0]])
+            # logg.extend([allstar_data['PARAM'][index, 1]])
+            # MH.extend([allstar_data['PARAM'][index, 3]])
+            # alpha_M.extend([allstar_data['PARAM'][index, 6]])
+            # C.extend([allstar_data['X_H'][index, 0]])
+            # Cl.extend([allstar_data['X_H'][index, 1]])
+            # N.extend([allstar_data['X_H'][index, 2]])
+            # O.extend([allstar_data['X_H'][index, 3]])
+            # Na.extend([allstar_data['X_H'][index, 4]])
+            # Mg.extend([allstar_data['X_H'][index, 5]])
+            # Al.extend([allstar_data['X_H'][index, 6]])
+            # Si.extend([allstar_data['X_H'][index, 7]])
+            # P.extend([allstar_data['X_H'][index, 8]])
+            # S.extend([allstar_data['X_H'][index, 9]])
+            # K.extend([allstar_data['X_H'][index, 10]])
+            # Ca.extend([allstar_data['X_H'][index, 11]])
+            # Ti.extend([allstar_data['X_H'][index, 12]])
+            # Ti2.extend([allstar_data['X_H'][index, 13]])
+            # V.extend([allstar_data['X_H'][index, 14]])
+            # Cr.extend([allstar_data['X_H'][index, 15]])
+            # Mn.extend([allstar_data['X_H'][index, 16]])
+            # Fe.extend([allstar_data['X_H'][index, 17]])
+            # Ni.extend([allstar_data['X_H'][index, 19]])
+            # Cu.extend([allstar_data['X_H'][index, 20]])
+            # Ge.extend([allstar_data['X_H'][index, 21]])
+            # Rb.extend([allstar_data['X_H'][index, 22]])
+            # Y.extend([allstar_data['X_H'][index, 23]])
+            # Nd.extend([allstar_data['X_H'][index, 24]])
 
     for tt in ['train', 'test']:
-        spec = []
-        SNR = []
-        RA = []
-        DEC = []
-        teff = []
-        logg = []
-        MH = []
-        alpha_M = []
-        C = []
-        Cl = []
-        N = []
-        O = []
-        Na = []
-        Mg = []
-        Al = []
-        Si = []
-        P = []
-        S = []
-        K = []
-        Ca = []
-        Ti = []
-        Ti2 = []
-        V = []
-        Cr = []
-        Mn = []
-        Fe = []
-        Ni = []
-        Cu = []
-        Ge = []
-        Rb = []
-        Y = []
-        Nd = []
-
-        # if tt == 'train':
-        #     filtered_index = filtered_train_index
-        # else:
-        #     filtered_index = filtered_test_index
-        filtered_index = np.concatenate((filtered_train_index, filtered_test_index))
-
-        print('Filtering the dataset according to the cuts you specified or default cuts for the {}ing dataset'.format(
-            tt))
-
-        for index in filtered_index:
-            apogee_id = hdulist[1].data['APOGEE_ID'][index]
-            location_id = hdulist[1].data['LOCATION_ID'][index]
-            warningflag, path = visit_spectra(dr=dr, location=location_id, apogee=apogee_id, verbose=0)
-            if warningflag is None:
-                combined_file = fits.open(path)
-                nvisits = combined_file[0].header['NVISITS']
-                # _spec = combined_file[1].data  # Pseudo-comtinumm normalized flux
-                # _spec = gap_delete(_spec, dr=14)  # Delete the gap between sensors
-                combined_file.close()
-
-                # spec.extend([_spec])
-                # SNR.extend([hdulist[1].data['SNR'][index]])
-                # RA.extend([hdulist[1].data['RA'][index]])
-                # DEC.extend([hdulist[1].data['DEC'][index]])
-                # teff.extend([hdulist[1].data['PARAM'][index, 0]])
-                # logg.extend([hdulist[1].data['PARAM'][index, 1]])
-                # MH.extend([hdulist[1].data['PARAM'][index, 3]])
-                # alpha_M.extend([hdulist[1].data['PARAM'][index, 6]])
-                # C.extend([hdulist[1].data['X_H'][index, 0]])
-                # Cl.extend([hdulist[1].data['X_H'][index, 1]])
-                # N.extend([hdulist[1].data['X_H'][index, 2]])
-                # O.extend([hdulist[1].data['X_H'][index, 3]])
-                # Na.extend([hdulist[1].data['X_H'][index, 4]])
-                # Mg.extend([hdulist[1].data['X_H'][index, 5]])
-                # Al.extend([hdulist[1].data['X_H'][index, 6]])
-                # Si.extend([hdulist[1].data['X_H'][index, 7]])
-                # P.extend([hdulist[1].data['X_H'][index, 8]])
-                # S.extend([hdulist[1].data['X_H'][index, 9]])
-                # K.extend([hdulist[1].data['X_H'][index, 10]])
-                # Ca.extend([hdulist[1].data['X_H'][index, 11]])
-                # Ti.extend([hdulist[1].data['X_H'][index, 12]])
-                # Ti2.extend([hdulist[1].data['X_H'][index, 13]])
-                # V.extend([hdulist[1].data['X_H'][index, 14]])
-                # Cr.extend([hdulist[1].data['X_H'][index, 15]])
-                # Mn.extend([hdulist[1].data['X_H'][index, 16]])
-                # Fe.extend([hdulist[1].data['X_H'][index, 17]])
-                # Ni.extend([hdulist[1].data['X_H'][index, 19]])
-                # Cu.extend([hdulist[1].data['X_H'][index, 20]])
-                # Ge.extend([hdulist[1].data['X_H'][index, 21]])
-                # Rb.extend([hdulist[1].data['X_H'][index, 22]])
-                # Y.extend([hdulist[1].data['X_H'][index, 23]])
-                # Nd.extend([hdulist[1].data['X_H'][index, 24]])
-
         print('Creating {}_{}.h5'.format(h5name, tt))
         h5f = h5py.File('{}_{}.h5'.format(h5name, tt), 'w')
         # h5f.create_dataset('spectra', data=spec)
@@ -482,13 +511,23 @@ def compile_apogee_apstar(h5name=None, dr=None, starflagcut=True, aspcapflagcut=
     return None
 
 
-def compile_gaia(h5name=None, gaia_dr=None, apogee_dr=None, SNR_low=100, vscattercut=1):
+def compile_gaia(h5name=None, gaia_dr=None, apogee_dr=None, SNR_low=100, vscattercut=1, block_size=256,
+                 chunk_rows=None, compression=None, compression_opts=None, spectra_dtype=None, download_workers=16,
+                 xmatch_workers=None):
     """
     NAME: compile_gaia
     PURPOSE: compile gaia data to a h5 file
     INPUT:
         gaia_dr= 1
         apogee_dr=14
+        block_size = number of spectra kept in memory before they are written to the h5 file
+        chunk_rows = number of spectra per h5 chunk, set it to the training batch size for fast random minibatch reads
+        compression = None, 'gzip' or 'lzf' compression of the h5 datasets
+        compression_opts = compression level for gzip (0-9)
+        spectra_dtype = dtype to store spectra with, i.e. 'float32' or 'float16', None to keep the dtype of the FITS
+        download_workers = number of concurrent downloads of spectra missing in the local mirror
+        xmatch_workers = number of processes to cross-match APOGEE and Gaia with, partitioned by HEALPix pixels
+                         (requires astropy_healpix), None to cross-match in this process
     OUTPUT: (just operations)
     HISTORY:
         2017-Nov-08 Henry Leung
@@ -497,89 +536,48 @@ def compile_gaia(h5name=None, gaia_dr=None, apogee_dr=None, SNR_low=100, vscatte
     apogee_dr = apogee_default_dr(dr=apogee_dr)
     gaia_dr = gaia_default_dr(dr=gaia_dr)
 
-    allstarpath = astroNN.apogee.downloader.allstar(dr=apogee_dr)
-    tgas_list = astroNN.gaia.downloader.tgas(dr=gaia_dr)
+    allstar_data = allstar_columns(dr=apogee_dr, columns=_ALLSTAR_COLUMNS)
+    # TGAS with positive parallax and parallax_error/parallax <= 0.2
+    tgas_data = tgas_load(dr=gaia_dr)
 
     tefflow = 4000
     teffhigh = 5500
 
-    hdulist = fits.open(allstarpath)
-    SNR = hdulist[1].data['SNR']
-    starflag = hdulist[1].data['STARFLAG']
-    aspcapflag = hdulist[1].data['ASPCAPFLAG']
-    vscatter = hdulist[1].data['VSCATTER']
-    location_id = hdulist[1].data['LOCATION_ID']
-    teff = hdulist[1].data['PARAM'][:, 0]
-
-    DR_fitlered_SNR_low = np.where(SNR > SNR_low)[0]
-    DR_fitlered_starflag = np.where(starflag == 0)[0]
-    DR_fitlered_aspcapflag = np.where(aspcapflag == 0)[0]
-    DR_fitlered_vscatter = np.where(vscatter < vscattercut)[0]
-    DR_fitlered_temp_lower = np.where((tefflow <= teff))[0]
-    DR_fitlered_temp_upper = np.where((teffhigh >= teff))[0]
-    # There are some location_id=1 to avoid
-    DR14_fitlered_location = np.where(location_id > 1)[0]
-
     # Here we found the common indices that satisfied all requirement
-    filtered_apogee_index = reduce(np.intersect1d, (DR14_fitlered_location, DR_fitlered_SNR_low, DR_fitlered_starflag,
-                                                    DR_fitlered_aspcapflag, DR_fitlered_vscatter, DR_fitlered_temp_lower,
-                                                    DR_fitlered_temp_upper))
-
-    ra_apogee = (hdulist[1].data['RA'])[filtered_apogee_index]
-    dec_apogee = (hdulist[1].data['DEC'])[filtered_apogee_index]
-    k_mag_apogee = (hdulist[1].data['K'])[filtered_apogee_index]
-    teff = (hdulist[1].data['PARAM'][:, 0])[filtered_apogee_index]
-
-    ra_gaia = np.array([])
-    dec_gaia = np.array([])
-    pmra_gaia = np.array([])
-    pmdec_gaia = np.array([])
-    parallax_gaia = np.array([])
-    parallax_error_gaia = np.array([])
-    mag_gaia = np.array([])
-
-    for i in tgas_list:
-        gaia = fits.open(i)
-        ra_gaia = np.concatenate((ra_gaia, gaia[1].data['RA']))
-        dec_gaia = np.concatenate((dec_gaia, gaia[1].data['DEC']))
-        pmra_gaia = np.concatenate((pmra_gaia, gaia[1].data['PMRA']))
-        pmdec_gaia = np.concatenate((pmdec_gaia, gaia[1].data['PMDEC']))
-        parallax_gaia = np.concatenate((parallax_gaia, gaia[1].data['parallax']))
-        parallax_error_gaia = np.concatenate((parallax_error_gaia, gaia[1].data['parallax_error']))
-        mag_gaia = np.concatenate((mag_gaia, gaia[1].data['phot_g_mean_mag']))
-
-    bad_index = np.where(parallax_gaia <= 0)
-    ra_gaia = np.delete(ra_gaia, bad_index)
-    dec_gaia = np.delete(dec_gaia, bad_index)
-    pmra_gaia = np.delete(pmra_gaia, bad_index)
-    pmdec_gaia = np.delete(pmdec_gaia, bad_index)
-    parallax_gaia = np.delete(parallax_gaia, bad_index)
-    parallax_error_gaia = np.delete(parallax_error_gaia, bad_index)
-    mag_gaia = np.delete(mag_gaia, bad_index)
-
-    bad_index = np.where((parallax_error_gaia / parallax_gaia) > 0.2)
-    ra_gaia = np.delete(ra_gaia, bad_index)
-    dec_gaia = np.delete(dec_gaia, bad_index)
-    pmra_gaia = np.delete(pmra_gaia, bad_index)
-    pmdec_gaia = np.delete(pmdec_gaia, bad_index)
-    parallax_gaia = np.delete(parallax_gaia, bad_index)
-    parallax_error_gaia = np.delete(parallax_error_gaia, bad_index)
-    # mag_gaia = np.delete(mag_gaia, bad_index)
-    # absmag = to_absmag(mag_gaia, parallax_gaia)
-
-    m1, m2, sep = astroNN.datasets.xmatch.xmatch(ra_apogee, ra_gaia, maxdist=2, colRA1=ra_apogee, colDec1=dec_apogee, epoch1=2000.,
-                         colRA2=ra_gaia, colDec2=dec_gaia, epoch2=2015., colpmRA2=pmra_gaia, colpmDec2=pmdec_gaia, swap=True)
+    filtered_apogee_index, _ = select(allstar_cuts(allstar_data, vscattercut=vscattercut, tefflow=tefflow,
+                                                   teffhigh=teffhigh) + snr_cuts(allstar_data, low=SNR_low))
+
+    ra_apogee = (allstar_data['RA'])[filtered_apogee_index]
+    dec_apogee = (allstar_data['DEC'])[filtered_apogee_index]
+    k_mag_apogee = (allstar_data['K'])[filtered_apogee_index]
+    teff = (allstar_data['PARAM'][:, 0])[filtered_apogee_index]
+
+    # tgas_data is fed to the cross-match as it is, m2 indexes its rows
+    ra_gaia, dec_gaia = tgas_data['ra'], tgas_data['dec']
+    if xmatch_workers is None:
+        m1, m2, sep = astroNN.datasets.xmatch.xmatch_kdtree(ra_apogee, ra_gaia, maxdist=2, colRA1=ra_apogee,
+                                                            colDec1=dec_apogee, epoch1=2000., colRA2=ra_gaia,
+                                                            colDec2=dec_gaia, epoch2=2015., colpmRA2=tgas_data['pmra'],
+                                                            colpmDec2=tgas_data['pmdec'], swap=True, cache=True)
+    else:
+        m1, m2, sep = astroNN.datasets.xmatch.xmatch_healpix(ra_apogee, ra_gaia, maxdist=2, colRA1=ra_apogee,
+                                                             colDec1=dec_apogee, epoch1=2000., colRA2=ra_gaia,
+                                                             colDec2=dec_gaia, epoch2=2015., colpmRA2=tgas_data['pmra'],
+                                                             colpmDec2=tgas_data['pmdec'], swap=True,
+                                                             workers=xmatch_workers, cache=True)
 
     #m2 fot Gaia, m1 for APOGEE
 
     print('Total Numer of matches: ', len(m1))
 
-    parallax_gaia_percent = (parallax_error_gaia / parallax_gaia)
+    parallax_gaia_percent = tgas_data['parallax_error'] / tgas_data['parallax']
 
     # train_len = int(len(m2)*0.6)
 
+    apogee_id = allstar_data['APOGEE_ID'][filtered_apogee_index]
+    location_id = allstar_data['LOCATION_ID'][filtered_apogee_index]
+
     for tt in ['train', 'test']:
-        spec = []
         if tt == 'train':
             filtered_index = np.where(parallax_gaia_percent[m2] >= 0.1)
             m1_1 = m1[filtered_index]
@@ -589,31 +587,25 @@ def compile_gaia(h5name=None, gaia_dr=None, apogee_dr=None, SNR_low=100, vscatte
             m1_1 = m1[filtered_index]
             m2_2 = m2[filtered_index]
 
-        absmag = to_absmag(k_mag_apogee[m1_1], parallax_gaia[m2_2])
-        for index in m1_1:
-            apogee_id = ((hdulist[1].data['APOGEE_ID'])[filtered_apogee_index])[index]
-            location_id = ((hdulist[1].data['LOCATION_ID'])[filtered_apogee_index])[index]
-
-            warningflag = None
-            if apogee_dr == 14:
-                filename = 'aspcapStar-r8-l31c.2-{}.fits'.format(apogee_id)
-                path = os.path.join(_APOGEE_DATA, 'dr14/apogee/spectro/redux/r8/stars/l31c/l31c.2/', str(location_id),
-                                    filename)
-                if not os.path.exists(path):
-                    warningflag = astroNN.apogee.downloader.combined_spectra(dr=apogee_dr, location=location_id,
-                                                                                  apogee=apogee_id)
-            else:
-                raise ValueError('astroNN only supports DR13 and DR14 APOGEE')
-            if warningflag is None:
-                combined_file = fits.open(path)
-                _spec = combined_file[1].data  # Pseudo-comtinumm normalized flux
-                _spec = gap_delete(_spec, dr=apogee_dr)
-                spec.extend([_spec])
+        absmag = to_absmag(k_mag_apogee[m1_1], tgas_data['parallax'][m2_2])
 
         print('Creating {}_{}.h5'.format(h5name, tt))
-        h5f = h5py.File('{}_{}.h5'.format(h5name, tt), 'w')
-        h5f.create_dataset('spectra', data=spec)
-        h5f.create_dataset('teff', data=teff[m1_1])
-        h5f.create_dataset('absmag', data=absmag)
+        writer = H5BlockWriter('{}_{}.h5'.format(h5name, tt), block_size=block_size,
+                               table={'teff': teff[m1_1], 'absmag': absmag}, chunk_rows=chunk_rows,
+                               compression=compression, compression_opts=compression_opts,
+                               dtypes={'spectra': spectra_dtype} if spectra_dtype is not None else None)
+
+        warningflags, paths = bulk_spectra(dr=apogee_dr, location=location_id[m1_1], apogee=apogee_id[m1_1],
+                                           kind='combined', workers=download_workers)
+
+        for counter, path in enumerate(paths):
+            if warningflags[counter] == 0:
+                combined_file = open_spectra(path)
+                if combined_file is None:
+                    continue
+                with combined_file:
+                    _spec = combined_file[1].data  # Pseudo-comtinumm normalized flux
+                    writer.append(row=counter, spectra=gap_delete(_spec, dr=apogee_dr))
+        writer.close()
 
     return None
@@ -0,0 +1,153 @@
+# ---------------------------------------------------------#
+#   astroNN.datasets.h5_tools: tools to read and write h5 datasets
+# ---------------------------------------------------------#
+
+import h5py
+import numpy as np
+
+
+class H5BlockWriter(object):
+    """
+    NAME: H5BlockWriter
+    PURPOSE: stream rows into resizable, chunked h5 datasets in fixed size blocks, so peak memory is bounded by the
+             block size instead of the size of the whole dataset
+    INPUT:
+        filename = name of the h5 file to create
+        block_size = number of rows kept in memory before they are written to disk
+        table = dictionary of name to array known in advance (i.e. labels), rows of it are written together with the
+                streamed rows according to the row argument of append()
+        mode = 'w' to create a new file, 'a' to append to the datasets of an existing file
+        chunk_rows = number of rows in a chunk of the streamed datasets, set it to the training batch size so a random
+                     minibatch touches as few chunks as possible, default to min(block_size, 64)
+        compression = None, 'gzip' or 'lzf'
+        compression_opts = compression level for gzip (0-9)
+        dtypes = dictionary of name to dtype to store the streamed datasets with, i.e. {'spectra': 'float16'}
+    HISTORY:
+        2017-Nov-17 Henry Leung
+    """
+    def __init__(self, filename, block_size=256, table=None, mode='w', chunk_rows=None, compression=None,
+                 compression_opts=None, dtypes=None):
+        self.filename = filename
+        self.block_size = block_size
+        self.table = table if table is not None else {}
+        self.chunk_rows = chunk_rows if chunk_rows is not None else min(block_size, 64)
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.dtypes = dtypes if dtypes is not None else {}
+        self.length = 0  # number of rows already written to disk
+        self.h5f = h5py.File(filename, mode)
+        self._buffer = {}
+        self._rows = np.zeros(block_size, dtype=np.int64)
+        self._filled = 0
+        if mode != 'w':
+            self._truncate()
+        else:
+            # Storage options are recorded so loaders know how the file was written
+            self.h5f.attrs['chunk_rows'] = self.chunk_rows
+            self.h5f.attrs['compression'] = compression if compression is not None else 'none'
+            for name, dtype in self.dtypes.items():
+                self.h5f.attrs['{}_dtype'.format(name)] = np.dtype(dtype).name
+
+    def _truncate(self):
+        # An interrupted flush can leave datasets with different length, only rows written to all of them are kept
+        lengths = [dataset.shape[0] for dataset in self.h5f.values() if isinstance(dataset, h5py.Dataset)]
+        if lengths:
+            self.length = min(lengths)
+            for dataset in self.h5f.values():
+                if isinstance(dataset, h5py.Dataset) and dataset.shape[0] > self.length:
+                    dataset.resize(self.length, axis=0)
+
+    def _create(self, name, shape, dtype):
+        dtype = np.dtype(dtype).newbyteorder('=')
+        self.h5f.create_dataset(name, shape=(0,) + shape, maxshape=(None,) + shape, dtype=dtype,
+                                chunks=(self.chunk_rows,) + shape if shape else (self.block_size,),
+                                compression=self.compression, compression_opts=self.compression_opts)
+
+    def append(self, row=None, **data):
+        """
+        NAME: append
+        PURPOSE: buffer one row, the block is written to disk when the buffer is full
+        INPUT:
+            row = index of this row in table, only required if table is given
+            data = name of the dataset to array of this row, i.e. spectra=spec
+        OUTPUT: None
+        HISTORY:
+            2017-Nov-17 Henry Leung
+        """
+        for name, value in data.items():
+            if name not in self._buffer:
+                value = np.asarray(value)
+                dtype = np.dtype(self.dtypes.get(name, value.dtype)).newbyteorder('=')
+                self._buffer[name] = np.empty((self.block_size,) + value.shape, dtype=dtype)
+            self._buffer[name][self._filled] = value
+        if row is not None:
+            self._rows[self._filled] = row
+        self._filled += 1
+        if self._filled == self.block_size:
+            self.flush()
+        return None
+
+    def flush(self):
+        """
+        NAME: flush
+        PURPOSE: write the buffered block to disk
+        INPUT:
+        OUTPUT: None
+        HISTORY:
+            2017-Nov-17 Henry Leung
+        """
+        if self._filled == 0:
+            return None
+        blocks = [(name, buffer[:self._filled]) for name, buffer in self._buffer.items()]
+        rows = self._rows[:self._filled]
+        blocks.extend([(name, np.asarray(column)[rows]) for name, column in self.table.items()])
+
+        for name, block in blocks:
+            if name not in self.h5f:
+                self._create(name, block.shape[1:], block.dtype)
+            dataset = self.h5f[name]
+            dataset.resize(self.length + self._filled, axis=0)
+            dataset[self.length:] = block
+        self.length += self._filled
+        self._filled = 0
+        self.h5f.flush()
+        return None
+
+    def close(self):
+        """
+        NAME: close
+        PURPOSE: write the remaining rows and close the h5 file
+        INPUT:
+        OUTPUT: None
+        HISTORY:
+            2017-Nov-17 Henry Leung
+        """
+        self.flush()
+        # Still create the table datasets even if no row was written at all
+        for name, column in self.table.items():
+            if name not in self.h5f:
+                column = np.asarray(column)
+                self._create(name, column.shape[1:], column.dtype)
+        self.h5f.close()
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def load_spectra(F, name='spectra'):
+    """
+    NAME: load_spectra
+    PURPOSE: load spectra from a compiled h5 file, spectra stored with reduced precision are promoted to float32
+    INPUT:
+        F = opened h5 file
+        name = name of the spectra dataset
+    OUTPUT: spectra array
+    HISTORY:
+        2017-Nov-18 Henry Leung
+    """
+    dtype = np.promote_types(F[name].dtype, np.float32)
+    return np.asarray(F[name][()], dtype=dtype)
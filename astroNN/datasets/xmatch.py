@@ -2,11 +2,94 @@
 #   astroNN.datasets.xmatch: matching function between catalog
 # ---------------------------------------------------------#
 
+import hashlib
+import os
+import tempfile
+from multiprocessing import Pool
+
 import astropy.coordinates as acoords
 import numpy as np
 from astropy import units as u
 
 
+# Default directory of cached cross-match results
+_XMATCH_CACHE = os.path.join(os.path.expanduser('~'), '.astroNN', 'cache', 'xmatch')
+
+# Pixel ordering of the HEALPix partitions of xmatch_healpix()
+_HEALPIX_ORDER = 'nested'
+
+
+def _fingerprint(kwargs, name, block_size=4000000):
+    """
+    NAME:
+       _fingerprint
+    PURPOSE:
+       sha1 of everything a cross-match result depends on, coordinates are hashed in blocks so h5py datasets are
+       never read into memory at once
+    INPUT:
+       kwargs = arguments of the cross-match
+       name = name of the cross-match function, matchers can break ties differently so they never share results
+    OUTPUT:
+       hex digest
+    HISTORY:
+       2017-Nov-26 - Written - Henry Leung (University of Toronto)
+    """
+    sha1 = hashlib.sha1()
+    sha1.update('{}:'.format(name).encode('ascii'))
+    if 'nside' in kwargs:
+        # Partitions of xmatch_healpix()
+        sha1.update('{}:{}:'.format(int(kwargs['nside']), _HEALPIX_ORDER).encode('ascii'))
+    depoch = kwargs['epoch2'] - kwargs['epoch1']
+    sha1.update(repr((float(kwargs['maxdist']), float(kwargs['epoch1']), float(kwargs['epoch2']),
+                      bool(kwargs['swap']))).encode('ascii'))
+    columns = ['colRA1', 'colDec1', 'colRA2', 'colDec2']
+    if depoch != 0.:
+        # Proper motions only matter if they are used
+        columns.extend(['colpmRA2', 'colpmDec2'])
+    for name in columns:
+        column = kwargs[name]
+        sha1.update('{}:{}'.format(name, len(column)).encode('ascii'))
+        for start in range(0, len(column), block_size):
+            sha1.update(np.ascontiguousarray(column[start:start + block_size], dtype=np.float64).tobytes())
+    return sha1.hexdigest()
+
+
+def _cached_xmatch(cache, func, kwargs):
+    """
+    NAME:
+       _cached_xmatch
+    PURPOSE:
+       return the cached result of a cross-match if its inputs were matched before, otherwise match and cache it
+    INPUT:
+       cache = True to cache in ~/.astroNN/cache/xmatch or a directory
+       func = cross-match function
+       kwargs = arguments of func
+    OUTPUT:
+       (m1, m2, sep)
+    HISTORY:
+       2017-Nov-26 - Written - Henry Leung (University of Toronto)
+    """
+    cachedir = _XMATCH_CACHE if cache is True else cache
+    path = os.path.join(cachedir, '{}.npz'.format(_fingerprint(kwargs, func.__name__)))
+    if os.path.isfile(path):
+        with np.load(path) as cached:
+            return cached['m1'], cached['m2'], acoords.Angle(cached['sep'], unit=u.degree)
+
+    m1, m2, sep = func(cache=False, **kwargs)
+    if not os.path.exists(cachedir):
+        os.makedirs(cachedir)
+    # Each writer has its own temporary file, processes caching the same match never write into each other's file
+    fd, temppath = tempfile.mkstemp(suffix='.tmp', dir=cachedir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, m1=m1, m2=m2, sep=sep.to(u.degree).value)
+        os.replace(temppath, path)
+    except BaseException:
+        os.remove(temppath)
+        raise
+    return m1, m2, sep
+
+
 # ---------------------------------------------------------#
 #   Please notice that astroNN.datasets.xmatch.xmatch() is a modification from Jo Bovy's gaia_tools
 #   If you found this xmatch function useful, please take a look at https://github.com/jobovy/gaia_tools/
@@ -14,7 +97,7 @@ from astropy import units as u
 
 
 def xmatch(cat1, cat2, maxdist=2, colRA1=1, colDec1=1, epoch1=2000., colRA2=1, colDec2=1, epoch2=2000.,
-           colpmRA2=1, colpmDec2=1, swap=False):
+           colpmRA2=1, colpmDec2=1, swap=False, cache=False):
     """
     NAME:
        xmatch
@@ -37,6 +120,8 @@ def xmatch(cat1, cat2, maxdist=2, colRA1=1, colDec1=1, epoch1=2000., colRA2=1, c
                             be ICRS) [only used when epochs are different]
        swap= (False) if False, find closest matches in cat2 for each cat1 source, if False do the opposite (important
                       when one of the catalogs has duplicates)
+       cache= (False) True to keep the result in ~/.astroNN/cache/xmatch (or a directory to keep it there), a later
+                      call with the same coordinates, epochs, maxdist and swap returns it without matching again
     OUTPUT:
        (index into cat1 of matching objects,
         index into cat2 of matching objects,
@@ -45,6 +130,10 @@ def xmatch(cat1, cat2, maxdist=2, colRA1=1, colDec1=1, epoch1=2000., colRA2=1, c
        2016-09-12 - Written - Bovy (UofT)
        2016-09-21 - Account for Gaia epoch 2015 - Bovy (UofT)
     """
+    if cache is not False:
+        return _cached_xmatch(cache, xmatch, dict(cat1=cat1, cat2=cat2, maxdist=maxdist, colRA1=colRA1,
+                                                  colDec1=colDec1, epoch1=epoch1, colRA2=colRA2, colDec2=colDec2,
+                                                  epoch2=epoch2, colpmRA2=colpmRA2, colpmDec2=colpmDec2, swap=swap))
 
     depoch = epoch2 - epoch1
     if depoch != 0.:
@@ -70,3 +159,225 @@ def xmatch(cat1, cat2, maxdist=2, colRA1=1, colDec1=1, epoch1=2000., colRA2=1, c
         return (m2, m1, d2d[mindx])
     else:
         return (m1, m2, d2d[mindx])
+
+
+def _unit_vectors(ra, dec):
+    ra = np.radians(np.asarray(ra, dtype=np.float64))
+    dec = np.radians(np.asarray(dec, dtype=np.float64))
+    cos_dec = np.cos(dec)
+    return np.stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)], axis=-1)
+
+
+def _epoch_shift(ra, dec, pmra, pmdec, depoch):
+    # Same proper motion correction as xmatch(), pmra includes cos(Dec) and both are in mas/yr
+    if depoch == 0.:
+        return ra, dec
+    dra = pmra / np.cos(dec / 180. * np.pi) / 3600000. * depoch
+    ddec = pmdec / 3600000. * depoch
+    return ra - dra, dec - ddec
+
+
+def xmatch_kdtree(cat1, cat2, maxdist=2, colRA1=1, colDec1=1, epoch1=2000., colRA2=1, colDec2=1, epoch2=2000.,
+                  colpmRA2=1, colpmDec2=1, swap=False, chunk_size=1000000, cache=False):
+    """
+    NAME:
+       xmatch_kdtree
+    PURPOSE:
+       cross-match two catalogs like xmatch() but with a k-d tree on unit vectors, cat2 is processed in chunks so it
+       can be much larger than cat1 (i.e. APOGEE x Gaia) with bounded memory, and can be h5py datasets on disk
+    INPUT:
+       same as xmatch(), colRA1/colDec1/colRA2/colDec2/colpmRA2/colpmDec2 are arrays
+       chunk_size= (1000000) number of cat2 sources processed at once
+       cache= (False) same as xmatch()
+    OUTPUT:
+       (index into cat1 of matching objects,
+        index into cat2 of matching objects,
+        angular separation between matching objects)
+    HISTORY:
+       2017-Nov-25 - Written - Henry Leung (University of Toronto)
+    """
+    from scipy.spatial import cKDTree
+
+    if cache is not False:
+        return _cached_xmatch(cache, xmatch_kdtree, dict(cat1=cat1, cat2=cat2, maxdist=maxdist, colRA1=colRA1,
+                                                         colDec1=colDec1, epoch1=epoch1, colRA2=colRA2,
+                                                         colDec2=colDec2, epoch2=epoch2, colpmRA2=colpmRA2,
+                                                         colpmDec2=colpmDec2, swap=swap, chunk_size=chunk_size))
+
+    depoch = epoch2 - epoch1
+    # Distance between unit vectors (chord) of two points separated by maxdist on the sky
+    max_chord = 2. * np.sin(np.radians(maxdist / 3600.) / 2.)
+
+    n1 = len(colRA1)
+    n2 = len(colRA2)
+    tree1 = cKDTree(_unit_vectors(colRA1, colDec1))
+
+    if swap:
+        # Nearest cat1 source for each cat2 source, every chunk of cat2 queries the tree of cat1
+        m1, m2, chord = [], [], []
+        for start in range(0, n2, chunk_size):
+            stop = min(start + chunk_size, n2)
+            ra2, dec2 = _epoch_shift(np.asarray(colRA2[start:stop]), np.asarray(colDec2[start:stop]),
+                                     None if depoch == 0. else np.asarray(colpmRA2[start:stop]),
+                                     None if depoch == 0. else np.asarray(colpmDec2[start:stop]), depoch)
+            distance, index = tree1.query(_unit_vectors(ra2, dec2), k=1, distance_upper_bound=max_chord)
+            matched = np.nonzero(distance < max_chord)[0]
+            m1.append(index[matched])
+            m2.append(matched + start)
+            chord.append(distance[matched])
+        m1 = np.concatenate(m1) if m1 else np.array([], dtype=np.int64)
+        m2 = np.concatenate(m2) if m2 else np.array([], dtype=np.int64)
+        chord = np.concatenate(chord) if chord else np.array([])
+    else:
+        # Nearest cat2 source for each cat1 source, the best match so far is kept while cat2 is streamed in chunks
+        best_chord = np.full(n1, np.inf)
+        best_index = np.full(n1, -1, dtype=np.int64)
+        xyz1 = tree1.data
+        for start in range(0, n2, chunk_size):
+            stop = min(start + chunk_size, n2)
+            ra2, dec2 = _epoch_shift(np.asarray(colRA2[start:stop]), np.asarray(colDec2[start:stop]),
+                                     None if depoch == 0. else np.asarray(colpmRA2[start:stop]),
+                                     None if depoch == 0. else np.asarray(colpmDec2[start:stop]), depoch)
+            distance, index = cKDTree(_unit_vectors(ra2, dec2)).query(xyz1, k=1, distance_upper_bound=max_chord)
+            better = distance < best_chord
+            best_chord[better] = distance[better]
+            best_index[better] = index[better] + start
+        m1 = np.nonzero(best_chord < max_chord)[0]
+        m2 = best_index[m1]
+        chord = best_chord[m1]
+
+    sep = acoords.Angle(np.degrees(2. * np.arcsin(np.clip(chord / 2., 0., 1.))), unit=u.degree)
+    return m1, m2, sep
+
+
+def _xmatch_partition(job):
+    """
+    NAME:
+       _xmatch_partition
+    PURPOSE:
+       match one partition of the sky, picklable so it can run in a process pool
+    INPUT:
+       job = (unit vectors of cat1 sources in the partition and its neighbours, their index in cat1,
+              unit vectors of cat2 sources in the partition, their index in cat2, maximum chord, swap)
+    OUTPUT:
+       (index into cat1, index into cat2, chord) of the nearest match in this partition
+    HISTORY:
+       2017-Nov-25 - Written - Henry Leung (University of Toronto)
+    """
+    from scipy.spatial import cKDTree
+
+    xyz1, index1, xyz2, index2, max_chord, swap = job
+    if swap:
+        distance, index = cKDTree(xyz1).query(xyz2, k=1, distance_upper_bound=max_chord)
+        matched = np.nonzero(distance < max_chord)[0]
+        return index1[index[matched]], index2[matched], distance[matched]
+    else:
+        distance, index = cKDTree(xyz2).query(xyz1, k=1, distance_upper_bound=max_chord)
+        matched = np.nonzero(distance < max_chord)[0]
+        return index1[matched], index2[index[matched]], distance[matched]
+
+
+def xmatch_healpix(cat1, cat2, maxdist=2, colRA1=1, colDec1=1, epoch1=2000., colRA2=1, colDec2=1, epoch2=2000.,
+                   colpmRA2=1, colpmDec2=1, swap=False, nside=64, workers=None, block_size=4000000, cache=False):
+    """
+    NAME:
+       xmatch_healpix
+    PURPOSE:
+       cross-match two catalogs like xmatch() with the sky partitioned by HEALPix pixels, partitions are matched in
+       parallel processes. cat1 sources are copied to the neighbouring pixels of their own so matches across pixel
+       boundaries are found. cat2 is read in blocks so it can be h5py datasets larger than memory (i.e. gaia_source)
+       Requires astropy_healpix (pip install astropy_healpix)
+    INPUT:
+       same as xmatch(), colRA1/colDec1/colRA2/colDec2/colpmRA2/colpmDec2 are arrays
+       nside= (64) HEALPix nside of the partitions, pixels must be much larger than maxdist
+       workers= (None) number of processes, None or 1 to match in this process
+       block_size= (4000000) number of cat2 sources read at once
+       cache= (False) same as xmatch()
+    OUTPUT:
+       (index into cat1 of matching objects,
+        index into cat2 of matching objects,
+        angular separation between matching objects)
+    HISTORY:
+       2017-Nov-25 - Written - Henry Leung (University of Toronto)
+    """
+    if cache is not False:
+        return _cached_xmatch(cache, xmatch_healpix, dict(cat1=cat1, cat2=cat2, maxdist=maxdist, colRA1=colRA1,
+                                                          colDec1=colDec1, epoch1=epoch1, colRA2=colRA2,
+                                                          colDec2=colDec2, epoch2=epoch2, colpmRA2=colpmRA2,
+                                                          colpmDec2=colpmDec2, swap=swap, nside=nside,
+                                                          workers=workers, block_size=block_size))
+
+    try:
+        import astropy_healpix
+    except ImportError:
+        raise ImportError('xmatch_healpix() requires astropy_healpix, please install it with pip install '
+                          'astropy_healpix or use xmatch_kdtree()')
+
+    if astropy_healpix.nside_to_pixel_resolution(nside).to(u.arcsec).value < 4. * maxdist:
+        raise ValueError('HEALPix pixels of nside={} are too small for maxdist={} arcsec'.format(nside, maxdist))
+
+    depoch = epoch2 - epoch1
+    max_chord = 2. * np.sin(np.radians(maxdist / 3600.) / 2.)
+    n1 = len(colRA1)
+    n2 = len(colRA2)
+
+    # Every cat1 source is copied to its own pixel and the neighbouring pixels, sorted by pixel
+    ra1 = np.asarray(colRA1, dtype=np.float64)
+    dec1 = np.asarray(colDec1, dtype=np.float64)
+    xyz1 = _unit_vectors(ra1, dec1)
+    pixel1 = astropy_healpix.lonlat_to_healpix(ra1 * u.degree, dec1 * u.degree, nside, order=_HEALPIX_ORDER)
+    with np.errstate(invalid='ignore'):
+        # Missing neighbours at the corners of the base pixels are -1
+        neighbours = astropy_healpix.neighbours(pixel1, nside, order=_HEALPIX_ORDER)
+    copy_pixel = np.concatenate([pixel1[np.newaxis, :], neighbours]).ravel()
+    copy_index = np.tile(np.arange(n1), neighbours.shape[0] + 1)
+    valid = copy_pixel >= 0
+    copy_pixel, copy_index = copy_pixel[valid], copy_index[valid]
+    order = np.argsort(copy_pixel, kind='mergesort')
+    copy_pixel, copy_index = copy_pixel[order], copy_index[order]
+
+    def jobs():
+        for start in range(0, n2, block_size):
+            stop = min(start + block_size, n2)
+            ra2, dec2 = _epoch_shift(np.asarray(colRA2[start:stop], dtype=np.float64),
+                                     np.asarray(colDec2[start:stop], dtype=np.float64),
+                                     None if depoch == 0. else np.asarray(colpmRA2[start:stop]),
+                                     None if depoch == 0. else np.asarray(colpmDec2[start:stop]), depoch)
+            pixel2 = astropy_healpix.lonlat_to_healpix(ra2 * u.degree, dec2 * u.degree, nside, order=_HEALPIX_ORDER)
+            order2 = np.argsort(pixel2, kind='mergesort')
+            pixel2 = pixel2[order2]
+            xyz2 = _unit_vectors(ra2, dec2)[order2]
+            index2 = order2 + start
+            # Each job is a contiguous range of pixels, the nearest source among all cat1 sources copied to those
+            # pixels is the true nearest because every cat1 source within maxdist of a pixel is copied to it
+            n_jobs = max(1, (workers if workers is not None else 1) * 4)
+            bounds = np.unique(pixel2[np.linspace(0, pixel2.shape[0], n_jobs + 1, dtype=np.int64)[1:-1]])
+            edges = np.concatenate([[pixel2[0]], bounds, [pixel2[-1] + 1]]) if pixel2.shape[0] > 0 else []
+            for low, high in zip(edges[:-1], edges[1:]):
+                select2 = slice(np.searchsorted(pixel2, low), np.searchsorted(pixel2, high))
+                index1 = np.unique(copy_index[np.searchsorted(copy_pixel, low):np.searchsorted(copy_pixel, high)])
+                if index1.shape[0] == 0 or select2.stop == select2.start:
+                    continue
+                yield xyz1[index1], index1, xyz2[select2], index2[select2], max_chord, swap
+
+    if workers is None or workers <= 1:
+        results = [_xmatch_partition(job) for job in jobs()]
+    else:
+        with Pool(processes=workers) as pool:
+            results = list(pool.imap_unordered(_xmatch_partition, jobs()))
+
+    m1 = np.concatenate([result[0] for result in results]) if results else np.array([], dtype=np.int64)
+    m2 = np.concatenate([result[1] for result in results]) if results else np.array([], dtype=np.int64)
+    chord = np.concatenate([result[2] for result in results]) if results else np.array([])
+
+    if swap:
+        # Every cat2 source is in exactly one partition
+        order = np.argsort(m2)
+    else:
+        # A cat1 source can match in several partitions, only its nearest match is kept
+        order = np.lexsort((chord, m1))
+        order = order[np.concatenate([[True], m1[order][1:] != m1[order][:-1]])] if order.shape[0] > 0 else order
+    m1, m2, chord = m1[order], m2[order], chord[order]
+
+    sep = acoords.Angle(np.degrees(2. * np.arcsin(np.clip(chord / 2., 0., 1.))), unit=u.degree)
+    return m1, m2, sep
@@ -0,0 +1,212 @@
+# ---------------------------------------------------------#
+#   astroNN.gaia.catalogs: load gaia catalogs
+# ---------------------------------------------------------#
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import h5py
+import numpy as np
+from astropy.io import fits
+
+from astroNN.gaia.downloader import gaia_source_files, tgas
+from astroNN.gaia.gaia_shared import gaia_env, gaia_default_dr
+from astroNN.shared.downloader_tools import fetch
+from astroNN.shared.inventory import mirror_inventory, mirror_quota
+
+_GAIA_DATA = gaia_env()
+
+# Columns of gaia_source kept in the h5 store
+_GAIA_SOURCE_COLUMNS = ('ra', 'dec', 'pmra', 'pmdec', 'parallax', 'parallax_error', 'phot_g_mean_mag')
+
+# Columns of TGAS loaded by tgas_load()
+_TGAS_COLUMNS = _GAIA_SOURCE_COLUMNS
+
+
+def gaia_source_h5(dr=None):
+    """
+    NAME: gaia_source_h5
+    PURPOSE: path of the h5 store of gaia_source
+    INPUT:
+        dr = 1
+    OUTPUT: full path
+    HISTORY:
+        2017-Nov-24 Henry Leung
+    """
+    dr = gaia_default_dr(dr=dr)
+    return os.path.join(_GAIA_DATA, 'Gaia/gaia_source/astroNN_gaia_source_dr{}.h5'.format(dr))
+
+
+def _open_store(h5filename, columns, chunk_rows):
+    h5f = h5py.File(h5filename, 'a')
+    if 'rows' not in h5f.attrs:
+        for name in columns:
+            h5f.create_dataset(name, shape=(0,), maxshape=(None,), dtype=np.float64, chunks=(chunk_rows,))
+        h5f.create_dataset('ingest/chunk', shape=(0,), maxshape=(None,), dtype='S64', chunks=(256,))
+        h5f.create_dataset('ingest/stop', shape=(0,), maxshape=(None,), dtype=np.int64, chunks=(256,))
+        h5f.attrs['rows'] = 0
+    else:
+        # Anything written after the last committed chunk belongs to an interrupted chunk and is dropped
+        rows = h5f.attrs['rows']
+        committed = np.count_nonzero(h5f['ingest/stop'][()] <= rows)
+        for name in columns:
+            h5f[name].resize(rows, axis=0)
+        h5f['ingest/chunk'].resize(committed, axis=0)
+        h5f['ingest/stop'].resize(committed, axis=0)
+    return h5f
+
+
+def _ingest_chunk(h5f, columns, chunkname, path):
+    with fits.open(path, memmap=True) as hdulist:
+        data = hdulist[1].data
+        block = {name: np.asarray(data[name], dtype=np.float64) for name in columns}
+    rows = h5f.attrs['rows']
+    length = block[columns[0]].shape[0]
+    for name in columns:
+        h5f[name].resize(rows + length, axis=0)
+        h5f[name][rows:] = block[name]
+    for name, value in (('ingest/chunk', chunkname.encode('ascii')), ('ingest/stop', rows + length)):
+        h5f[name].resize(h5f[name].shape[0] + 1, axis=0)
+        h5f[name][-1] = value
+    # The chunk only counts once the row count is committed, everything above is dropped when restarting
+    h5f.attrs['rows'] = rows + length
+    h5f.flush()
+
+
+def gaia_source_ingest(dr=None, workers=8, batch=16, keep_fits=False, chunk_rows=65536, quota=None):
+    """
+    NAME: gaia_source_ingest
+    PURPOSE: download all gaia_source files concurrently and append the columns astroNN uses to a single chunked
+             h5 store, one FITS file at a time. The next batch of files is downloaded while the current one is ingested.
+             Ingest is restartable, files already in the store are skipped and a file interrupted in the middle is
+             ingested again from scratch
+    INPUT:
+        dr = 1
+        workers = number of concurrent connections
+        batch = number of files downloaded ahead of the ingest, bounds the disk space used by FITS files
+        keep_fits = True to keep the FITS files in the local mirror, False to delete each after ingest
+        chunk_rows = number of rows in a h5 chunk
+        quota = disk quota of the local mirror in bytes or a string like '500G', None to use ASTRONN_MIRROR_QUOTA,
+                kept FITS files are evicted least recently used first, except the batch being downloaded
+    OUTPUT: full path of the h5 store
+    HISTORY:
+        2017-Nov-24 Henry Leung
+    """
+    dr = gaia_default_dr(dr=dr)
+    h5filename = gaia_source_h5(dr=dr)
+    jobs = gaia_source_files(dr=dr)
+    columns = list(_GAIA_SOURCE_COLUMNS)
+    if not os.path.exists(os.path.dirname(jobs[0][1])):
+        os.makedirs(os.path.dirname(jobs[0][1]))
+
+    h5f = _open_store(h5filename, columns, chunk_rows)
+    inventory = mirror_inventory(_GAIA_DATA)
+    quota = mirror_quota(quota)
+    try:
+        done = set(h5f['ingest/chunk'][()].astype(str).tolist())
+        jobs = [job for job in jobs if os.path.basename(job[1]) not in done]
+        print('{} of {} gaia_source files already in {}, {} to ingest'.format(len(done), len(done) + len(jobs),
+                                                                           h5filename, len(jobs)))
+        batches = [jobs[i:i + batch] for i in range(0, len(jobs), batch)]
+
+        def download(batch_jobs):
+            missing = [job for job in batch_jobs if not os.path.isfile(job[1])]
+            flags = dict(zip([job[1] for job in missing], fetch(missing, connections=workers)))
+            return [flags.get(job[1]) for job in batch_jobs]
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(download, batches[0]) if batches else None
+            for counter, batch_jobs in enumerate(batches):
+                flags = future.result()
+                if counter + 1 < len(batches):
+                    future = executor.submit(download, batches[counter + 1])
+                ingested = []
+                for (url, path), flag in zip(batch_jobs, flags):
+                    if flag is not None:
+                        print('{} cannot be downloaded, skipped, run again later to ingest it'.format(url))
+                        continue
+                    _ingest_chunk(h5f, columns, os.path.basename(path), path)
+                    if keep_fits is False:
+                        os.remove(path)
+                    ingested.append(path)
+                if keep_fits is True:
+                    # Kept FITS files go through the same inventory and quota as the rest of the mirror, the saved
+                    # inventory is only merged with during the ingest if files have to be evicted to bound disk use
+                    inventory.add(ingested, save=False)
+                    if quota is not None:
+                        keep = [job[1] for job in batches[counter + 1]] if counter + 1 < len(batches) else []
+                        inventory.evict(quota=quota, keep=keep)
+                else:
+                    # Files kept by an earlier ingest may be in the inventory
+                    inventory.remove(ingested, save=False)
+                print('Ingested {} of {} batches, {} rows in total'.format(counter + 1, len(batches),
+                                                                          h5f.attrs['rows']))
+    finally:
+        h5f.close()
+        inventory.save()
+
+    return h5filename
+
+
+def gaia_source_load(dr=None, columns=None, in_memory=True):
+    """
+    NAME: gaia_source_load
+    PURPOSE: load columns of gaia_source from the h5 store made by gaia_source_ingest()
+    INPUT:
+        dr = 1
+        columns = list of columns, default to all of ra, dec, pmra, pmdec, parallax, parallax_error, phot_g_mean_mag
+        in_memory = True to read the columns into numpy arrays, False to return h5py datasets to read in blocks
+    OUTPUT: dictionary of column name to array (the h5 file stays open if in_memory is False)
+    HISTORY:
+        2017-Nov-24 Henry Leung
+    """
+    h5filename = gaia_source_h5(dr=dr)
+    if not os.path.isfile(h5filename):
+        raise FileNotFoundError('{} does not exist, run astroNN.gaia.catalogs.gaia_source_ingest() first'.format(
+            h5filename))
+    if columns is None:
+        columns = _GAIA_SOURCE_COLUMNS
+    h5f = h5py.File(h5filename, 'r')
+    if in_memory is False:
+        return {name: h5f[name] for name in columns}
+    with h5f:
+        return {name: h5f[name][()] for name in columns}
+
+
+def tgas_load(dr=None, columns=None, parallax_error_ratio=0.2):
+    """
+    NAME: tgas_load
+    PURPOSE: load TGAS into a single structured table, the files are read in one pass into columns preallocated from
+             the row counts in their headers, then the quality cuts are applied as one boolean mask
+    INPUT:
+        dr = 1
+        columns = list of columns, default to all of ra, dec, pmra, pmdec, parallax, parallax_error, phot_g_mean_mag
+        parallax_error_ratio = keep sources with positive parallax and parallax_error/parallax not larger than this,
+                               None to keep every source
+    OUTPUT: numpy structured array with a field for each column
+    HISTORY:
+        2017-Nov-26 Henry Leung
+    """
+    tgas_list = tgas(dr=dr)
+    if columns is None:
+        columns = _TGAS_COLUMNS
+    columns = list(columns)
+    load_columns = columns if parallax_error_ratio is None else \
+        columns + [name for name in ('parallax', 'parallax_error') if name not in columns]
+
+    lengths = [fits.getheader(path, 1)['NAXIS2'] for path in tgas_list]
+    table = np.empty(sum(lengths), dtype=[(name, np.float64) for name in load_columns])
+    start = 0
+    for path, length in zip(tgas_list, lengths):
+        with fits.open(path, memmap=True) as hdulist:
+            data = hdulist[1].data
+            for name in load_columns:
+                table[name][start:start + length] = data[name]
+        start += length
+
+    if parallax_error_ratio is not None:
+        good = (table['parallax'] > 0.) & (table['parallax_error'] <= parallax_error_ratio * table['parallax'])
+        table = table[good]
+    if load_columns != columns:
+        table = np.array(table[columns])
+    return table
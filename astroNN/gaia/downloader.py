@@ -3,10 +3,12 @@
 # ---------------------------------------------------------#
 
 import os
-import urllib.request
 
-from astroNN.shared.downloader_tools import TqdmUpTo
+from tqdm import tqdm
+
+from astroNN.shared.downloader_tools import TqdmUpTo, fetch, urlretrieve
 from astroNN.gaia.gaia_shared import gaia_env, gaia_default_dr
+from astroNN.shared.inventory import record_download
 
 currentdir = os.getcwd()
 _GAIA_DATA = gaia_env()
@@ -25,6 +27,7 @@ def tgas(dr=None):
     # Check if dr arguement is provided, if none then use default
     dr = gaia_default_dr(dr=dr)
     fulllist = []
+    downloaded = []
 
     if dr == 1:
         # Check if directory exists
@@ -42,48 +45,71 @@ def tgas(dr=None):
                 # progress bar
                 with TqdmUpTo(unit='B', unit_scale=True, miniters=1, desc=urlstr.split('/')[-1]) as t:
                     # Download
-                    urllib.request.urlretrieve(urlstr, fullfilename, reporthook=t.update_to)
+                    urlretrieve(urlstr, fullfilename, reporthook=t.update_to)
+                downloaded.append(fullfilename)
                 print('Downloaded Gaia DR{:d} TGAS ({:d} of 15) file catalog successfully to {}'.format(dr, i,
                                                                                                         fullfilename))
             else:
                 print(fullfilename + ' was found!')
 
             fulllist.extend([fullfilename])
+        # TGAS is a catalog, it counts towards the quota of the mirror but is never evicted
+        if downloaded:
+            record_download(_GAIA_DATA, downloaded)
     else:
         raise ValueError('[astroNN.gaia.downloader.tgas()] only supports Gaia DR1 TGAS')
 
     return fulllist
 
 
-def gaia_source(dr=None):
-    # TODO not working
+def gaia_source_files(dr=None):
     """
-    NAME: gaia_source
-    PURPOSE: download the gaia_source files
+    NAME: gaia_source_files
+    PURPOSE: urls and local paths of all the gaia_source files
     INPUT:
-    OUTPUT: (just downloads)
+        dr = 1
+    OUTPUT: list of (url, full local file path)
     HISTORY:
-        2017-Oct-13 Henry Leung
+        2017-Nov-24 Henry Leung
     """
-
     dr = gaia_default_dr(dr=dr)
 
     if dr == 1:
-        for j in range(0, 20, 1):
-            for i in range(0, 256, 1):
-                urlstr = 'http://cdn.gea.esac.esa.int/Gaia/gaia_source/fits/GaiaSource_000-0{:02d}-{:03d}.fits'.format(
-                    j, i)
-                with TqdmUpTo(unit='B', unit_scale=True, miniters=1, desc=urlstr.split('/')[-1]) as t:
-                    urllib.request.urlretrieve(urlstr, reporthook=t.update_to)
-                print('Downloaded Gaia DR{:d} Gaia Source ({:d} of {:d}) file catalog successfully to {}') % (
-                    dr, (j * 256 + i), 256 * 20 + 112, currentdir)
-        for i in range(0, 111, 1):
-            urlstr = 'http://cdn.gea.esac.esa.int/Gaia/gaia_source/fits/GaiaSource_000-020-{:03d}.fits'.format(i)
-            with TqdmUpTo(unit='B', unit_scale=True, miniters=1, desc=urlstr.split('/')[-1]) as t:
-                urllib.request.urlretrieve(urlstr, reporthook=t.update_to)
-            print('Downloaded Gaia DR{:d} Gaia Source ({:d} of {:d}) file catalog successfully to {}') % (
-                dr, (20 * 256 + i), 256 * 20 + 112, currentdir)
+        folderpath = os.path.join(_GAIA_DATA, 'Gaia/gaia_source/fits/')
+        # 20 x 256 files and then 111 files in the last folder
+        filenames = ['GaiaSource_000-{:03d}-{:03d}.fits'.format(j, i) for j in range(0, 20, 1)
+                     for i in range(0, 256, 1)]
+        filenames.extend(['GaiaSource_000-020-{:03d}.fits'.format(i) for i in range(0, 111, 1)])
+        return [('http://cdn.gea.esac.esa.int/Gaia/gaia_source/fits/{}'.format(filename),
+                 os.path.join(folderpath, filename)) for filename in filenames]
     else:
         raise ValueError('[astroNN.gaia.downloader.gaia_source()] only supports Gaia DR1 Gaia Source')
 
-    return None
+
+def gaia_source(dr=None, workers=8, quota=None):
+    """
+    NAME: gaia_source
+    PURPOSE: download the gaia_source files, use astroNN.gaia.catalogs.gaia_source_ingest() instead to keep only the
+             columns needed in a single h5 file without keeping thousands of FITS files around
+    INPUT:
+        dr = 1
+        workers = number of concurrent connections
+        quota = disk quota of the local mirror in bytes or a string like '500G', None to use ASTRONN_MIRROR_QUOTA,
+                only other evictable files are deleted to make room since all gaia_source files are asked for
+    OUTPUT: list of full local file path
+    HISTORY:
+        2017-Oct-13 Henry Leung
+    """
+    jobs = gaia_source_files(dr=dr)
+    missing = [job for job in jobs if not os.path.isfile(job[1])]
+    if missing:
+        if not os.path.exists(os.path.dirname(missing[0][1])):
+            os.makedirs(os.path.dirname(missing[0][1]))
+        with tqdm(total=len(missing), unit='file', desc='gaia_source') as t:
+            flags = fetch(missing, connections=workers, callback=lambda counter, flag: t.update(1))
+        record_download(_GAIA_DATA, [job[1] for job, flag in zip(missing, flags) if flag is None], quota=quota,
+                        keep=[job[1] for job in jobs])
+        print('Downloaded {} of {} missing Gaia DR1 Gaia Source files successfully to {}'.format(
+            flags.count(None), len(missing), os.path.dirname(missing[0][1])))
+
+    return [job[1] for job in jobs]
@@ -2,8 +2,19 @@
 #   astroNN.shared.downloader_tools: shared download tools
 # ---------------------------------------------------------#
 
+import asyncio
+import os
+import ssl
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
 from tqdm import tqdm
 
+# Size of each read from the socket and of each write to the file
+_BLOCK_SIZE = 1024 * 64
+
 
 class TqdmUpTo(tqdm):
     """Provides `update_to(n)` which uses `tqdm.update(delta_n)`."""
@@ -19,4 +30,381 @@ class TqdmUpTo(tqdm):
         """
         if tsize is not None:
             self.total = tsize
-        self.update(b * bsize - self.n)  # will also set self.n = b * bsize
\ No newline at end of file
+        self.update(b * bsize - self.n)  # will also set self.n = b * bsize
+
+
+class _Connection(object):
+    """
+    NAME: _Connection
+    PURPOSE: a persistent HTTP/1.1 connection to one host, reopened whenever the server closed it
+    HISTORY:
+        2017-Nov-22 Henry Leung
+    """
+    def __init__(self, scheme, host, port, timeout):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.reused = False  # whether a request was already served on this connection
+
+    async def open(self):
+        if self.reader is None:
+            context = ssl.create_default_context() if self.scheme == 'https' else None
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, ssl=context), self.timeout)
+            self.reused = False
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader, self.writer = None, None
+
+    async def readline(self):
+        return await asyncio.wait_for(self.reader.readline(), self.timeout)
+
+    async def read(self, size):
+        return await asyncio.wait_for(self.reader.read(size), self.timeout)
+
+    async def readexactly(self, size):
+        return await asyncio.wait_for(self.reader.readexactly(size), self.timeout)
+
+    async def request(self, path, headers=None):
+        """
+        NAME: request
+        PURPOSE: send a GET request and read the status line and headers of the response
+        INPUT:
+            path = path of the url including the query
+            headers = dictionary of extra request headers
+        OUTPUT: (status code, dictionary of lower case response headers)
+        HISTORY:
+            2017-Nov-22 Henry Leung
+        """
+        lines = ['GET {} HTTP/1.1'.format(path), 'Host: {}'.format(self.host), 'User-Agent: astroNN',
+                 'Accept-Encoding: identity', 'Connection: keep-alive']
+        if headers is not None:
+            lines.extend(['{}: {}'.format(key, value) for key, value in headers.items()])
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await self.writer.drain()
+
+        status_line = await self.readline()
+        if not status_line:
+            raise ConnectionResetError('Connection closed by {}'.format(self.host))
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while True:
+            line = await self.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            response_headers[key.strip().lower()] = value.strip()
+        if status_line.startswith(b'HTTP/1.0') and response_headers.get('connection', '').lower() != 'keep-alive':
+            response_headers['connection'] = 'close'
+        self.reused = True
+        return status, response_headers
+
+    async def body(self, headers):
+        """
+        NAME: body
+        PURPOSE: iterate over blocks of the response body, handles Content-Length, chunked and read until close
+        INPUT:
+            headers = response headers from request()
+        OUTPUT: async generator of bytes
+        HISTORY:
+            2017-Nov-22 Henry Leung
+        """
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size = int((await self.readline()).split(b';')[0], 16)
+                if size == 0:
+                    # Skip the trailers
+                    while (await self.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                while size > 0:
+                    block = await self.read(min(size, _BLOCK_SIZE))
+                    if not block:
+                        raise asyncio.IncompleteReadError(block, size)
+                    size -= len(block)
+                    yield block
+                await self.readexactly(2)
+        elif 'content-length' in headers:
+            remaining = int(headers['content-length'])
+            while remaining > 0:
+                block = await self.read(min(remaining, _BLOCK_SIZE))
+                if not block:
+                    raise asyncio.IncompleteReadError(block, remaining)
+                remaining -= len(block)
+                yield block
+        else:
+            while True:
+                block = await self.read(_BLOCK_SIZE)
+                if not block:
+                    break
+                yield block
+            headers['connection'] = 'close'
+        if headers.get('connection', '').lower() == 'close':
+            self.close()
+
+
+def part_path(fullfilename):
+    """
+    NAME: part_path
+    PURPOSE: path of the part-file an unfinished download of fullfilename is written to
+    INPUT:
+        fullfilename = full local file path
+    OUTPUT: full path of the part-file
+    HISTORY:
+        2017-Nov-22 Henry Leung
+    """
+    return fullfilename + '.part'
+
+
+def _proxied(url):
+    # The keep-alive engine connects to the host directly, so hosts which have to be reached through a proxy of
+    # HTTP_PROXY/HTTPS_PROXY (and not listed in no_proxy) are downloaded with urllib, which goes through the proxy
+    parts = urllib.parse.urlsplit(url)
+    proxies = urllib.request.getproxies()
+    return parts.scheme in proxies and not urllib.request.proxy_bypass(parts.netloc)
+
+
+def _urllib_fetch(url, fullfilename, reporthook=None, timeout=60):
+    # Fallback for hosts behind a proxy and for responses the keep-alive engine does not handle itself, i.e.
+    # redirects. Part-files are resumed with a Range request the same way as the keep-alive engine does
+    partname = part_path(fullfilename)
+    offset = os.path.getsize(partname) if os.path.isfile(partname) else 0
+    request = urllib.request.Request(url, headers={'User-Agent': 'astroNN', 'Accept-Encoding': 'identity'})
+    if offset > 0:
+        request.add_header('Range', 'bytes={}-'.format(offset))
+    try:
+        # A new opener reads the proxy settings again, urlopen() keeps those of its first call
+        response = urllib.request.build_opener().open(request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        content_range = e.headers.get('Content-Range', '') if e.headers is not None else ''
+        e.close()
+        if e.code == 416 and offset > 0:
+            # Nothing left to send, the part-file is complete if it has the size of the remote file
+            total = content_range.rpartition('/')[2]
+            if total.isdigit() and int(total) == offset:
+                os.replace(partname, fullfilename)
+                return None
+        if os.path.isfile(partname):
+            os.remove(partname)
+        return 1
+    except (urllib.error.URLError, OSError):
+        # The part-file is kept so the next attempt resumes from where this one stopped
+        return 1
+
+    with response:
+        if response.status == 206:
+            content_range = response.headers.get('Content-Range', '')
+            start = int(content_range.split()[1].split('-')[0]) if content_range.startswith('bytes ') else -1
+            if start != offset:
+                os.remove(partname)
+                return 1
+        else:
+            # Server ignored the Range request, start over
+            offset = 0
+        length = int(response.headers['Content-Length']) if 'Content-Length' in response.headers else -1
+        total = offset + length if length >= 0 else -1
+        received = offset
+        try:
+            with open(partname, 'ab' if offset > 0 else 'wb') as f:
+                if reporthook is not None:
+                    reporthook(received, 1, total)
+                while True:
+                    block = response.read(_BLOCK_SIZE)
+                    if not block:
+                        break
+                    f.write(block)
+                    received += len(block)
+                    if reporthook is not None:
+                        reporthook(received, 1, total)
+        except OSError:
+            return 1
+
+    if total >= 0 and received != total:
+        return 1
+    os.replace(partname, fullfilename)
+    return None
+
+
+async def _download(connection, url, fullfilename, reporthook):
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path + ('?' + parts.query if parts.query else '')
+
+    # The file is written to a part-file and only renamed to fullfilename once complete, an interrupted download
+    # resumes from the size of the part-file with a Range request
+    partname = part_path(fullfilename)
+    offset = os.path.getsize(partname) if os.path.isfile(partname) else 0
+    request_headers = {'Range': 'bytes={}-'.format(offset)} if offset > 0 else None
+
+    # A kept-alive connection may have been closed by the server in the meantime, then retry once on a new one
+    for attempt in range(2):
+        await connection.open()
+        reused = connection.reused
+        try:
+            status, headers = await connection.request(path, headers=request_headers)
+            break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError, IndexError):
+            connection.close()
+            if not reused or attempt == 1:
+                raise
+
+    if status == 206:
+        # Content-Range: bytes start-end/total
+        content_range = headers.get('content-range', '')
+        start = int(content_range.split()[1].split('-')[0]) if content_range.startswith('bytes ') else -1
+        if start != offset:
+            async for _ in connection.body(headers):
+                pass
+            os.remove(partname)
+            return 1
+    elif status == 200:
+        # Server ignored the Range request, start over
+        offset = 0
+    else:
+        async for _ in connection.body(headers):
+            pass
+        if status == 416 and offset > 0:
+            # Nothing left to send, the part-file is complete if it has the size of the remote file
+            total = headers.get('content-range', '').rpartition('/')[2]
+            if total.isdigit() and int(total) == offset:
+                os.replace(partname, fullfilename)
+                return None
+            os.remove(partname)
+            return 1
+        if os.path.isfile(partname):
+            os.remove(partname)
+        if status in (301, 302, 303, 307, 308):
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(None, _urllib_fetch, url, fullfilename, reporthook,
+                                              connection.timeout)
+        return 1
+
+    length = int(headers['content-length']) if 'content-length' in headers else -1
+    total = offset + length if length >= 0 else -1
+    received = offset
+    with open(partname, 'ab' if offset > 0 else 'wb') as f:
+        if reporthook is not None:
+            reporthook(received, 1, total)
+        async for block in connection.body(headers):
+            f.write(block)
+            received += len(block)
+            if reporthook is not None:
+                reporthook(received, 1, total)
+
+    # The connection may be closed early by the server without an error, keep the part-file to resume later
+    if total >= 0 and received != total:
+        return 1
+    os.replace(partname, fullfilename)
+    return None
+
+
+async def _host_worker(queue, connection, flags, jobs, reporthook, callback):
+    while True:
+        try:
+            counter = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            break
+        url, fullfilename = jobs[counter]
+        try:
+            flags[counter] = await _download(connection, url, fullfilename, reporthook)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, IndexError):
+            # The part-file is kept so the next attempt resumes from where this one stopped
+            connection.close()
+            flags[counter] = 1
+        if callback is not None:
+            callback(counter, flags[counter])
+    connection.close()
+
+
+async def _proxy_worker(queue, flags, jobs, reporthook, callback, timeout):
+    loop = asyncio.get_event_loop()
+    while True:
+        try:
+            counter = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            break
+        url, fullfilename = jobs[counter]
+        flags[counter] = await loop.run_in_executor(None, _urllib_fetch, url, fullfilename, reporthook, timeout)
+        if callback is not None:
+            callback(counter, flags[counter])
+
+
+async def _fetch(jobs, connections, reporthook, callback, timeout):
+    flags = [1] * len(jobs)
+    # One queue of jobs and one pool of persistent connections for each host, jobs through a proxy share one queue
+    queues = {}
+    proxy_queue = asyncio.Queue()
+    for counter, (url, _) in enumerate(jobs):
+        if _proxied(url):
+            proxy_queue.put_nowait(counter)
+            continue
+        parts = urllib.parse.urlsplit(url)
+        port = parts.port if parts.port is not None else (443 if parts.scheme == 'https' else 80)
+        key = (parts.scheme, parts.hostname, port)
+        if key not in queues:
+            queues[key] = asyncio.Queue()
+        queues[key].put_nowait(counter)
+
+    workers = []
+    for (scheme, host, port), queue in queues.items():
+        for _ in range(min(connections, queue.qsize())):
+            workers.append(_host_worker(queue, _Connection(scheme, host, port, timeout), flags, jobs, reporthook,
+                                        callback))
+    for _ in range(min(connections, proxy_queue.qsize())):
+        workers.append(_proxy_worker(proxy_queue, flags, jobs, reporthook, callback, timeout))
+    await asyncio.gather(*workers)
+    return flags
+
+
+def fetch(jobs, connections=8, reporthook=None, callback=None, timeout=60):
+    """
+    NAME: fetch
+    PURPOSE: download many files over a pool of persistent HTTP/1.1 connections per host, so the TCP/TLS handshake
+             is paid once per connection instead of once per file. Files appear at their path only when complete,
+             interrupted downloads are kept as part-files and resumed with a Range request next time. Hosts which
+             have to be reached through a proxy of HTTP_PROXY/HTTPS_PROXY are downloaded with urllib instead
+    INPUT:
+        jobs = list of (url, full local file path)
+        connections = number of persistent connections per host
+        reporthook = function(bytes so far, 1, total bytes or -1) compatible with TqdmUpTo.update_to, called as bytes
+                     arrive, only meaningful for a single job
+        callback = function(index of job, warning_flag) called when each job is done
+        timeout = seconds to wait on the network before a job fails
+    OUTPUT: list of warning_flag in the order of jobs, None if downloaded successfully or 1 if failed
+    HISTORY:
+        2017-Nov-22 Henry Leung
+    """
+    if len(jobs) == 0:
+        return []
+
+    def runner():
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(_fetch(jobs, connections, reporthook, callback, timeout))
+        finally:
+            loop.close()
+
+    # The event loop runs in its own thread, so fetch() also works when the caller runs an event loop (i.e. Jupyter)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(runner).result()
+
+
+def urlretrieve(url, fullfilename, reporthook=None):
+    """
+    NAME: urlretrieve
+    PURPOSE: download a single file with fetch(), replacement of urllib.request.urlretrieve
+    INPUT:
+        url = url of the file
+        fullfilename = full local file path
+        reporthook = function(bytes so far, 1, total bytes or -1), i.e. TqdmUpTo.update_to
+    OUTPUT: full local file path
+    HISTORY:
+        2017-Nov-22 Henry Leung
+    """
+    if fetch([(url, fullfilename)], connections=1, reporthook=reporthook)[0] is not None:
+        raise ConnectionError('{} cannot be downloaded'.format(url))
+    return fullfilename
@@ -0,0 +1,348 @@
+# ---------------------------------------------------------#
+#   astroNN.shared.inventory: inventory of files in a local data mirror
+# ---------------------------------------------------------#
+
+import contextlib
+import os
+import time
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, the inventory is still merged on save but without a lock
+    fcntl = None
+
+# Inventories already loaded in this process, keyed by the root of the mirror
+_INVENTORY = {}
+
+# Only files starting with these names can be evicted, catalogs (allStar, allVisit, TGAS, etc.) are always kept
+_EVICTABLE = ('aspcapStar-', 'apStar-', 'GaiaSource_')
+
+_UNITS = {'K': 1e3, 'M': 1e6, 'G': 1e9, 'T': 1e12}
+
+
+def mirror_quota(quota=None):
+    """
+    NAME: mirror_quota
+    PURPOSE: disk quota of local mirrors in bytes, from the argument or the ASTRONN_MIRROR_QUOTA environment variable
+    INPUT:
+        quota = bytes, or a string like '500G', None to read ASTRONN_MIRROR_QUOTA
+    OUTPUT: quota in bytes, None if there is no quota
+    HISTORY:
+        2017-Nov-24 Henry Leung
+    """
+    if quota is None:
+        quota = os.getenv('ASTRONN_MIRROR_QUOTA')
+        if quota is None or quota == '':
+            return None
+    if isinstance(quota, str):
+        quota = quota.strip().upper().rstrip('B')
+        if quota[-1] in _UNITS:
+            return int(float(quota[:-1]) * _UNITS[quota[-1]])
+        return int(float(quota))
+    return int(quota)
+
+
+class MirrorInventory(object):
+    """
+    NAME: MirrorInventory
+    PURPOSE: in-memory inventory of the files in a local mirror (i.e. SDSS_LOCAL_SAS_MIRROR), built by a single scan of
+             the directory tree and updated by the downloader, so checking which of many files are present takes no
+             filesystem metadata call at all. The inventory is saved to astroNN_inventory.npz in the root of the mirror.
+             It also keeps when each file was last used, so least recently used spectra can be evicted under a quota.
+             Several processes can share a mirror, each saves only its own changes merged into the saved inventory
+             under a file lock
+    INPUT:
+        root = root directory of the mirror
+        rescan = True to ignore the saved inventory and scan the mirror again
+    HISTORY:
+        2017-Nov-23 Henry Leung
+    """
+    filename = 'astroNN_inventory.npz'
+    lockname = 'astroNN_inventory.lock'
+
+    def __init__(self, root, rescan=False):
+        self.root = os.path.normpath(root)
+        self.path = os.path.join(self.root, self.filename)
+        self._sizes = {}
+        self._atimes = {}
+        # Changes made by this process since the last save, key to ('add', size, atime), ('touch', atime) or
+        # ('remove',), replayed on top of whatever other processes saved in the meantime
+        self._changes = {}
+        if rescan is False and os.path.isfile(self.path):
+            self._sizes, self._atimes = self._read()
+        else:
+            self.scan()
+
+    def _key(self, fullfilename):
+        return os.path.normpath(fullfilename)[len(self.root) + 1:]
+
+    def _read(self):
+        with np.load(self.path) as inventory:
+            paths = inventory['paths'].tolist()
+            sizes = dict(zip(paths, inventory['sizes'].tolist()))
+            atimes = dict(zip(paths, inventory['atimes'].tolist())) if 'atimes' in inventory else {}
+        return sizes, atimes
+
+    @contextlib.contextmanager
+    def _lock(self):
+        # Not reentrant, methods holding the lock use _merge() and _write() directly
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        with open(os.path.join(self.root, self.lockname), 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _merge(self):
+        # Start from the saved inventory, which has the changes of other processes, then replay the changes of this one
+        if not os.path.isfile(self.path):
+            self._changes = {}
+            return None
+        sizes, atimes = self._read()
+        for key, change in self._changes.items():
+            if change[0] == 'add':
+                sizes[key] = change[1]
+                atimes[key] = max(atimes.get(key, 0.), change[2])
+            elif change[0] == 'touch':
+                # A file evicted by another process is not brought back by using the stale entry
+                if key in sizes:
+                    atimes[key] = max(atimes.get(key, 0.), change[1])
+            else:
+                sizes.pop(key, None)
+                atimes.pop(key, None)
+        self._sizes, self._atimes = sizes, atimes
+        self._changes = {}
+        return None
+
+    def _write(self):
+        temppath = self.path + '.tmp'
+        with open(temppath, 'wb') as f:
+            paths = list(self._sizes.keys())
+            np.savez_compressed(f, paths=np.array(paths, dtype=str),
+                                sizes=np.array([self._sizes[path] for path in paths], dtype=np.int64),
+                                atimes=np.array([self._atimes.get(path, 0.) for path in paths], dtype=np.float64))
+        os.replace(temppath, self.path)
+
+    def scan(self):
+        """
+        NAME: scan
+        PURPOSE: rebuild the inventory with one pass of os.scandir over the mirror and save it
+        INPUT:
+        OUTPUT: None
+        HISTORY:
+            2017-Nov-23 Henry Leung
+        """
+        sizes = {}
+        atimes = {}
+        directories = [self.root] if os.path.isdir(self.root) else []
+        while directories:
+            directory = directories.pop()
+            for entry in os.scandir(directory):
+                if entry.is_dir(follow_symlinks=False):
+                    # Column caches are derived from the catalogs and not part of the mirror
+                    if entry.name != 'astroNN_cache':
+                        directories.append(entry.path)
+                elif not entry.name.startswith('astroNN_') and not entry.name.endswith(('.part', '.tmp')):
+                    # Files made by astroNN itself (this inventory, its lock, h5 stores) are not part of the mirror
+                    stat = entry.stat()
+                    sizes[self._key(entry.path)] = stat.st_size
+                    atimes[self._key(entry.path)] = max(stat.st_atime, stat.st_mtime)
+        # The scan is the truth about the mirror, so it replaces the saved inventory instead of being merged
+        with self._lock():
+            self._sizes, self._atimes, self._changes = sizes, atimes, {}
+            self._write()
+        return None
+
+    def save(self):
+        """
+        NAME: save
+        PURPOSE: merge the changes of this process into the inventory saved in the root of the mirror, the inventory
+                 in memory is updated with the changes saved by other processes. Reading and writing the whole
+                 inventory, bulk downloads only save once when they are done
+        INPUT:
+        OUTPUT: None
+        HISTORY:
+            2017-Nov-23 Henry Leung
+        """
+        with self._lock():
+            self._merge()
+            self._write()
+        return None
+
+    def add(self, fullfilenames, save=True):
+        """
+        NAME: add
+        PURPOSE: record files which were just downloaded
+        INPUT:
+            fullfilenames = full path or list of full paths of files in the mirror
+            save = whether to save the inventory right away
+        OUTPUT: None
+        HISTORY:
+            2017-Nov-23 Henry Leung
+        """
+        now = time.time()
+        for fullfilename in np.atleast_1d(fullfilenames).tolist():
+            key = self._key(fullfilename)
+            self._sizes[key] = os.path.getsize(fullfilename)
+            self._atimes[key] = now
+            self._changes[key] = ('add', self._sizes[key], now)
+        if save is True:
+            self.save()
+        return None
+
+    def remove(self, fullfilenames, save=True):
+        """
+        NAME: remove
+        PURPOSE: forget files which were deleted from the mirror
+        INPUT:
+            fullfilenames = full path or list of full paths of files in the mirror
+            save = whether to save the inventory right away
+        OUTPUT: None
+        HISTORY:
+            2017-Nov-23 Henry Leung
+        """
+        for fullfilename in np.atleast_1d(fullfilenames).tolist():
+            key = self._key(fullfilename)
+            self._sizes.pop(key, None)
+            self._atimes.pop(key, None)
+            self._changes[key] = ('remove',)
+        if save is True:
+            self.save()
+        return None
+
+    def touch(self, fullfilenames, save=False):
+        """
+        NAME: touch
+        PURPOSE: record that files were just used
+        INPUT:
+            fullfilenames = full path or list of full paths of files in the mirror
+            save = whether to save the inventory right away
+        OUTPUT: None
+        HISTORY:
+            2017-Nov-24 Henry Leung
+        """
+        now = time.time()
+        for fullfilename in np.atleast_1d(fullfilenames).tolist():
+            key = self._key(fullfilename)
+            if key in self._sizes:
+                self._atimes[key] = now
+                change = self._changes.get(key)
+                self._changes[key] = ('add', change[1], now) if change is not None and change[0] == 'add' else \
+                    ('touch', now)
+        if save is True:
+            self.save()
+        return None
+
+    def total_size(self):
+        return sum(self._sizes.values())
+
+    def evict(self, quota=None, keep=None, evictable=_EVICTABLE):
+        """
+        NAME: evict
+        PURPOSE: delete least recently used files until the mirror fits in the quota, catalogs are never deleted. The
+                 inventory is saved in the same pass, so there is no need to save() after
+        INPUT:
+            quota = bytes or a string like '500G', None to use ASTRONN_MIRROR_QUOTA, nothing is deleted without quota
+            keep = list of full paths never to delete, i.e. files needed by the running compilation
+            evictable = tuple of the beginning of the names of files which can be deleted
+        OUTPUT: list of full paths deleted
+        HISTORY:
+            2017-Nov-24 Henry Leung
+        """
+        quota = mirror_quota(quota)
+        if quota is None:
+            self.save()
+            return []
+
+        keep = set(self._key(fullfilename) for fullfilename in np.atleast_1d(keep).tolist()) if keep is not None \
+            else set()
+        evicted = []
+        # Decided on the merged inventory under the lock, so the latest use of a file by any process counts
+        with self._lock():
+            self._merge()
+            excess = self.total_size() - quota
+            candidates = [key for key in self._sizes if os.path.basename(key).startswith(evictable) and key not in keep]
+            candidates.sort(key=lambda key: self._atimes.get(key, 0.))
+            for key in candidates:
+                if excess <= 0:
+                    break
+                fullfilename = os.path.join(self.root, key)
+                try:
+                    os.remove(fullfilename)
+                except FileNotFoundError:
+                    pass
+                excess -= self._sizes.pop(key)
+                self._atimes.pop(key, None)
+                evicted.append(fullfilename)
+            self._write()
+        if excess > 0:
+            print('Local mirror {} is still {:.1f} MB over its quota, only catalogs and files in use are left'.format(
+                self.root, excess / 1e6))
+        return evicted
+
+    def contains(self, fullfilenames):
+        """
+        NAME: contains
+        PURPOSE: vectorized check of which files are in the mirror
+        INPUT:
+            fullfilenames = list of full paths
+        OUTPUT: boolean array
+        HISTORY:
+            2017-Nov-23 Henry Leung
+        """
+        return np.array([self._key(fullfilename) in self._sizes
+                         for fullfilename in np.atleast_1d(fullfilenames).tolist()], dtype=bool)
+
+    def size(self, fullfilename):
+        return self._sizes[self._key(fullfilename)]
+
+    def __contains__(self, fullfilename):
+        return self._key(fullfilename) in self._sizes
+
+    def __len__(self):
+        return len(self._sizes)
+
+
+def mirror_inventory(root, rescan=False):
+    """
+    NAME: mirror_inventory
+    PURPOSE: inventory of a local mirror, loaded once per process
+    INPUT:
+        root = root directory of the mirror
+        rescan = True to scan the mirror again, i.e. after files were added or deleted by hand
+    OUTPUT: MirrorInventory
+    HISTORY:
+        2017-Nov-23 Henry Leung
+    """
+    key = os.path.normpath(root)
+    if key not in _INVENTORY:
+        _INVENTORY[key] = MirrorInventory(root, rescan=rescan)
+    elif rescan is True:
+        _INVENTORY[key].scan()
+    return _INVENTORY[key]
+
+
+def record_download(root, fullfilenames, quota=None, keep=None):
+    """
+    NAME: record_download
+    PURPOSE: record files just downloaded into the inventory of a local mirror and save it, least recently used files
+             are evicted in the same pass if the mirror is over quota
+    INPUT:
+        root = root directory of the mirror
+        fullfilenames = full path or list of full paths of the downloaded files
+        quota = bytes or a string like '500G', None to use ASTRONN_MIRROR_QUOTA
+        keep = list of full paths never to delete, default to the downloaded files
+    OUTPUT: list of full paths deleted
+    HISTORY:
+        2017-Nov-24 Henry Leung
+    """
+    inventory = mirror_inventory(root)
+    inventory.add(fullfilenames, save=False)
+    return inventory.evict(quota=quota, keep=fullfilenames if keep is None else keep)
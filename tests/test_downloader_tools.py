@@ -0,0 +1,152 @@
+# ---------------------------------------------------------#
+#   tests of astroNN.shared.downloader_tools against a local stand-in of the SAS
+# ---------------------------------------------------------#
+
+import http.server
+import os
+import threading
+
+import pytest
+
+from astroNN.shared.downloader_tools import fetch, part_path
+
+FILES = {'/dr14/aspcapStar-{}.fits'.format(i): os.urandom(100000 + i) for i in range(5)}
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        self.server.connections += 1
+        super().setup()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path
+        proxied = path.startswith('http://')
+        if proxied:
+            # Request line of a client going through a proxy has the absolute url
+            path = '/' + path.split('/', 3)[3]
+        self.server.requests.append((path, self.headers.get('Range'), proxied))
+
+        if path.startswith('/redirect/'):
+            self.send_response(302)
+            self.send_header('Location', path[len('/redirect'):])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if path not in FILES:
+            self.send_error(404)
+            return
+
+        data = FILES[path]
+        start = 0
+        if self.headers.get('Range') is not None:
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(len(data)))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+
+@pytest.fixture
+def server(monkeypatch):
+    for name in ('http_proxy', 'HTTP_PROXY', 'https_proxy', 'HTTPS_PROXY', 'no_proxy', 'NO_PROXY'):
+        monkeypatch.delenv(name, raising=False)
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    httpd.daemon_threads = True
+    httpd.connections = 0
+    httpd.requests = []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _url(server, path):
+    return 'http://127.0.0.1:{}{}'.format(server.server_address[1], path)
+
+
+def test_keep_alive_reuse(server, tmpdir):
+    jobs = [(_url(server, path), str(tmpdir.join(os.path.basename(path)))) for path in sorted(FILES)]
+    assert fetch(jobs, connections=1) == [None] * len(jobs)
+    for path, fullfilename in zip(sorted(FILES), [job[1] for job in jobs]):
+        with open(fullfilename, 'rb') as f:
+            assert f.read() == FILES[path]
+    # Every file went over the same connection
+    assert server.connections == 1
+
+
+def test_range_resume(server, tmpdir):
+    path = sorted(FILES)[0]
+    fullfilename = str(tmpdir.join('resumed.fits'))
+    with open(part_path(fullfilename), 'wb') as f:
+        f.write(FILES[path][:30000])
+    assert fetch([(_url(server, path), fullfilename)]) == [None]
+    assert server.requests == [(path, 'bytes=30000-', False)]
+    with open(fullfilename, 'rb') as f:
+        assert f.read() == FILES[path]
+    assert not os.path.exists(part_path(fullfilename))
+
+
+def test_range_complete_part_file(server, tmpdir):
+    # A part-file which already has every byte gets 416 and is renamed without downloading again
+    path = sorted(FILES)[1]
+    fullfilename = str(tmpdir.join('complete.fits'))
+    with open(part_path(fullfilename), 'wb') as f:
+        f.write(FILES[path])
+    assert fetch([(_url(server, path), fullfilename)]) == [None]
+    with open(fullfilename, 'rb') as f:
+        assert f.read() == FILES[path]
+    assert not os.path.exists(part_path(fullfilename))
+
+
+def test_redirect_fallback(server, tmpdir):
+    path = sorted(FILES)[2]
+    fullfilename = str(tmpdir.join('redirected.fits'))
+    assert fetch([(_url(server, '/redirect' + path), fullfilename)]) == [None]
+    assert [request[0] for request in server.requests] == ['/redirect' + path, '/redirect' + path, path]
+    with open(fullfilename, 'rb') as f:
+        assert f.read() == FILES[path]
+
+
+def test_missing_file(server, tmpdir):
+    fullfilename = str(tmpdir.join('missing.fits'))
+    assert fetch([(_url(server, '/dr14/missing.fits'), fullfilename)]) == [1]
+    assert not os.path.exists(fullfilename)
+    assert not os.path.exists(part_path(fullfilename))
+
+
+def test_proxy(server, tmpdir, monkeypatch):
+    # The stand-in server is also the proxy, requests through a proxy have the absolute url in the request line
+    monkeypatch.setenv('http_proxy', 'http://127.0.0.1:{}'.format(server.server_address[1]))
+    path = sorted(FILES)[3]
+    fullfilename = str(tmpdir.join('proxied.fits'))
+    with open(part_path(fullfilename), 'wb') as f:
+        f.write(FILES[path][:5000])
+    assert fetch([('http://sas.invalid' + path, fullfilename)]) == [None]
+    assert server.requests == [(path, 'bytes=5000-', True)]
+    with open(fullfilename, 'rb') as f:
+        assert f.read() == FILES[path]
+
+
+def test_no_proxy(server, tmpdir, monkeypatch):
+    # Hosts in no_proxy are reached directly by the keep-alive engine even if the proxy does not exist
+    monkeypatch.setenv('http_proxy', 'http://127.0.0.1:9')
+    monkeypatch.setenv('no_proxy', '127.0.0.1')
+    path = sorted(FILES)[4]
+    fullfilename = str(tmpdir.join('direct.fits'))
+    assert fetch([(_url(server, path), fullfilename)]) == [None]
+    assert server.requests == [(path, None, False)]